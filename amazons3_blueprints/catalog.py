@@ -0,0 +1,198 @@
+import binascii
+import operator
+import re
+from array import array
+from datetime import datetime, timezone
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+ETAG_WIDTH = 16
+# Largest part count the 'H' part_counts column holds.
+MAX_PART_COUNT = 0xFFFF
+
+
+def parse_time(value):
+    """
+    Turn an ISO 8601 date or time, or a datetime, into seconds since the epoch.
+    Times without a timezone are taken as UTC, as S3 reports them.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+
+class ObjectFilter:
+    """
+    Which listed objects a run acts on: keys matching pattern, sizes between
+    min_size and max_size inclusive, and last modified at or after modified_after
+    and before modified_before. Bounds left as None don't filter.
+    """
+
+    def __init__(
+            self,
+            pattern=None,
+            min_size=None,
+            max_size=None,
+            modified_after=None,
+            modified_before=None):
+        self.pattern = re.compile(pattern) if isinstance(pattern, str) else pattern
+        self.min_size = min_size
+        self.max_size = max_size
+        self.modified_after = parse_time(modified_after)
+        self.modified_before = parse_time(modified_before)
+
+
+class ObjectCatalog:
+    """
+    Listed objects stored column by column in flat arrays rather than as a dict or
+    string per object, so tens of millions of keys fit in memory.
+
+    Keys are split at their last '/' into a prefix, stored once per distinct prefix,
+    and the remaining name as UTF-8 bytes. Sizes and last modified times are int64
+    columns. ETags are 16-byte MD5 digests with a part count for multipart uploads,
+    and only ETags that aren't MD5 based are kept as strings. An object costs 46
+    bytes plus the length of its name.
+
+    select() filters by size and time a column at a time, using numpy if it's
+    installed, and only decodes the keys that are left to match them by pattern.
+    """
+
+    def __init__(self):
+        self.prefixes = []
+        self._prefix_ids = {}
+        self.prefix_ids = array('I')
+        self.names = bytearray()
+        self.name_ends = array('Q')
+        self.sizes = array('q')
+        self.modified = array('q')
+        self.etags = bytearray()
+        self.part_counts = array('H')
+        self.other_etags = {}
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def add(self, key, size, last_modified, etag):
+        modified = parse_time(last_modified)
+        # Parse the ETag before touching any column, so one that doesn't fit can't
+        # leave the columns with different lengths.
+        etag = etag.strip('"')
+        digest, _, part_count = etag.partition('-')
+        try:
+            digest_bytes = binascii.unhexlify(digest)
+            if len(digest_bytes) != ETAG_WIDTH or not (
+                    part_count == '' or part_count.isdigit()):
+                raise ValueError(etag)
+            part_count = int(part_count or 0)
+            if part_count > MAX_PART_COUNT:
+                raise ValueError(etag)
+            other_etag = None
+        except (binascii.Error, ValueError):
+            digest_bytes = bytes(ETAG_WIDTH)
+            part_count = 0
+            other_etag = etag
+
+        prefix, separator, name = key.rpartition('/')
+        prefix += separator
+        prefix_id = self._prefix_ids.get(prefix)
+        if prefix_id is None:
+            prefix_id = self._prefix_ids[prefix] = len(self.prefixes)
+            self.prefixes.append(prefix)
+        if other_etag is not None:
+            self.other_etags[len(self)] = other_etag
+        self.prefix_ids.append(prefix_id)
+        self.names += name.encode('utf-8')
+        self.name_ends.append(len(self.names))
+        self.sizes.append(size)
+        self.modified.append(modified)
+        self.etags += digest_bytes
+        self.part_counts.append(part_count)
+
+    def add_page(self, contents):
+        """
+        Add the Contents of a ListObjectsV2 response.
+        """
+        for s3_object in contents:
+            self.add(
+                s3_object['Key'],
+                s3_object['Size'],
+                s3_object['LastModified'],
+                s3_object['ETag'])
+
+    @classmethod
+    def from_listing(cls, s3_client, bucket_name, prefix=''):
+        """
+        Build a catalog of every object under prefix, one listing page at a time.
+        """
+        object_catalog = cls()
+        for contents in list_pages(s3_client, bucket_name, prefix):
+            object_catalog.add_page(contents)
+        return object_catalog
+
+    def key(self, index):
+        start = self.name_ends[index - 1] if index else 0
+        return self.prefixes[self.prefix_ids[index]] + self.names[
+            start:self.name_ends[index]].decode('utf-8')
+
+    def etag(self, index):
+        if index in self.other_etags:
+            return self.other_etags[index]
+        digest = self.etags[index * ETAG_WIDTH:(index + 1) * ETAG_WIDTH].hex()
+        part_count = self.part_counts[index]
+        return f'{digest}-{part_count}' if part_count else digest
+
+    def keys(self, indexes=None):
+        """
+        Yield the key of each index, or of every object, decoding them one at a time.
+        """
+        for index in range(len(self)) if indexes is None else indexes:
+            yield self.key(index)
+
+    def select(self, object_filter):
+        """
+        Return an array('Q') of the indexes of the objects that pass object_filter,
+        in listing order.
+        """
+        conditions = [
+            (column, compare, bound) for column, compare, bound in [
+                (self.sizes, operator.ge, object_filter.min_size),
+                (self.sizes, operator.le, object_filter.max_size),
+                (self.modified, operator.ge, object_filter.modified_after),
+                (self.modified, operator.lt, object_filter.modified_before)]
+            if bound is not None]
+        if numpy is not None:
+            mask = numpy.ones(len(self), dtype=bool)
+            for column, compare, bound in conditions:
+                mask &= compare(numpy.frombuffer(column, dtype=numpy.int64), bound)
+            indexes = array('Q')
+            indexes.frombytes(numpy.flatnonzero(mask).astype(numpy.uint64).tobytes())
+        else:
+            indexes = array('Q', range(len(self)))
+            for column, compare, bound in conditions:
+                indexes = array(
+                    'Q', (index for index in indexes if compare(column[index], bound)))
+
+        if object_filter.pattern is not None:
+            search = object_filter.pattern.search
+            indexes = array('Q', (index for index in indexes if search(self.key(index))))
+        return indexes
+
+
+def list_pages(s3_client, bucket_name, prefix=''):
+    """
+    Yield the Contents of every ListObjectsV2 page under prefix.
+    """
+    kwargs = {'Bucket': bucket_name, 'Prefix': prefix}
+    while True:
+        response = s3_client.list_objects_v2(**kwargs)
+        yield response.get('Contents', [])
+        if not response.get('IsTruncated'):
+            return
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
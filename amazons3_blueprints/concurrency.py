@@ -0,0 +1,266 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from boto3.s3.transfer import TransferConfig
+try:
+    import retries
+except BaseException:
+    from . import retries
+
+
+def is_throttling_response(parsed_response):
+    """
+    Determine if a parsed S3 response (or the response attached to a ClientError)
+    indicates that S3 is throttling requests.
+    """
+    if not parsed_response:
+        return False
+    error_code = parsed_response.get('Error', {}).get('Code')
+    status_code = parsed_response.get(
+        'ResponseMetadata', {}).get('HTTPStatusCode')
+    return error_code in retries.THROTTLING_ERROR_CODES or status_code == 503
+
+
+def is_throttling_error(error):
+    """
+    Determine if an exception raised by boto3 was caused by S3 throttling.
+    """
+    return is_throttling_response(getattr(error, 'response', None))
+
+
+class AdaptiveConcurrencyController:
+    """
+    Additive-increase/multiplicative-decrease controller for the number of
+    in-flight S3 requests.
+
+    Completions are grouped into windows of roughly `limit` requests. At the end of
+    each window the limit is raised by `increase_step` if throughput improved, held
+    if it plateaued, and multiplied by `decrease_factor` if average latency rose past
+    `latency_tolerance` times the baseline latency. Throttling cuts the limit
+    immediately, at most once per window.
+
+    The baseline is the lowest window average seen since the last latency cut. After a
+    cut, completions of the requests that were already in flight are skipped, and the
+    first window at the new limit sets the baseline afresh, so a congested window never
+    becomes the latency later windows are judged against.
+    """
+
+    def __init__(
+            self,
+            initial_limit=4,
+            min_limit=1,
+            max_limit=32,
+            increase_step=1,
+            decrease_factor=0.5,
+            latency_tolerance=2.0,
+            improvement_threshold=0.05,
+            min_window_size=4,
+            verbose=True):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = min(max(initial_limit, self.min_limit), self.max_limit)
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.improvement_threshold = improvement_threshold
+        self.min_window_size = min_window_size
+        self.verbose = verbose
+
+        self._lock = threading.Lock()
+        self._best_latency = None
+        self._rebaseline = False
+        self._settling_completions = 0
+        self._last_throughput = None
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_start = time.monotonic()
+        self._window_completions = 0
+        self._window_latency = 0.0
+        self._window_throttled = False
+
+    def _log(self, message):
+        if self.verbose:
+            print(f'Concurrency: {message}')
+
+    def _set_limit(self, new_limit, reason):
+        new_limit = min(max(int(new_limit), self.min_limit), self.max_limit)
+        if new_limit != self.limit:
+            direction = 'increased' if new_limit > self.limit else 'decreased'
+            self._log(f'{direction} from {self.limit} to {new_limit} ({reason})')
+            self.limit = new_limit
+
+    def _cut_limit(self, reason):
+        # Requests started at the old limit would otherwise be judged at the new one.
+        self._settling_completions = self.limit
+        self._set_limit(self.limit * self.decrease_factor, reason)
+        self._last_throughput = None
+        self._reset_window()
+
+    def record_throttle(self):
+        """
+        Register a throttling response from S3. Cuts the limit immediately, unless it
+        has already been cut during the current window.
+        """
+        with self._lock:
+            if self._window_throttled:
+                return
+            self._cut_limit('throttled by S3')
+            self._window_throttled = True
+
+    def record(self, latency, throttled=False):
+        """
+        Register a completed request and its latency in seconds, adjusting the limit
+        once enough requests have completed to judge the current window.
+        """
+        if throttled:
+            self.record_throttle()
+            return
+
+        with self._lock:
+            if self._settling_completions:
+                self._settling_completions -= 1
+                if not self._settling_completions:
+                    self._reset_window()
+                return
+            self._window_completions += 1
+            self._window_latency += latency
+            if self._window_completions < max(self.limit, self.min_window_size):
+                return
+
+            elapsed = max(time.monotonic() - self._window_start, 1e-9)
+            throughput = self._window_completions / elapsed
+            average_latency = self._window_latency / self._window_completions
+            if self._rebaseline or self._best_latency is None or (
+                    average_latency < self._best_latency):
+                self._best_latency = average_latency
+                self._rebaseline = False
+
+            if average_latency > self._best_latency * self.latency_tolerance:
+                self._cut_limit(
+                    f'latency rose to {average_latency:.3f}s from {self._best_latency:.3f}s')
+                self._rebaseline = True
+                return
+            if self._last_throughput is None or throughput > self._last_throughput * (
+                    1 + self.improvement_threshold):
+                self._set_limit(
+                    self.limit + self.increase_step,
+                    f'throughput {throughput:.1f} requests/s')
+
+            self._last_throughput = throughput
+            self._reset_window()
+
+    def observe_client(self, s3_client):
+        """
+        Watch the retries botocore performs internally so that throttling is noticed
+        even when the request eventually succeeds.
+        """
+        s3_client.meta.events.register('needs-retry.s3', self._on_needs_retry)
+        return s3_client
+
+    def _on_needs_retry(self, response=None, **kwargs):
+        if response and is_throttling_response(response[1]):
+            self.record_throttle()
+        return None
+
+
+def transfer_config():
+    """
+    Return the TransferConfig for managed transfers made by run_concurrently workers.
+    Their parts are sent on the worker's own thread rather than a pool per transfer, so
+    the controller's limit is the number of requests actually in flight.
+    """
+    return TransferConfig(use_threads=False)
+
+
+def _timed_call(function, item):
+    """
+    Call function on item, returning its result, how long it took and any exception it raised.
+    Timing inside the worker keeps the latency free of any time spent waiting for work.
+    """
+    start = time.monotonic()
+    try:
+        return function(item), time.monotonic() - start, None
+    except BaseException as error:
+        return None, time.monotonic() - start, error
+
+
+def run_concurrently(
+        function,
+        work_items,
+        controller=None,
+        retry_policy=None,
+        report=None):
+    """
+    Call function on every item in work_items from a pool of threads, keeping the number
+    of in-flight calls at the limit chosen by the controller.
+
+    Work items are pulled lazily, so work_items may be a generator. Returns a list of
+    the results in completion order.
+
+    Without a retry_policy, the first exception raised by function is re-raised once
+    the in-flight calls have finished. With one, failed items are classified and either
+    deferred to a retry queue that is worked through once every other item has been
+    attempted, or recorded as failures on the report.
+    """
+    if controller is None:
+        controller = AdaptiveConcurrencyController()
+    if retry_policy is not None and report is None:
+        report = retries.OperationReport()
+
+    work_items = iter(work_items)
+    retry_queue = retries.RetryQueue()
+    results = []
+    in_flight = {}
+    exhausted = False
+
+    with ThreadPoolExecutor(max_workers=controller.max_limit) as executor:
+        while True:
+            while len(in_flight) < controller.limit:
+                if not exhausted:
+                    try:
+                        item, attempt = next(work_items), 1
+                    except StopIteration:
+                        exhausted = True
+                        continue
+                else:
+                    ready = retry_queue.pop_ready()
+                    if ready is None:
+                        break
+                    item, attempt = ready
+                future = executor.submit(_timed_call, function, item)
+                in_flight[future] = (item, attempt)
+
+            if not in_flight:
+                if not retry_queue:
+                    break
+                time.sleep(retry_queue.seconds_until_ready())
+                continue
+
+            done, _ = wait(
+                in_flight,
+                timeout=retry_queue.seconds_until_ready() if exhausted else None,
+                return_when=FIRST_COMPLETED)
+            for future in done:
+                item, attempt = in_flight.pop(future)
+                result, latency, error = future.result()
+                if error is None:
+                    controller.record(latency)
+                    results.append(result)
+                    if report is not None:
+                        report.record_success()
+                    continue
+
+                controller.record(latency, throttled=is_throttling_error(error))
+                if retry_policy is None or not isinstance(error, Exception):
+                    wait(in_flight)
+                    raise error
+                error_class = retries.classify_error(error)
+                if retry_policy.should_retry(error_class, attempt):
+                    delay = retry_policy.backoff_delay(attempt)
+                    retry_queue.push(item, attempt + 1, delay)
+                    report.record_retry(item, error_class, error, attempt, delay)
+                else:
+                    report.record_failure(item, error_class, error)
+
+    return results
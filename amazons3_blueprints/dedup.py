@@ -0,0 +1,318 @@
+import codecs
+import csv
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+import botocore.exceptions
+try:
+    import concurrency
+    import integrity
+    import manifest
+    import retries
+except BaseException:
+    from . import concurrency
+    from . import integrity
+    from . import manifest
+    from . import retries
+
+
+CHUNK_SIZE = 1024 * 1024
+MAX_COPY_SIZE = 5 * 1024 * 1024 * 1024
+MANIFEST_FIELDS = ['sha256', 'size', 'bucket', 'key', 'etag']
+
+RESULT_UPLOADED = 'uploaded'
+RESULT_COPIED = 'copied'
+RESULT_UNCHANGED = 'unchanged'
+
+
+def hash_file(local_path):
+    """
+    Return the SHA-256 hex digest and size of a file, read a chunk at a time.
+    hashlib releases the GIL while hashing, so files hash in parallel across threads.
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(local_path, 'rb') as local_file:
+        while True:
+            chunk = local_file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            size += len(chunk)
+    return sha256.hexdigest(), size
+
+
+class ContentIndex:
+    """
+    Content-addressed index of objects known to be in S3, keyed by SHA-256 and size,
+    together with a cache of local file hashes so that unchanged files aren't read
+    again on the next run. Stored in SQLite and shared between threads.
+
+    Writes are committed in batches of commit_size, or every commit_interval
+    seconds. Losing the last batch only means some files are hashed or uploaded again.
+    """
+
+    def __init__(self, index_path, commit_size=1000, commit_interval=2.0):
+        self.index_path = index_path
+        self.commit_size = commit_size
+        self.commit_interval = commit_interval
+        self.results = Counter()
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+
+        self._connection = sqlite3.connect(index_path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS objects ('
+            'sha256 TEXT, size INTEGER, bucket TEXT, key TEXT, etag TEXT, '
+            'PRIMARY KEY (bucket, key))')
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS objects_content ON objects (sha256, size)')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT)')
+        self._connection.commit()
+
+    def _write(self, statement, parameters):
+        with self._lock:
+            self._connection.execute(statement, parameters)
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_size or (
+                    time.monotonic() - self._last_commit >= self.commit_interval):
+                self._commit()
+
+    def _commit(self):
+        self._connection.commit()
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+
+    def file_digest(self, local_path):
+        """
+        Return the SHA-256 and size of a local file, only reading it if its size or
+        modification time changed since it was last hashed.
+        """
+        local_path = os.path.abspath(local_path)
+        stat = os.stat(local_path)
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT sha256 FROM files WHERE path = ? AND size = ? AND mtime_ns = ?',
+                (local_path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row:
+            return row[0], stat.st_size
+        digest, size = hash_file(local_path)
+        self._write(
+            'INSERT OR REPLACE INTO files (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)',
+            (local_path, size, stat.st_mtime_ns, digest))
+        return digest, size
+
+    def lookup(self, digest, size):
+        """
+        Return the (bucket, key, etag) of every object indexed with this content.
+        """
+        with self._lock:
+            return self._connection.execute(
+                'SELECT bucket, key, etag FROM objects WHERE sha256 = ? AND size = ?',
+                (digest, size)).fetchall()
+
+    def add(self, digest, size, bucket_name, key_name, etag):
+        self._write(
+            'INSERT OR REPLACE INTO objects (sha256, size, bucket, key, etag) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (digest, size, bucket_name, key_name, etag))
+
+    def remove(self, bucket_name, key_name):
+        self._write(
+            'DELETE FROM objects WHERE bucket = ? AND key = ?', (bucket_name, key_name))
+
+    @contextmanager
+    def claim(self, digest, size):
+        """
+        Hold the content exclusively, so that identical files in the same run wait for
+        the first one to be uploaded and are then copied from it.
+        """
+        while True:
+            with self._lock:
+                event = self._in_flight.get((digest, size))
+                if event is None:
+                    event = self._in_flight[(digest, size)] = threading.Event()
+                    break
+            event.wait()
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._in_flight[(digest, size)]
+            event.set()
+
+    def load_manifest(self, s3_client, manifest_url):
+        """
+        Merge the entries of an index manifest stored in S3 into the local index.
+        A manifest that doesn't exist yet is treated as empty.
+        """
+        bucket_name, key_name = manifest.split_s3_url(manifest_url)
+        try:
+            body = s3_client.get_object(Bucket=bucket_name, Key=key_name)['Body']
+        except botocore.exceptions.ClientError as e:
+            if retries.classify_error(e) == retries.ERROR_NOT_FOUND:
+                print(f'{manifest_url} does not exist yet and will be created.')
+                return
+            raise
+        rows = csv.DictReader(codecs.getreader('utf-8')(body))
+        with self._lock:
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO objects (sha256, size, bucket, key, etag) '
+                'VALUES (?, ?, ?, ?, ?)',
+                ((row['sha256'], int(row['size']), row['bucket'], row['key'], row['etag'])
+                 for row in rows))
+            self._commit()
+
+    def save_manifest(self, s3_client, manifest_url):
+        """
+        Write the whole object index to S3 as a CSV manifest other runs can load.
+        """
+        bucket_name, key_name = manifest.split_s3_url(manifest_url)
+        with tempfile.TemporaryFile('w+b') as manifest_file:
+            writer = csv.writer(codecs.getwriter('utf-8')(manifest_file))
+            writer.writerow(MANIFEST_FIELDS)
+            with self._lock:
+                writer.writerows(self._connection.execute(
+                    f'SELECT {", ".join(MANIFEST_FIELDS)} FROM objects'))
+            manifest_file.seek(0)
+            s3_client.upload_fileobj(manifest_file, bucket_name, key_name)
+        print(f'Deduplication index saved to {manifest_url}')
+
+    def record(self, result, size):
+        with self._lock:
+            self.results[result] += 1
+            if result != RESULT_UPLOADED:
+                self.bytes_saved += size
+
+    def print_summary(self):
+        print(
+            f'Deduplication: {self.results[RESULT_UPLOADED]} uploaded, '
+            f'{self.results[RESULT_COPIED]} copied from identical objects, '
+            f'{self.results[RESULT_UNCHANGED]} already up to date, '
+            f'{self.bytes_saved} bytes not sent.')
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._connection.close()
+
+
+def _copy_existing(
+        s3_client,
+        source_bucket_name,
+        source_key_name,
+        etag,
+        size,
+        bucket_name,
+        key_name,
+        extra_args,
+        checksum_algorithm=None):
+    """
+    Copy an indexed object to key_name server side, failing if it no longer has the
+    indexed ETag. Returns the new object's ETag.
+
+    The copy gets the upload's extra_args, such as ACL, encryption, metadata and tags,
+    in place of the source's, so it ends up as an upload of the file would have.
+    With a checksum_algorithm, S3 stores a checksum in it for the copy, and the copy is
+    checked against its source with integrity.verify_copy.
+    """
+    copy_args = dict(
+        extra_args, CopySourceIfMatch=f'"{etag}"', MetadataDirective='REPLACE')
+    if 'Tagging' in extra_args:
+        copy_args['TaggingDirective'] = 'REPLACE'
+    if checksum_algorithm:
+        copy_args['ChecksumAlgorithm'] = checksum_algorithm
+    copy_source = {'Bucket': source_bucket_name, 'Key': source_key_name}
+    if size <= MAX_COPY_SIZE:
+        response = s3_client.copy_object(
+            CopySource=copy_source, Bucket=bucket_name, Key=key_name, **copy_args)
+        new_etag = response['CopyObjectResult']['ETag'].strip('"')
+    else:
+        s3_client.copy(
+            copy_source,
+            bucket_name,
+            key_name,
+            ExtraArgs=copy_args,
+            Config=concurrency.transfer_config())
+        new_etag = s3_client.head_object(
+            Bucket=bucket_name, Key=key_name)['ETag'].strip('"')
+    if checksum_algorithm and (source_bucket_name, source_key_name) != (bucket_name, key_name):
+        integrity.verify_copy(
+            s3_client, source_bucket_name, source_key_name, bucket_name, key_name)
+    return new_etag
+
+
+def deduplicated_upload(
+        s3_client,
+        content_index,
+        local_path,
+        bucket_name,
+        key_name,
+        upload,
+        extra_args=None,
+        checksum_algorithm=None):
+    """
+    Put a local file at key_name without sending its bytes if S3 already has identical
+    content. The object is then copied server side from an indexed key, or left
+    alone if it is that key. Otherwise upload() is called to send the file and the
+    new object is added to the index.
+
+    Copies are made with the upload's extra_args and checksum_algorithm, as described
+    in _copy_existing. An unchanged object is copied onto itself to apply extra_args.
+
+    Indexed objects that were deleted or overwritten since are dropped from the index.
+    Returns which of RESULT_UPLOADED, RESULT_COPIED or RESULT_UNCHANGED happened.
+    """
+    extra_args = extra_args or {}
+    digest, size = content_index.file_digest(local_path)
+    with content_index.claim(digest, size):
+        # The destination itself comes first, since an unchanged object needs no copy.
+        entries = sorted(
+            content_index.lookup(digest, size),
+            key=lambda entry: entry[:2] != (bucket_name, key_name))
+        for source_bucket_name, source_key_name, etag in entries:
+            try:
+                is_destination = (
+                    source_bucket_name, source_key_name) == (bucket_name, key_name)
+                if is_destination and not extra_args:
+                    s3_client.head_object(
+                        Bucket=bucket_name, Key=key_name, IfMatch=f'"{etag}"')
+                else:
+                    new_etag = _copy_existing(
+                        s3_client,
+                        source_bucket_name,
+                        source_key_name,
+                        etag,
+                        size,
+                        bucket_name,
+                        key_name,
+                        extra_args,
+                        checksum_algorithm)
+                    content_index.add(digest, size, bucket_name, key_name, new_etag)
+                result = RESULT_UNCHANGED if is_destination else RESULT_COPIED
+                content_index.record(result, size)
+                return result
+            except botocore.exceptions.ClientError as e:
+                error_code = str(e.response.get('Error', {}).get('Code'))
+                if retries.classify_error(e) != retries.ERROR_NOT_FOUND and (
+                        error_code not in {'PreconditionFailed', '412'}):
+                    raise
+                content_index.remove(source_bucket_name, source_key_name)
+
+        upload()
+        etag = s3_client.head_object(Bucket=bucket_name, Key=key_name)['ETag'].strip('"')
+        content_index.add(digest, size, bucket_name, key_name, etag)
+        content_index.record(RESULT_UPLOADED, size)
+        return RESULT_UPLOADED
@@ -5,6 +5,24 @@ from botocore.client import Config
 import re
 import argparse
 import code
+try:
+    import catalog
+    import concurrency
+    import integrity
+    import limiter
+    import manifest
+    import profiling
+    import retries
+    import scheduler
+except BaseException:
+    from . import catalog
+    from . import concurrency
+    from . import integrity
+    from . import limiter
+    from . import manifest
+    from . import profiling
+    from . import retries
+    from . import scheduler
 
 
 def get_args():
@@ -25,7 +43,7 @@ def get_args():
     parser.add_argument(
         '--source-file-name',
         dest='source_file_name',
-        required=True)
+        required=False)
     parser.add_argument(
         '--destination-file-name',
         dest='destination_file_name',
@@ -53,7 +71,141 @@ def get_args():
         '--aws-default-region',
         dest='aws_default_region',
         required=False)
-    return parser.parse_args()
+    parser.add_argument(
+        '--max-concurrency',
+        dest='max_concurrency',
+        type=int,
+        default=32,
+        required=False)
+    parser.add_argument(
+        '--max-attempts',
+        dest='max_attempts',
+        type=int,
+        default=5,
+        required=False)
+    parser.add_argument(
+        '--failure-manifest',
+        dest='failure_manifest',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--max-bytes-per-second',
+        dest='max_bytes_per_second',
+        type=float,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--max-requests-per-second',
+        dest='max_requests_per_second',
+        type=float,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--limits-file',
+        dest='limits_file',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--profile',
+        dest='profile',
+        choices=profiling.PROFILE_MODES,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--profile-output',
+        dest='profile_output',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--min-size',
+        dest='min_size',
+        type=int,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--max-size',
+        dest='max_size',
+        type=int,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--modified-after',
+        dest='modified_after',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--modified-before',
+        dest='modified_before',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--manifest',
+        dest='manifest',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--manifest-format',
+        dest='manifest_format',
+        choices=manifest.MANIFEST_FORMATS,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--manifest-chunk-size',
+        dest='manifest_chunk_size',
+        type=int,
+        default=10000,
+        required=False)
+    parser.add_argument(
+        '--prefix-write-rate',
+        dest='prefix_write_rate',
+        type=float,
+        default=scheduler.DEFAULT_WRITE_RATE,
+        required=False)
+    parser.add_argument(
+        '--prefix-read-rate',
+        dest='prefix_read_rate',
+        type=float,
+        default=scheduler.DEFAULT_READ_RATE,
+        required=False)
+    parser.add_argument(
+        '--prefix-depth',
+        dest='prefix_depth',
+        type=int,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--verify-checksums',
+        dest='verify_checksums',
+        choices={
+            'TRUE',
+            'FALSE'},
+        default='FALSE',
+        required=False)
+    parser.add_argument(
+        '--preserve-structure',
+        dest='preserve_structure',
+        choices={
+            'TRUE',
+            'FALSE'},
+        default='FALSE',
+        required=False)
+    args = parser.parse_args()
+    if not args.source_file_name and not args.manifest:
+        parser.error('--source-file-name is required unless --manifest is provided')
+    if args.preserve_structure == 'TRUE' and args.destination_file_name:
+        parser.error('--destination-file-name cannot be used with --preserve-structure')
+    if (args.min_size, args.max_size, args.modified_after, args.modified_before) != (
+            None, None, None, None) and (
+            args.manifest or args.source_file_name_match_type != 'regex_match'):
+        parser.error(
+            '--min-size, --max-size, --modified-after and --modified-before require '
+            '--source-file-name-match-type regex_match and no --manifest')
+    for modified_time in (args.modified_after, args.modified_before):
+        try:
+            catalog.parse_time(modified_time)
+        except ValueError:
+            parser.error(f'{modified_time} is not an ISO 8601 date or time')
+    return args
 
 
 def set_environment_variables(args):
@@ -71,14 +223,24 @@ def set_environment_variables(args):
     return
 
 
-def connect_to_s3(s3_config=None):
+def connect_to_s3(s3_config=None, max_pool_connections=10):
     """
     Create a connection to the S3 service using credentials provided as environment variables.
     """
-    s3_connection = boto3.client(
-        's3',
-        config=Config(s3_config)
-    )
+    with profiling.phase('credentials'):
+        session = boto3.Session()
+        session.get_credentials()
+    with profiling.phase('connect'):
+        s3_connection = session.client(
+            's3',
+            config=Config(
+                s3_config,
+                max_pool_connections=max_pool_connections,
+                # Only checksums a request asks for, such as --verify-checksums, are sent
+                # or checked; S3-compatible stores may reject the ones boto3 adds by default.
+                request_checksum_calculation='when_required',
+                response_checksum_validation='when_required')
+        )
     return s3_connection
 
 
@@ -164,90 +326,80 @@ def determine_destination_name(
     return destination_name
 
 
-def list_s3_objects(
-        s3_connection,
-        bucket_name,
-        prefix='',
-        continuation_token=None):
-    """
-    List 1000 objects at a time, filtering by the prefix and continuing if more than 1000
-    objects were found on the previous run.
+def determine_preserved_destination_name(
+        destination_folder_name,
+        source_folder_name,
+        source_full_path):
     """
-    kwargs = {'Bucket': bucket_name, 'Prefix': prefix}
-    if continuation_token:
-        kwargs['ContinuationToken'] = continuation_token
-
-    response = s3_connection.list_objects_v2(**kwargs)
-    return response
-
-
-def find_s3_file_names(response):
+    Determine the destination name of a file that keeps the folders of its key below
+    source_folder_name, so that downloading a prefix mirrors it locally.
     """
-    Return all the objects found on S3 as a list.
+    relative_path = source_full_path
+    if source_folder_name and relative_path.startswith(f'{source_folder_name}/'):
+        relative_path = relative_path[len(source_folder_name) + 1:]
+    path_parts = [part for part in relative_path.split('/') if part not in ('', '.')]
+    if '..' in path_parts or not path_parts:
+        raise ValueError(
+            f'{source_full_path} cannot be mapped to a path inside {destination_folder_name or "the current directory"}')
+    return combine_folder_and_file_name(
+        destination_folder_name, os.path.join(*path_parts))
+
+
+class DirectoryCache:
     """
-    file_names = []
-    objects = response['Contents']
-    for obj in objects:
-        object = obj['Key']
-        file_names.append(object)
-
-    return file_names
+    Creates the local directories files are downloaded into, remembering which ones
+    exist so that each costs one makedirs call however many files land in it.
 
-
-def find_all_s3_file_names(s3_connection, bucket_name, source_folder_name=''):
-    """
-    Run the find_s3_file_names() in a loop until no more continuation tokens are found.
-    Return a list of all source_full_paths.
+    Safe to share between threads: makedirs with exist_ok tolerates another thread
+    creating the same directory first, and adding to a set is atomic.
     """
-    response = list_s3_objects(
-        s3_connection=s3_connection,
-        bucket_name=bucket_name,
-        prefix=source_folder_name)
-    file_names = find_s3_file_names(response)
-    continuation_token = response.get('NextContinuationToken')
-
-    while continuation_token:
-        response = list_s3_objects(
-            s3_connection=s3_connection,
-            bucket_name=bucket_name,
-            prefix=source_folder_name,
-            continuation_token=continuation_token)
-        file_names = file_names.append(find_s3_file_names(response))
-        continuation_token = response.get('NextContinuationToken')
-    return file_names
 
+    def __init__(self):
+        self._created = set()
 
-def find_all_file_matches(file_names, file_name_re):
-    """
-    Return a list of all file_names that matched the regular expression.
-    """
-    matching_file_names = []
-    for file in file_names:
-        if re.search(file_name_re, file):
-            matching_file_names.append(file)
-
-    return matching_file_names
+    def ensure(self, directory):
+        directory = os.path.normpath(directory) if directory else ''
+        if not directory or directory in self._created:
+            return
+        os.makedirs(directory, exist_ok=True)
+        while directory and directory not in self._created:
+            self._created.add(directory)
+            directory = os.path.dirname(directory)
 
 
 def download_s3_file(
         s3_connection,
         bucket_name,
         source_full_path,
-        destination_file_name=None):
+        destination_file_name=None,
+        verify_checksums=False):
     """
     Download a selected file from S3 to local storage in the current working directory.
+
+    With verify_checksums, the file is checked against the checksum S3 stored for it,
+    or its ETag, and an IntegrityError is raised if they don't match.
     """
     local_path = os.path.normpath(f'{os.getcwd()}/{destination_file_name}')
 
-    s3_connection.download_file(bucket_name, source_full_path, local_path)
+    if verify_checksums:
+        integrity.download_verified(
+            s3_connection, bucket_name, source_full_path, local_path)
+        print(f'{bucket_name}/{source_full_path} successfully downloaded to {local_path} and verified')
+        return
+
+    s3_connection.download_file(
+        bucket_name, source_full_path, local_path, Config=concurrency.transfer_config())
 
     print(f'{bucket_name}/{source_full_path} successfully downloaded to {local_path}')
 
     return
 
 
+@profiling.profiled
 def main():
     args = get_args()
+    if args.profile:
+        profiling.get_profiler().start(args.profile, args.profile_output)
     set_environment_variables(args)
     bucket_name = args.bucket_name
     source_file_name = args.source_file_name
@@ -257,44 +409,120 @@ def main():
     source_file_name_match_type = args.source_file_name_match_type
     s3_config = args.s3_config
     destination_folder_name = clean_folder_name(args.destination_folder_name)
+    verify_checksums = args.verify_checksums == 'TRUE'
+    preserve_structure = args.preserve_structure == 'TRUE'
+    directory_cache = DirectoryCache()
 
     if not os.path.exists(destination_folder_name) and (
             destination_folder_name != ''):
         os.makedirs(destination_folder_name)
 
-    s3_connection = connect_to_s3(s3_config)
-
-    if source_file_name_match_type == 'regex_match':
-        file_names = find_all_s3_file_names(
+    s3_connection = connect_to_s3(
+        s3_config,
+        max_pool_connections=args.max_concurrency + integrity.PART_CONCURRENCY)
+    controller = concurrency.AdaptiveConcurrencyController(
+        max_limit=args.max_concurrency)
+    retry_policy = retries.RetryPolicy(max_attempts=args.max_attempts)
+    controller.observe_client(s3_connection)
+    transfer_limiter = limiter.get_limiter()
+    transfer_limiter.set_limits(
+        args.max_bytes_per_second, args.max_requests_per_second)
+    if args.limits_file:
+        transfer_limiter.watch(args.limits_file)
+    transfer_limiter.attach(s3_connection)
+    prefix_scheduler = scheduler.PrefixScheduler(
+        write_rate=args.prefix_write_rate,
+        read_rate=args.prefix_read_rate,
+        prefix_depth=args.prefix_depth)
+
+    if args.manifest:
+        matching_file_names = profiling.timed('list', manifest.read_manifest(
+            args.manifest,
             s3_connection=s3_connection,
-            bucket_name=bucket_name,
-            source_folder_name=source_folder_name)
-        matching_file_names = find_all_file_matches(
-            file_names, re.compile(source_file_name))
-        print(f'{len(matching_file_names)} files found. Preparing to download...')
-
-        for index, key_name in enumerate(matching_file_names):
+            manifest_format=args.manifest_format))
+        num_matches = None
+        window_size = args.manifest_chunk_size
+        print(f'Reading files to download from {args.manifest}...')
+
+    elif source_file_name_match_type == 'regex_match':
+        object_filter = catalog.ObjectFilter(
+            source_file_name,
+            min_size=args.min_size,
+            max_size=args.max_size,
+            modified_after=args.modified_after,
+            modified_before=args.modified_before)
+        with profiling.phase('list'):
+            object_catalog = catalog.ObjectCatalog.from_listing(
+                s3_connection, bucket_name, source_folder_name)
+        with profiling.phase('match'):
+            matching_indexes = object_catalog.select(object_filter)
+        matching_file_names = object_catalog.keys(matching_indexes)
+        num_matches = len(matching_indexes)
+        print(f'{num_matches} files found. Preparing to download...')
+        window_size = args.manifest_chunk_size
+
+    if args.manifest or source_file_name_match_type == 'regex_match':
+        def download_match(indexed_key_name):
+            index, key_name = indexed_key_name
+            print(f'Downloading file {index}{f" of {num_matches}" if num_matches else ""}')
+            with profiling.phase('destination names'):
+                if preserve_structure:
+                    destination_name = determine_preserved_destination_name(
+                        destination_folder_name=destination_folder_name,
+                        source_folder_name=source_folder_name,
+                        source_full_path=key_name)
+                    if key_name.endswith('/'):
+                        # Folder placeholder objects only need their directory.
+                        directory_cache.ensure(destination_name)
+                        return
+                    directory_cache.ensure(os.path.dirname(destination_name))
+                else:
+                    destination_name = determine_destination_name(
+                        destination_folder_name=destination_folder_name,
+                        destination_file_name=args.destination_file_name,
+                        source_full_path=key_name,
+                        file_number=index)
+            with profiling.phase('transfer'):
+                download_s3_file(
+                    bucket_name=bucket_name,
+                    source_full_path=key_name,
+                    destination_file_name=destination_name,
+                    s3_connection=s3_connection,
+                    verify_checksums=verify_checksums)
+
+        report = retries.OperationReport(
+            key=lambda indexed_key_name: indexed_key_name[1])
+        concurrency.run_concurrently(
+            download_match,
+            prefix_scheduler.schedule(
+                enumerate(matching_file_names, 1),
+                bucket_name=bucket_name,
+                operations=('GET',),
+                key=lambda indexed_key_name: indexed_key_name[1],
+                window_size=window_size),
+            controller=controller,
+            retry_policy=retry_policy,
+            report=report)
+        report.finish(args.failure_manifest)
+    else:
+        if preserve_structure:
+            destination_name = determine_preserved_destination_name(
+                destination_folder_name=destination_folder_name,
+                source_folder_name=source_folder_name,
+                source_full_path=source_full_path)
+            directory_cache.ensure(os.path.dirname(destination_name))
+        else:
             destination_name = determine_destination_name(
                 destination_folder_name=destination_folder_name,
                 destination_file_name=args.destination_file_name,
-                source_full_path=key_name,
-                file_number=index + 1)
-            print(f'Downloading file {index+1} of {len(matching_file_names)}')
+                source_full_path=source_full_path)
+        with profiling.phase('transfer'):
             download_s3_file(
                 bucket_name=bucket_name,
-                source_full_path=key_name,
+                source_full_path=source_full_path,
                 destination_file_name=destination_name,
-                s3_connection=s3_connection)
-    else:
-        destination_name = determine_destination_name(
-            destination_folder_name=destination_folder_name,
-            destination_file_name=args.destination_file_name,
-            source_full_path=source_full_path)
-        download_s3_file(
-            bucket_name=bucket_name,
-            source_full_path=source_full_path,
-            destination_file_name=destination_name,
-            s3_connection=s3_connection)
+                s3_connection=s3_connection,
+                verify_checksums=verify_checksums)
 
 
 if __name__ == '__main__':
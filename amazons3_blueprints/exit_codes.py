@@ -1,3 +1,5 @@
 EXIT_CODE_FILE_NOT_FOUND = 201
 EXIT_CODE_INVALID_CREDENTIALS = 202
-EXIT_CODE_INVALID_REGEX = 203
\ No newline at end of file
+EXIT_CODE_INVALID_REGEX = 203
+EXIT_CODE_RETRIES_EXHAUSTED = 204
+EXIT_CODE_UNKNOWN_ERROR = 249
\ No newline at end of file
@@ -0,0 +1,747 @@
+import base64
+import hashlib
+import os
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import botocore.exceptions
+
+
+CHECKSUM_ALGORITHMS = ['CRC32', 'CRC32C', 'CRC64NVME', 'SHA1', 'SHA256']
+# Used for copies whose source has no checksum; needs no extra package.
+DEFAULT_CHECKSUM_ALGORITHM = 'CRC32'
+
+MEGABYTE = 1024 * 1024
+MULTIPART_THRESHOLD = 8 * MEGABYTE
+PART_SIZE = 8 * MEGABYTE
+MAX_PARTS = 10000
+MAX_COPY_SIZE = 5 * 1024 * MEGABYTE
+CHUNK_SIZE = MEGABYTE
+
+# Parts of all objects are transferred on one shared pool, so per-part memory stays
+# bounded by PART_CONCURRENCY * PART_SIZE however many files are in flight.
+PART_CONCURRENCY = 8
+
+HASH_ALGORITHMS = {'SHA1': 'sha1', 'SHA256': 'sha256', 'MD5': 'md5'}
+# Reflected polynomial and width of each CRC, used to combine per-part CRCs.
+CRC_POLYNOMIALS = {
+    'CRC32': (0xEDB88320, 32),
+    'CRC32C': (0x82F63B78, 32),
+    'CRC64NVME': (0x9A6C9329AC4BC9B5, 64),
+}
+CRC_PACKAGES = {'CRC32C': 'crc32c or awscrt', 'CRC64NVME': 'awscrt'}
+ENCRYPTED_ETAG_ALGORITHMS = {'aws:kms', 'aws:kms:dsse'}
+# Error codes S3-compatible servers return for APIs they don't implement.
+UNSUPPORTED_ERROR_CODES = {'NotImplemented', 'MethodNotAllowed', '501', '405'}
+
+_part_executor = None
+_part_executor_lock = threading.Lock()
+
+
+class IntegrityError(Exception):
+    """
+    Raised when the data transferred doesn't match the checksum S3 has for it.
+    """
+
+
+def _crc_function(algorithm):
+    """
+    Return a function(data, crc) -> crc for a CRC algorithm, or None if the package it
+    needs isn't installed. zlib, crc32c and awscrt all release the GIL while hashing.
+    """
+    if algorithm == 'CRC32':
+        return zlib.crc32
+    if algorithm == 'CRC32C':
+        try:
+            import crc32c
+            return crc32c.crc32c
+        except ImportError:
+            pass
+    try:
+        from awscrt import checksums
+    except ImportError:
+        return None
+    return getattr(checksums, algorithm.lower(), None)
+
+
+def algorithm_available(algorithm):
+    return algorithm in HASH_ALGORITHMS or _crc_function(algorithm) is not None
+
+
+def missing_package_message(algorithm):
+    return f'{algorithm} checksums need the {CRC_PACKAGES.get(algorithm)} package installed.'
+
+
+class Checksum:
+    """
+    Running checksum in one of the algorithms S3 supports, or MD5 for checking ETags.
+    """
+
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        self.size = 0
+        self.crc = 0
+        self._hash = None
+        if algorithm in HASH_ALGORITHMS:
+            self._hash = hashlib.new(HASH_ALGORITHMS[algorithm])
+        else:
+            self._update_crc = _crc_function(algorithm)
+            if self._update_crc is None:
+                raise ValueError(missing_package_message(algorithm))
+
+    def update(self, data):
+        self.size += len(data)
+        if self._hash is not None:
+            self._hash.update(data)
+        else:
+            self.crc = self._update_crc(data, self.crc)
+
+    def digest(self):
+        if self._hash is not None:
+            return self._hash.digest()
+        return self.crc.to_bytes(CRC_POLYNOMIALS[self.algorithm][1] // 8, 'big')
+
+    def encoded(self):
+        """
+        Return the checksum the way S3 reports it: hex for ETags, base64 otherwise.
+        """
+        if self.algorithm == 'MD5':
+            return self.digest().hex()
+        return base64.b64encode(self.digest()).decode()
+
+
+def composite_checksum(checksums):
+    """
+    Return the checksum of the concatenated digests of each part, which is how S3
+    builds COMPOSITE checksums and multipart ETags.
+    """
+    combined = Checksum(checksums[0].algorithm)
+    for checksum in checksums:
+        combined.update(checksum.digest())
+    return combined.encoded()
+
+
+def _gf2_matrix_times(matrix, vector):
+    total = 0
+    row = 0
+    while vector:
+        if vector & 1:
+            total ^= matrix[row]
+        vector >>= 1
+        row += 1
+    return total
+
+
+def _gf2_matrix_square(matrix):
+    return [_gf2_matrix_times(matrix, row) for row in matrix]
+
+
+def crc_combine(algorithm, crc1, crc2, length2):
+    """
+    Return the CRC of two concatenated blocks from the CRC of each and the length of
+    the second, without their data. This is zlib's crc32_combine() for any polynomial.
+    """
+    polynomial, width = CRC_POLYNOMIALS[algorithm]
+    if length2 == 0:
+        return crc1
+    odd = [polynomial] + [1 << bit for bit in range(width - 1)]
+    even = _gf2_matrix_square(odd)
+    odd = _gf2_matrix_square(even)
+    while True:
+        even = _gf2_matrix_square(odd)
+        if length2 & 1:
+            crc1 = _gf2_matrix_times(even, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+        odd = _gf2_matrix_square(even)
+        if length2 & 1:
+            crc1 = _gf2_matrix_times(odd, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+    return crc1 ^ crc2
+
+
+def full_object_checksum(checksums):
+    """
+    Return the CRC of a whole object from the CRCs of its parts, which is how S3 builds
+    FULL_OBJECT checksums of multipart objects.
+    """
+    combined = Checksum(checksums[0].algorithm)
+    for checksum in checksums:
+        combined.crc = crc_combine(
+            combined.algorithm, combined.crc, checksum.crc, checksum.size)
+    return combined.encoded()
+
+
+def strip_part_count(value):
+    """
+    Remove the '-<parts>' suffix S3 adds to multipart ETags and composite checksums.
+    """
+    return value.strip('"').split('-')[0] if value else value
+
+
+def part_executor():
+    global _part_executor
+    with _part_executor_lock:
+        if _part_executor is None:
+            _part_executor = ThreadPoolExecutor(
+                max_workers=PART_CONCURRENCY, thread_name_prefix='part')
+        return _part_executor
+
+
+def _map_parts(function, items):
+    """
+    Call function on every item on the shared part pool and return the results in order.
+    A single item is handled on the calling thread.
+    """
+    items = list(items)
+    if len(items) <= 1:
+        return [function(item) for item in items]
+    futures = [part_executor().submit(function, item) for item in items]
+    try:
+        return [future.result() for future in futures]
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+
+def _byte_ranges(part_sizes):
+    ranges = []
+    start = 0
+    for part_size in part_sizes:
+        ranges.append((start, start + part_size - 1))
+        start += part_size
+    return ranges
+
+
+class ObjectChecksum:
+    """
+    What S3 knows about an object's contents: its size, ETag, part count and, if it
+    was stored with one, its checksum.
+    """
+
+    def __init__(
+            self,
+            size,
+            etag,
+            parts_count=1,
+            algorithm=None,
+            checksum=None,
+            checksum_type=None,
+            part_sizes=None,
+            part_checksums=None):
+        self.size = size
+        self.etag = etag
+        self.parts_count = parts_count
+        self.algorithm = algorithm
+        self.checksum = checksum
+        self.checksum_type = checksum_type
+        self.part_sizes = part_sizes
+        self.part_checksums = part_checksums
+
+    @property
+    def is_full_object(self):
+        return self.parts_count == 1 or self.checksum_type == 'FULL_OBJECT'
+
+    def comparable_to(self, other):
+        """
+        Return whether both objects have checksums that match if their contents do.
+        """
+        return (
+            self.checksum is not None and other.checksum is not None
+            and self.algorithm == other.algorithm
+            and self.is_full_object == other.is_full_object
+            and (self.is_full_object or self.parts_count == other.parts_count))
+
+    def byte_ranges(self, s3_client, bucket_name, key_name):
+        """
+        Return the inclusive byte range of every part, looking up part sizes with a
+        HEAD per part if S3 didn't list them.
+        """
+        if self.size == 0:
+            return []
+        if self.parts_count == 1:
+            return [(0, self.size - 1)]
+        if self.part_sizes is None:
+            self.part_sizes = _map_parts(
+                lambda part_number: s3_client.head_object(
+                    Bucket=bucket_name,
+                    Key=key_name,
+                    PartNumber=part_number)['ContentLength'],
+                range(1, self.parts_count + 1))
+        return _byte_ranges(self.part_sizes)
+
+
+def _find_checksum(response):
+    for algorithm in CHECKSUM_ALGORITHMS:
+        if response.get(f'Checksum{algorithm}'):
+            return algorithm, strip_part_count(response[f'Checksum{algorithm}'])
+    return None, None
+
+
+def etag_parts_count(etag):
+    """
+    Return the part count in a multipart ETag, or 1 for any other ETag.
+    """
+    etag = etag.strip('"')
+    return int(etag.split('-')[1]) if '-' in etag else 1
+
+
+def get_object_checksum(s3_client, bucket_name, key_name):
+    """
+    Return the ObjectChecksum of an object, using GetObjectAttributes so that part
+    sizes and checksums come back in one request. Falls back to a HEAD request on
+    S3-compatible servers that don't implement it.
+    """
+    try:
+        attributes = s3_client.get_object_attributes(
+            Bucket=bucket_name,
+            Key=key_name,
+            ObjectAttributes=['ETag', 'Checksum', 'ObjectParts', 'ObjectSize'],
+            MaxParts=1000)
+    except botocore.exceptions.ClientError as e:
+        if str(e.response.get('Error', {}).get('Code')) not in UNSUPPORTED_ERROR_CODES:
+            raise
+        response = s3_client.head_object(
+            Bucket=bucket_name, Key=key_name, ChecksumMode='ENABLED')
+        etag = response['ETag'].strip('"')
+        algorithm, checksum = _find_checksum(response)
+        return ObjectChecksum(
+            size=response['ContentLength'],
+            etag=etag,
+            parts_count=etag_parts_count(etag),
+            algorithm=algorithm,
+            checksum=checksum,
+            checksum_type=response.get('ChecksumType'))
+
+    etag = attributes['ETag'].strip('"')
+    algorithm, checksum = _find_checksum(attributes.get('Checksum', {}))
+    object_parts = attributes.get('ObjectParts', {})
+    parts = list(object_parts.get('Parts', []))
+    while object_parts.get('IsTruncated'):
+        object_parts = s3_client.get_object_attributes(
+            Bucket=bucket_name,
+            Key=key_name,
+            ObjectAttributes=['ObjectParts'],
+            MaxParts=1000,
+            PartNumberMarker=object_parts['NextPartNumberMarker'])['ObjectParts']
+        parts.extend(object_parts.get('Parts', []))
+    parts_count = object_parts.get('TotalPartsCount') or etag_parts_count(etag)
+
+    part_sizes = part_checksums = None
+    if parts_count > 1 and len(parts) == parts_count:
+        part_sizes = [part['Size'] for part in parts]
+        if algorithm and all(part.get(f'Checksum{algorithm}') for part in parts):
+            part_checksums = [part[f'Checksum{algorithm}'] for part in parts]
+    return ObjectChecksum(
+        size=attributes['ObjectSize'],
+        etag=etag,
+        parts_count=parts_count,
+        algorithm=algorithm,
+        checksum=checksum,
+        checksum_type=attributes.get('Checksum', {}).get('ChecksumType'),
+        part_sizes=part_sizes,
+        part_checksums=part_checksums)
+
+
+def etag_is_encrypted(response):
+    """
+    Return whether a GET or HEAD response is for an object encrypted with SSE-KMS or
+    SSE-C, whose ETag isn't an MD5 of its contents.
+    """
+    return bool(
+        response.get('ServerSideEncryption') in ENCRYPTED_ETAG_ALGORITHMS
+        or response.get('SSECustomerAlgorithm'))
+
+
+def _hash_range(s3_client, bucket_name, key_name, etag, byte_range, algorithm):
+    """
+    Read one byte range of an object and return its Checksum in algorithm.
+    """
+    start, end = byte_range
+    checksum = Checksum(algorithm)
+    body = s3_client.get_object(
+        Bucket=bucket_name,
+        Key=key_name,
+        Range=f'bytes={start}-{end}',
+        IfMatch=f'"{etag}"')['Body']
+    for chunk in body.iter_chunks(CHUNK_SIZE):
+        checksum.update(chunk)
+    if checksum.size != end - start + 1:
+        raise IntegrityError(
+            f'{bucket_name}/{key_name}: expected {end - start + 1} bytes from '
+            f'{start} but received {checksum.size}')
+    return checksum
+
+
+def read_checksum(s3_client, bucket_name, key_name, expected, algorithm):
+    """
+    Read a whole object and return its full object checksum in algorithm, which must
+    be a CRC so that ranges read in parallel on the part pool can be combined.
+    expected is the object's ObjectChecksum; reads fail if its ETag changes.
+    """
+    if expected.checksum is not None and expected.algorithm == algorithm and (
+            expected.is_full_object):
+        return expected.checksum
+    part_size = max(PART_SIZE, -(-expected.size // MAX_PARTS))
+    byte_ranges = _byte_ranges(
+        [min(part_size, expected.size - start)
+         for start in range(0, expected.size, part_size)])
+    checksums = _map_parts(
+        lambda byte_range: _hash_range(
+            s3_client, bucket_name, key_name, expected.etag, byte_range, algorithm),
+        byte_ranges)
+    return full_object_checksum(checksums or [Checksum(algorithm)])
+
+
+def _download_range(
+        s3_client,
+        bucket_name,
+        key_name,
+        etag,
+        local_path,
+        byte_range,
+        algorithm):
+    """
+    Download one byte range into its place in local_path, hashing it on the way.
+    """
+    start, end = byte_range
+    checksum = Checksum(algorithm)
+    response = s3_client.get_object(
+        Bucket=bucket_name,
+        Key=key_name,
+        Range=f'bytes={start}-{end}',
+        IfMatch=f'"{etag}"')
+    with open(local_path, 'r+b') as local_file:
+        local_file.seek(start)
+        for chunk in response['Body'].iter_chunks(CHUNK_SIZE):
+            checksum.update(chunk)
+            local_file.write(chunk)
+    if checksum.size != end - start + 1:
+        raise IntegrityError(
+            f'{bucket_name}/{key_name}: expected {end - start + 1} bytes from '
+            f'{start} but received {checksum.size}')
+    return checksum, etag_is_encrypted(response)
+
+
+def download_verified(s3_client, bucket_name, key_name, local_path):
+    """
+    Download an object and check it against the checksum S3 stored for it, or its
+    ETag if it has none. Multipart objects are fetched with one ranged GET per part on
+    the shared part pool, each part hashed as it is written. The file is only moved to
+    local_path once it has been verified.
+    """
+    expected = get_object_checksum(s3_client, bucket_name, key_name)
+    algorithm = expected.algorithm
+    if expected.checksum is None or not algorithm_available(algorithm):
+        algorithm = 'MD5'
+    byte_ranges = expected.byte_ranges(s3_client, bucket_name, key_name)
+
+    folder_name, file_name = os.path.split(local_path)
+    descriptor, temporary_path = tempfile.mkstemp(
+        dir=folder_name or None, prefix=f'.{file_name}.')
+    try:
+        with os.fdopen(descriptor, 'wb') as local_file:
+            local_file.truncate(expected.size)
+        results = _map_parts(
+            lambda byte_range: _download_range(
+                s3_client,
+                bucket_name,
+                key_name,
+                expected.etag,
+                temporary_path,
+                byte_range,
+                algorithm),
+            byte_ranges)
+        checksums = [checksum for checksum, _ in results]
+        if not checksums:
+            checksums = [Checksum(algorithm)]
+
+        description = f'{bucket_name}/{key_name}'
+        if algorithm == 'MD5':
+            if any(encrypted for _, encrypted in results):
+                print(
+                    f'Warning: {description} has no checksum and its ETag is not an MD5 '
+                    'of its contents, so only its size was verified.')
+            else:
+                _compare(description, 'ETag', expected.etag, composite_checksum(checksums)
+                         if expected.parts_count > 1 else checksums[0].encoded())
+        else:
+            if expected.part_checksums:
+                for part_number, (checksum, part_checksum) in enumerate(
+                        zip(checksums, expected.part_checksums), 1):
+                    _compare(f'{description} part {part_number}', algorithm,
+                             part_checksum, checksum.encoded())
+            if len(checksums) == 1:
+                actual = checksums[0].encoded()
+            elif expected.is_full_object:
+                actual = full_object_checksum(checksums)
+            else:
+                actual = composite_checksum(checksums)
+            _compare(description, algorithm, expected.checksum, actual)
+        os.replace(temporary_path, local_path)
+    except BaseException:
+        try:
+            os.remove(temporary_path)
+        except OSError:
+            pass
+        raise
+
+
+def _compare(description, algorithm, expected, actual):
+    if expected != actual:
+        raise IntegrityError(
+            f'{description}: {algorithm} mismatch, expected {expected} but got {actual}')
+
+
+def _upload_part(
+        s3_client,
+        local_path,
+        bucket_name,
+        key_name,
+        upload_id,
+        part_number,
+        byte_range,
+        algorithm):
+    start, end = byte_range
+    with open(local_path, 'rb') as local_file:
+        local_file.seek(start)
+        data = local_file.read(end - start + 1)
+    checksum = Checksum(algorithm)
+    checksum.update(data)
+    response = s3_client.upload_part(
+        Bucket=bucket_name,
+        Key=key_name,
+        UploadId=upload_id,
+        PartNumber=part_number,
+        Body=data,
+        **{f'Checksum{algorithm}': checksum.encoded()})
+    return checksum, {
+        'ETag': response['ETag'],
+        'PartNumber': part_number,
+        f'Checksum{algorithm}': checksum.encoded()}
+
+
+def upload_verified(
+        s3_client,
+        local_path,
+        bucket_name,
+        key_name,
+        algorithm,
+        extra_args=None):
+    """
+    Upload a file with a checksum in algorithm sent for every request, so S3 rejects any
+    part that arrives corrupted, then check the checksum S3 stored for the whole object
+    against the one computed locally. Each part is read from disk once, and parts are
+    uploaded on the shared part pool.
+    """
+    extra_args = extra_args or {}
+    size = os.path.getsize(local_path)
+    if size <= MULTIPART_THRESHOLD:
+        with open(local_path, 'rb') as local_file:
+            data = local_file.read()
+        checksum = Checksum(algorithm)
+        checksum.update(data)
+        expected = checksum.encoded()
+        response = s3_client.put_object(
+            Bucket=bucket_name,
+            Key=key_name,
+            Body=data,
+            **{f'Checksum{algorithm}': expected},
+            **extra_args)
+    else:
+        part_size = max(PART_SIZE, -(-size // MAX_PARTS))
+        byte_ranges = _byte_ranges(
+            [min(part_size, size - start) for start in range(0, size, part_size)])
+        # CRC64NVME only supports full object checksums on multipart uploads.
+        full_object = algorithm == 'CRC64NVME'
+        checksum_type = {'ChecksumType': 'FULL_OBJECT'} if full_object else {}
+        upload_id = s3_client.create_multipart_upload(
+            Bucket=bucket_name,
+            Key=key_name,
+            ChecksumAlgorithm=algorithm,
+            **checksum_type,
+            **extra_args)['UploadId']
+        try:
+            results = _map_parts(
+                lambda numbered_range: _upload_part(
+                    s3_client,
+                    local_path,
+                    bucket_name,
+                    key_name,
+                    upload_id,
+                    numbered_range[0],
+                    numbered_range[1],
+                    algorithm),
+                enumerate(byte_ranges, 1))
+            checksums = [checksum for checksum, _ in results]
+            if full_object:
+                expected = full_object_checksum(checksums)
+                checksum_type[f'Checksum{algorithm}'] = expected
+            else:
+                expected = composite_checksum(checksums)
+            response = s3_client.complete_multipart_upload(
+                Bucket=bucket_name,
+                Key=key_name,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': [part for _, part in results]},
+                **checksum_type)
+        except BaseException:
+            s3_client.abort_multipart_upload(
+                Bucket=bucket_name, Key=key_name, UploadId=upload_id)
+            raise
+
+    stored = strip_part_count(response.get(f'Checksum{algorithm}'))
+    if stored is None:
+        stored = get_object_checksum(s3_client, bucket_name, key_name).checksum
+    if stored is not None:
+        _compare(f'{bucket_name}/{key_name}', algorithm, expected, stored)
+
+
+# Object properties a multipart copy has to carry over itself.
+COPIED_PROPERTIES = [
+    'CacheControl',
+    'ContentDisposition',
+    'ContentEncoding',
+    'ContentLanguage',
+    'ContentType',
+    'Metadata']
+
+
+def copy_with_checksum(
+        s3_client,
+        source_bucket_name,
+        source_key_name,
+        destination_bucket_name,
+        destination_key_name):
+    """
+    Copy an object server side so that S3 computes the destination's checksum in the
+    same algorithm as the source's, or DEFAULT_CHECKSUM_ALGORITHM if it has none.
+
+    Multipart objects are copied along the source's own part boundaries, so composite
+    checksums and multipart ETags of the two objects can be compared afterwards.
+    """
+    source = get_object_checksum(s3_client, source_bucket_name, source_key_name)
+    algorithm = source.algorithm or DEFAULT_CHECKSUM_ALGORITHM
+    copy_source = {'Bucket': source_bucket_name, 'Key': source_key_name}
+    if source.parts_count == 1 and source.size <= MAX_COPY_SIZE:
+        s3_client.copy_object(
+            CopySource=copy_source,
+            Bucket=destination_bucket_name,
+            Key=destination_key_name,
+            ChecksumAlgorithm=algorithm,
+            CopySourceIfMatch=f'"{source.etag}"')
+        return
+
+    head = s3_client.head_object(
+        Bucket=source_bucket_name, Key=source_key_name, IfMatch=f'"{source.etag}"')
+    properties = {name: head[name] for name in COPIED_PROPERTIES if head.get(name)}
+    checksum_type = {}
+    if source.checksum_type == 'FULL_OBJECT' and source.checksum is not None:
+        checksum_type = {'ChecksumType': 'FULL_OBJECT'}
+    upload_id = s3_client.create_multipart_upload(
+        Bucket=destination_bucket_name,
+        Key=destination_key_name,
+        ChecksumAlgorithm=algorithm,
+        **checksum_type,
+        **properties)['UploadId']
+
+    def copy_part(numbered_range):
+        part_number, (start, end) = numbered_range
+        result = s3_client.upload_part_copy(
+            CopySource=copy_source,
+            Bucket=destination_bucket_name,
+            Key=destination_key_name,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            CopySourceRange=f'bytes={start}-{end}',
+            CopySourceIfMatch=f'"{source.etag}"')['CopyPartResult']
+        part = {'ETag': result['ETag'], 'PartNumber': part_number}
+        if result.get(f'Checksum{algorithm}'):
+            part[f'Checksum{algorithm}'] = result[f'Checksum{algorithm}']
+        return part
+
+    try:
+        parts = _map_parts(copy_part, enumerate(
+            source.byte_ranges(s3_client, source_bucket_name, source_key_name), 1))
+        if checksum_type:
+            # S3 rejects the completed object if it doesn't match the source's checksum.
+            checksum_type[f'Checksum{algorithm}'] = source.checksum
+        s3_client.complete_multipart_upload(
+            Bucket=destination_bucket_name,
+            Key=destination_key_name,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': parts},
+            **checksum_type)
+    except BaseException:
+        s3_client.abort_multipart_upload(
+            Bucket=destination_bucket_name,
+            Key=destination_key_name,
+            UploadId=upload_id)
+        raise
+
+
+def verify_copy(
+        s3_client,
+        source_bucket_name,
+        source_key_name,
+        destination_bucket_name,
+        destination_key_name,
+        destination_client=None,
+        contents_verified=False):
+    """
+    Check that a copy matches its source. Checksums are compared when both objects
+    have one that can be compared, otherwise ETags if both have the same parts and
+    neither is encrypted with SSE-KMS or SSE-C. Failing both, the objects are read to
+    compare a CRC of their contents. Raises IntegrityError if they differ.
+
+    destination_client is used for the destination if it lives on another connection.
+    With contents_verified, the copy was already checked against the source while it
+    was made, so only sizes and comparable checksums are checked.
+    """
+    destination_client = destination_client or s3_client
+    locations = [
+        (s3_client, source_bucket_name, source_key_name),
+        (destination_client, destination_bucket_name, destination_key_name)]
+    source, destination = _map_parts(
+        lambda location: get_object_checksum(*location), locations)
+    description = f'{destination_bucket_name}/{destination_key_name}'
+    if source.size != destination.size:
+        raise IntegrityError(
+            f'{description}: expected {source.size} bytes but found {destination.size}')
+    if source.comparable_to(destination):
+        _compare(description, source.algorithm, source.checksum, destination.checksum)
+        return
+    if contents_verified or source.etag == destination.etag:
+        return
+    encrypted = _map_parts(
+        lambda location: etag_is_encrypted(
+            location[0].head_object(Bucket=location[1], Key=location[2])),
+        locations)
+    if source.parts_count == destination.parts_count and not any(encrypted):
+        raise IntegrityError(
+            f'{description}: ETag mismatch, expected {source.etag} '
+            f'but got {destination.etag}')
+
+    # Neither checksums nor ETags can be compared, so read the objects. A full object
+    # CRC S3 already stored for one side is used so that only the other is read.
+    algorithm = next(
+        (checksum.algorithm for checksum in [destination, source]
+         if checksum.checksum is not None and checksum.is_full_object
+         and checksum.algorithm in CRC_POLYNOMIALS
+         and algorithm_available(checksum.algorithm)),
+        DEFAULT_CHECKSUM_ALGORITHM)
+    _compare(
+        description,
+        algorithm,
+        read_checksum(s3_client, source_bucket_name, source_key_name, source, algorithm),
+        read_checksum(
+            destination_client,
+            destination_bucket_name,
+            destination_key_name,
+            destination,
+            algorithm))
@@ -0,0 +1,179 @@
+import json
+import sqlite3
+import sys
+import threading
+import time
+from itertools import islice
+try:
+    import exit_codes as ec
+except BaseException:
+    from . import exit_codes as ec
+
+
+STATE_LISTED = 'listed'
+STATE_COPIED = 'copied'
+STATE_VERIFIED = 'verified'
+STATE_DELETED = 'deleted'
+
+
+class JobJournal:
+    """
+    Durable record of every key in a bulk job and how far along it is, stored in SQLite
+    so that an interrupted job can resume without listing again.
+
+    State changes are buffered in memory and written in batches of flush_size, or every
+    flush_interval seconds, whichever comes first. Losing the last batch to a crash only
+    means those keys are re-checked on resume; every step is safe to repeat.
+    """
+
+    def __init__(self, journal_path, flush_size=1000, flush_interval=2.0):
+        self.journal_path = journal_path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending_states = {}
+        self._last_flush = time.monotonic()
+
+        self._connection = sqlite3.connect(
+            journal_path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS job (name TEXT PRIMARY KEY, value TEXT)')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS objects ('
+            'key TEXT PRIMARY KEY, item_index INTEGER, state TEXT)')
+        # Indexes repeat across resumed listings, so rows are ordered and paged by both.
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS objects_item_index_key ON objects (item_index, key)')
+        self._connection.commit()
+
+    def get(self, name, default=None):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT value FROM job WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, name, value):
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO job (name, value) VALUES (?, ?)',
+                (name, json.dumps(value)))
+            self._connection.commit()
+
+    @property
+    def listing_complete(self):
+        return self.get('listing_complete', False)
+
+    def check_job(self, job_description):
+        """
+        Store the arguments the job was started with, or exit if the journal belongs to
+        a job that was started with different ones.
+        """
+        existing_description = self.get('job')
+        if existing_description is None:
+            self.set('job', job_description)
+        elif existing_description != job_description:
+            print(
+                f'Error: The journal {self.journal_path} belongs to a different job '
+                f'({existing_description}). Remove it or choose another journal.')
+            sys.exit(ec.EXIT_CODE_UNKNOWN_ERROR)
+
+    def track(self, indexed_keys, num_matches=None):
+        """
+        Record every (index, key) pair as listed while passing it through, skipping keys a
+        previous, partially listed run already finished. Marks the listing as complete
+        once indexed_keys is exhausted.
+        """
+        with self._lock:
+            is_new_job = self._connection.execute(
+                'SELECT 1 FROM objects LIMIT 1').fetchone() is None
+
+        indexed_keys = iter(indexed_keys)
+        while True:
+            batch = list(islice(indexed_keys, self.flush_size))
+            if not batch:
+                break
+            if not is_new_job:
+                batch = [(index, key_name) for index, key_name in batch
+                         if self.state(key_name) != STATE_DELETED]
+            # Write keys before handing them out so state updates always find their row.
+            self._insert_listed(
+                [(key_name, index, STATE_LISTED) for index, key_name in batch])
+            yield from batch
+        self.set('num_matches', num_matches)
+        self.set('listing_complete', True)
+
+    def _insert_listed(self, rows):
+        with self._lock:
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO objects (key, item_index, state) '
+                'VALUES (?, ?, ?)', rows)
+            self._connection.commit()
+
+    def pending(self, page_size=1000):
+        """
+        Yield (index, key) for every key that hasn't been deleted yet, in listing order,
+        reading the journal a page at a time.
+        """
+        last_row = (-1, '')
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    'SELECT item_index, key FROM objects '
+                    'WHERE (item_index, key) > (?, ?) AND state != ? '
+                    'ORDER BY item_index, key LIMIT ?',
+                    (*last_row, STATE_DELETED, page_size)).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_row = rows[-1]
+
+    def state(self, key_name):
+        """
+        Return the latest known state of a key, including changes not yet flushed.
+        """
+        with self._lock:
+            state = self._pending_states.get(key_name)
+            if state is not None:
+                return state
+            row = self._connection.execute(
+                'SELECT state FROM objects WHERE key = ?', (key_name,)).fetchone()
+        return row[0] if row else STATE_LISTED
+
+    def record(self, key_name, state):
+        """
+        Buffer a state change for a key, flushing the buffer if it is due.
+        """
+        with self._lock:
+            self._pending_states[key_name] = state
+            if len(self._pending_states) >= self.flush_size or (
+                    time.monotonic() - self._last_flush >= self.flush_interval):
+                self._flush()
+
+    def _flush(self):
+        self._connection.executemany(
+            'UPDATE objects SET state = ? WHERE key = ?',
+            [(state, key_name)
+             for key_name, state in self._pending_states.items()])
+        self._connection.commit()
+        self._pending_states = {}
+        self._last_flush = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def counts(self):
+        """
+        Return how many keys are in each state.
+        """
+        self.flush()
+        with self._lock:
+            return dict(self._connection.execute(
+                'SELECT state, COUNT(*) FROM objects GROUP BY state').fetchall())
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,145 @@
+import json
+import os
+import threading
+import time
+try:
+    import scheduler
+except BaseException:
+    from . import scheduler
+
+
+# How often, in seconds, a limits file is checked for changes.
+LIMITS_FILE_CHECK_INTERVAL = 1.0
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+class TransferLimiter:
+    """
+    Process-wide caps on the bytes per second and requests per second sent to and
+    received from S3, shared by every client attached to it.
+
+    Both caps are TokenBuckets, so concurrent files are served in the order they asked
+    and each request or chunk costs one short lock acquisition. Request bodies are
+    paid for in full before they are sent, response bodies as each chunk is read.
+    Server side copies and deletes only cost a request.
+
+    Limits can be changed while transfers are running with set_limits(), or by
+    editing the JSON limits file passed to watch().
+    """
+
+    def __init__(self, bytes_per_second=None, requests_per_second=None):
+        self.bytes = scheduler.TokenBucket(bytes_per_second)
+        self.requests = scheduler.TokenBucket(requests_per_second)
+        self._limits_path = None
+        self._limits_mtime = None
+        self._next_check = 0.0
+        self._check_lock = threading.Lock()
+
+    def set_limits(self, bytes_per_second=None, requests_per_second=None):
+        if (bytes_per_second, requests_per_second) == (
+                self.bytes.rate, self.requests.rate):
+            return
+        self.bytes.set_rate(bytes_per_second)
+        self.requests.set_rate(requests_per_second)
+        print(
+            f'Transfer limits: {bytes_per_second or "unlimited"} bytes/s, '
+            f'{requests_per_second or "unlimited"} requests/s')
+
+    def watch(self, limits_path):
+        """
+        Take limits from a JSON file like {"bytes_per_second": 10485760,
+        "requests_per_second": 100}, re-reading it whenever it changes.
+        """
+        self._limits_path = limits_path
+        self._reload_limits()
+
+    def _reload_limits(self):
+        try:
+            mtime = os.path.getmtime(self._limits_path)
+        except OSError:
+            return
+        if mtime == self._limits_mtime:
+            return
+        self._limits_mtime = mtime
+        try:
+            with open(self._limits_path) as limits_file:
+                limits = json.load(limits_file)
+        except (OSError, ValueError) as e:
+            print(f'Warning: could not read limits from {self._limits_path}: {e}')
+            return
+        self.set_limits(
+            limits.get('bytes_per_second'), limits.get('requests_per_second'))
+
+    def _check_limits_file(self):
+        now = time.monotonic()
+        if self._limits_path is None or now < self._next_check:
+            return
+        if not self._check_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = now + LIMITS_FILE_CHECK_INTERVAL
+            self._reload_limits()
+        finally:
+            self._check_lock.release()
+
+    def attach(self, s3_client):
+        """
+        Make every request s3_client sends, including retries, wait for the limits.
+        """
+        s3_client.meta.events.register('before-send.s3', self._before_send)
+        s3_client.meta.events.register('after-call.s3', self._after_call)
+        return s3_client
+
+    def _before_send(self, request, **kwargs):
+        self._check_limits_file()
+        self.requests.acquire()
+        body_size = _body_size(request)
+        if body_size:
+            self.bytes.acquire(body_size)
+        return None
+
+    def _after_call(self, parsed, **kwargs):
+        body = parsed.get('Body') if isinstance(parsed, dict) else None
+        if body is not None and hasattr(body, 'read'):
+            self.limit_stream(body)
+
+    def limit_stream(self, stream):
+        """
+        Make each read from stream wait for the bytes it returned.
+        """
+        read = stream.read
+        bytes_bucket = self.bytes
+
+        def limited_read(*args, **kwargs):
+            data = read(*args, **kwargs)
+            if data:
+                bytes_bucket.acquire(len(data))
+            return data
+
+        # An instance attribute, so iter_chunks() and iteration pay for their reads too.
+        stream.read = limited_read
+        return stream
+
+
+def _body_size(request):
+    # Bodies sent with aws-chunked encoding carry their real size in a separate header.
+    size = request.headers.get('X-Amz-Decoded-Content-Length') or request.headers.get(
+        'Content-Length')
+    if size is not None:
+        return int(size)
+    if isinstance(request.body, (bytes, bytearray)):
+        return len(request.body)
+    return 0
+
+
+def get_limiter():
+    """
+    Return the limiter shared by the whole process, creating it without limits.
+    """
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = TransferLimiter()
+        return _limiter
@@ -0,0 +1,188 @@
+import codecs
+import csv
+import gzip
+import io
+import json
+import sys
+from urllib.parse import unquote_plus
+try:
+    import exit_codes as ec
+except BaseException:
+    from . import exit_codes as ec
+
+
+MANIFEST_FORMATS = {
+    'lines',
+    'csv',
+    'inventory_csv',
+    'inventory_parquet',
+    'inventory_manifest'}
+
+
+def split_s3_url(url):
+    """
+    Split an s3://bucket/key url into its bucket name and key.
+    """
+    bucket_name, _, key = url[len('s3://'):].partition('/')
+    return bucket_name, key
+
+
+def detect_manifest_format(manifest_path):
+    """
+    Guess the manifest format from its file name. CSV files are assumed to list keys
+    in the first column; S3 Inventory CSV files must be requested explicitly.
+    """
+    path = manifest_path.lower()
+    if path.endswith('manifest.json'):
+        return 'inventory_manifest'
+    if path.endswith('.parquet'):
+        return 'inventory_parquet'
+    if path.endswith('.csv') or path.endswith('.csv.gz'):
+        return 'csv'
+    return 'lines'
+
+
+def open_manifest(manifest_path, s3_connection=None):
+    """
+    Open a local or s3:// manifest as a binary stream, decompressing .gz files on the fly.
+    Objects on S3 are streamed rather than downloaded first.
+    """
+    if manifest_path.startswith('s3://'):
+        bucket_name, key = split_s3_url(manifest_path)
+        try:
+            stream = s3_connection.get_object(
+                Bucket=bucket_name, Key=key)['Body']
+        except Exception as e:
+            print(f'Error: The manifest {manifest_path} could not be read. {e}')
+            sys.exit(ec.EXIT_CODE_FILE_NOT_FOUND)
+    else:
+        try:
+            stream = open(manifest_path, 'rb')
+        except OSError as e:
+            print(f'Error: The manifest {manifest_path} could not be read. {e}')
+            sys.exit(ec.EXIT_CODE_FILE_NOT_FOUND)
+
+    if manifest_path.lower().endswith('.gz'):
+        stream = gzip.GzipFile(fileobj=stream)
+    return stream
+
+
+def read_line_keys(stream):
+    """
+    Yield one key per non-empty line.
+    """
+    for line in codecs.getreader('utf-8')(stream):
+        key = line.rstrip('\r\n')
+        if key:
+            yield key
+
+
+def read_sniffed_keys(stream):
+    """
+    Yield the keys of a manifest whose name doesn't say its format. Files that start
+    with a 'key' header row, like the plans --plan writes, are read as CSV, and
+    anything else as one key per line.
+    """
+    lines = codecs.getreader('utf-8')(stream)
+    first_line = lines.readline()
+    if next(csv.reader([first_line]), [''])[0].lower() == 'key':
+        for row in csv.reader(lines):
+            if row and row[0]:
+                yield row[0]
+        return
+    key = first_line.rstrip('\r\n')
+    if key:
+        yield key
+    for line in lines:
+        key = line.rstrip('\r\n')
+        if key:
+            yield key
+
+
+def read_csv_keys(stream):
+    """
+    Yield the first column of every row, skipping a leading header row named 'key'.
+    """
+    rows = csv.reader(codecs.getreader('utf-8')(stream))
+    for row_number, row in enumerate(rows):
+        if not row or not row[0]:
+            continue
+        if row_number == 0 and row[0].lower() == 'key':
+            continue
+        yield row[0]
+
+
+def read_inventory_csv_keys(stream):
+    """
+    Yield the keys from an S3 Inventory CSV file, whose rows start with the bucket
+    name followed by the key, URL-encoded as a form value with spaces as '+'.
+    """
+    for row in csv.reader(codecs.getreader('utf-8')(stream)):
+        if len(row) > 1:
+            yield unquote_plus(row[1])
+
+
+def read_inventory_parquet_keys(stream, batch_size=10000):
+    """
+    Yield the keys from an S3 Inventory Parquet file one row group batch at a time.
+    Requires pyarrow.
+    """
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        print('Error: pyarrow must be installed to read Parquet manifests.')
+        sys.exit(ec.EXIT_CODE_UNKNOWN_ERROR)
+
+    # Parquet footers sit at the end of the file, so the stream must be seekable.
+    if not hasattr(stream, 'seekable') or not stream.seekable():
+        stream = io.BytesIO(stream.read())
+    parquet_file = pq.ParquetFile(stream)
+    for batch in parquet_file.iter_batches(
+            batch_size=batch_size, columns=['key']):
+        for key in batch.column(0).to_pylist():
+            if key:
+                yield key
+
+
+def read_inventory_manifest_keys(stream, s3_connection=None):
+    """
+    Yield the keys from every data file listed in an S3 Inventory manifest.json.
+    """
+    inventory = json.load(codecs.getreader('utf-8')(stream))
+    bucket_name = inventory['destinationBucket'].split(':::')[-1]
+    file_format = inventory.get('fileFormat', 'CSV').lower()
+    for data_file in inventory['files']:
+        data_file_path = f's3://{bucket_name}/{data_file["key"]}'
+        yield from read_manifest(
+            data_file_path,
+            s3_connection=s3_connection,
+            manifest_format=f'inventory_{file_format}')
+
+
+def read_manifest(manifest_path, s3_connection=None, manifest_format=None):
+    """
+    Yield every key listed in a manifest, reading it as a stream so that arbitrarily
+    large manifests never have to fit in memory.
+    """
+    format_detected = manifest_format is None
+    manifest_format = manifest_format or detect_manifest_format(manifest_path)
+    if manifest_format not in MANIFEST_FORMATS:
+        print(f'Error: {manifest_format} is not a supported manifest format.')
+        sys.exit(ec.EXIT_CODE_UNKNOWN_ERROR)
+
+    stream = open_manifest(manifest_path, s3_connection)
+    try:
+        if manifest_format == 'inventory_manifest':
+            yield from read_inventory_manifest_keys(stream, s3_connection)
+        elif manifest_format == 'inventory_parquet':
+            yield from read_inventory_parquet_keys(stream)
+        elif manifest_format == 'inventory_csv':
+            yield from read_inventory_csv_keys(stream)
+        elif manifest_format == 'csv':
+            yield from read_csv_keys(stream)
+        elif format_detected:
+            yield from read_sniffed_keys(stream)
+        else:
+            yield from read_line_keys(stream)
+    finally:
+        stream.close()
@@ -10,8 +10,30 @@ import sys
 import shipyard_utils as shipyard
 try:
     import exit_codes as ec
+    import catalog
+    import concurrency
+    import integrity
+    import journal
+    import limiter
+    import manifest
+    import planner
+    import profiling
+    import retries
+    import scheduler
+    import streaming
 except BaseException:
     from . import exit_codes as ec
+    from . import catalog
+    from . import concurrency
+    from . import integrity
+    from . import journal
+    from . import limiter
+    from . import manifest
+    from . import planner
+    from . import profiling
+    from . import retries
+    from . import scheduler
+    from . import streaming
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -26,7 +48,7 @@ def get_args():
     parser.add_argument(
         '--source-file-name',
         dest='source_file_name',
-        required=True)
+        required=False)
     parser.add_argument(
         '--source-folder-name',
         dest='source_folder_name',
@@ -64,8 +86,191 @@ def get_args():
         '--aws-default-region',
         dest='aws_default_region',
         required=False)
-    
-    return parser.parse_args()
+    parser.add_argument(
+        '--source-endpoint-url',
+        dest='source_endpoint_url',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--destination-endpoint-url',
+        dest='destination_endpoint_url',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--destination-aws-access-key-id',
+        dest='destination_aws_access_key_id',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--destination-aws-secret-access-key',
+        dest='destination_aws_secret_access_key',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--destination-aws-default-region',
+        dest='destination_aws_default_region',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--stream-part-size',
+        dest='stream_part_size',
+        type=int,
+        default=streaming.PART_SIZE,
+        required=False)
+    parser.add_argument(
+        '--stream-buffer-count',
+        dest='stream_buffer_count',
+        type=int,
+        default=streaming.BUFFER_COUNT,
+        required=False)
+    parser.add_argument(
+        '--max-concurrency',
+        dest='max_concurrency',
+        type=int,
+        default=32,
+        required=False)
+    parser.add_argument(
+        '--max-attempts',
+        dest='max_attempts',
+        type=int,
+        default=5,
+        required=False)
+    parser.add_argument(
+        '--failure-manifest',
+        dest='failure_manifest',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--max-bytes-per-second',
+        dest='max_bytes_per_second',
+        type=float,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--max-requests-per-second',
+        dest='max_requests_per_second',
+        type=float,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--limits-file',
+        dest='limits_file',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--profile',
+        dest='profile',
+        choices=profiling.PROFILE_MODES,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--profile-output',
+        dest='profile_output',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--min-size',
+        dest='min_size',
+        type=int,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--max-size',
+        dest='max_size',
+        type=int,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--modified-after',
+        dest='modified_after',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--modified-before',
+        dest='modified_before',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--manifest',
+        dest='manifest',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--manifest-format',
+        dest='manifest_format',
+        choices=manifest.MANIFEST_FORMATS,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--manifest-chunk-size',
+        dest='manifest_chunk_size',
+        type=int,
+        default=10000,
+        required=False)
+    parser.add_argument(
+        '--journal',
+        dest='journal',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--plan',
+        dest='plan',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--verify-checksums',
+        dest='verify_checksums',
+        choices={
+            'TRUE',
+            'FALSE'},
+        default='FALSE',
+        required=False)
+    parser.add_argument(
+        '--preserve-structure',
+        dest='preserve_structure',
+        choices={
+            'TRUE',
+            'FALSE'},
+        default='FALSE',
+        required=False)
+    parser.add_argument(
+        '--prefix-write-rate',
+        dest='prefix_write_rate',
+        type=float,
+        default=scheduler.DEFAULT_WRITE_RATE,
+        required=False)
+    parser.add_argument(
+        '--prefix-read-rate',
+        dest='prefix_read_rate',
+        type=float,
+        default=scheduler.DEFAULT_READ_RATE,
+        required=False)
+    parser.add_argument(
+        '--prefix-depth',
+        dest='prefix_depth',
+        type=int,
+        default=None,
+        required=False)
+    args = parser.parse_args()
+    if not args.source_file_name and not args.manifest:
+        parser.error('--source-file-name is required unless --manifest is provided')
+    if args.preserve_structure == 'TRUE' and args.destination_file_name:
+        parser.error('--preserve-structure cannot be combined with --destination-file-name')
+    if args.plan and (
+            args.manifest or args.source_file_name_match_type != 'regex_match'):
+        parser.error('--plan requires --source-file-name-match-type regex_match and no --manifest')
+    if (args.min_size, args.max_size, args.modified_after, args.modified_before) != (
+            None, None, None, None) and (
+            args.manifest or args.source_file_name_match_type != 'regex_match'):
+        parser.error(
+            '--min-size, --max-size, --modified-after and --modified-before require '
+            '--source-file-name-match-type regex_match and no --manifest')
+    for modified_time in (args.modified_after, args.modified_before):
+        try:
+            catalog.parse_time(modified_time)
+        except ValueError:
+            parser.error(f'{modified_time} is not an ISO 8601 date or time')
+    return args
 
 
 def set_environment_variables(args):
@@ -83,38 +288,34 @@ def set_environment_variables(args):
     return
 
 
-def s3_list_files(
-        s3_connection,
-        bucket_name,
-        source_folder,
-        ):
-    """List files in s3"""
-    try:
-        # s3_response = s3_connection.list_objects_v2(Bucket=bucket_name, Prefix=source_folder)
-        # files_list =  [
-        #     _file['Key'] for _file in s3_response['Contents']
-        # ]
-        bucket = s3_connection.Bucket(bucket_name)
-
-        files_list = [obj.key for obj in bucket.objects.filter(Prefix = source_folder)]
-        return files_list
-    except: 
-        print(f"There was an error locating the files. Either the bucket does not exist or the folder does not exist. Please ensure that both are correct.")
-        sys.exit(ec.EXIT_CODE_FILE_NOT_FOUND)
-
-
-def connect_to_s3(access_key_id, secret_access_key, default_region=None):
+def connect_to_s3(
+        access_key_id,
+        secret_access_key,
+        default_region=None,
+        max_pool_connections=10,
+        endpoint_url=None):
     """
     Create a connection to the S3 service using credentials provided as environment variables.
     """
     try:
-        session = boto3.Session(
-            aws_access_key_id=access_key_id,
-            aws_secret_access_key=secret_access_key,
-            region_name=default_region
-        )
+        with profiling.phase('credentials'):
+            session = boto3.Session(
+                aws_access_key_id=access_key_id,
+                aws_secret_access_key=secret_access_key,
+                region_name=default_region
+            )
+            session.get_credentials()
 
-        s3_connection = session.resource('s3')
+        with profiling.phase('connect'):
+            s3_connection = session.resource(
+                's3',
+                endpoint_url=endpoint_url,
+                config=Config(
+                    max_pool_connections=max_pool_connections,
+                    # Only checksums a request asks for, such as --verify-checksums, are sent
+                    # or checked; S3-compatible stores may reject the ones boto3 adds by default.
+                    request_checksum_calculation='when_required',
+                    response_checksum_validation='when_required'))
         return s3_connection
     except Exception as e:
         print("Error: Could not connect to S3. Ensure that the provided access key, secret key, and region are correct")
@@ -122,18 +323,62 @@ def connect_to_s3(access_key_id, secret_access_key, default_region=None):
         sys.exit(ec.EXIT_CODE_INVALID_CREDENTIALS)
 
 
+def preserved_destination_path(destination_folder_name, source_folder_name, key_name):
+    """
+    Return where key_name is moved to when its path below source_folder_name is kept,
+    so that keys with the same file name in different folders don't overwrite each other.
+    Keys outside source_folder_name keep their whole path.
+    """
+    source_prefix = shipyard.files.clean_folder_name(source_folder_name)
+    if source_prefix and key_name.startswith(f'{source_prefix}/'):
+        key_name = key_name[len(source_prefix) + 1:]
+    return shipyard.files.combine_folder_and_file_name(destination_folder_name, key_name)
+
+
+def record_already_moved(
+        destination_client,
+        job_journal,
+        source_full_path,
+        destination_bucket_name,
+        destination_full_path):
+    """
+    Record a file whose source is gone as moved, if its destination exists. A
+    previous run may have deleted the source after its last journal flush. A
+    missing destination raises the not found error instead.
+    """
+    destination_client.head_object(
+        Bucket=destination_bucket_name, Key=destination_full_path)
+    job_journal.record(source_full_path, journal.STATE_DELETED)
+    print(f'{source_full_path} was already moved to {destination_bucket_name}/{destination_full_path}')
+
+
 def move_s3_file(
         s3_connection,
         source_bucket_name,
         destination_bucket_name,
         source_full_path,
         destination_full_path,
+        job_journal=None,
+        verify_checksums=False,
+        stream_mover=None,
         ):
     """
     Moves an AWS S3 file from one bucket to another.
 
     The specific way it does this is by first copying the file from one bucket to another
-    then deleting the file in the source_bucket.
+    then deleting the file in the source_bucket. The underlying client is used directly
+    since, unlike the resource, it is safe to share between threads. Errors are raised
+    to the caller so they can be classified and retried.
+
+    If a job_journal is provided, each step is recorded in it and steps a previous run
+    already completed are skipped.
+
+    With verify_checksums, the copy is made so that S3 computes the destination's
+    checksum in the source's algorithm, and the source is only deleted once the two
+    checksums match.
+
+    With a stream_mover, the file is streamed to the mover's destination connection
+    instead of being copied server side.
     """
     #create a source dictionary that specifies bucket name and key name of the object to be copied
     copy_source = {
@@ -141,20 +386,92 @@ def move_s3_file(
         'Key': source_full_path
     }
 
-    bucket = s3_connection.Bucket(destination_bucket_name)
-    try: 
-        bucket.copy(copy_source, destination_full_path)
+    s3_client = s3_connection.meta.client
+    destination_client = stream_mover.destination_client if stream_mover else s3_client
+    state = job_journal.state(source_full_path) if job_journal else journal.STATE_LISTED
+    if state == journal.STATE_DELETED:
+        return
 
-        s3_connection.Object(source_bucket_name, source_full_path).delete()
+    contents_verified = False
+    if state == journal.STATE_LISTED:
+        try:
+            if stream_mover:
+                contents_verified = stream_mover.copy(
+                    source_bucket_name,
+                    source_full_path,
+                    destination_bucket_name,
+                    destination_full_path,
+                    verify_checksums=verify_checksums)
+            elif verify_checksums:
+                integrity.copy_with_checksum(
+                    s3_client,
+                    source_bucket_name,
+                    source_full_path,
+                    destination_bucket_name,
+                    destination_full_path)
+            else:
+                s3_client.copy(
+                    copy_source,
+                    destination_bucket_name,
+                    destination_full_path,
+                    Config=concurrency.transfer_config())
+        except botocore.exceptions.ClientError as e:
+            if not job_journal or retries.classify_error(e) != retries.ERROR_NOT_FOUND:
+                raise
+            record_already_moved(
+                destination_client,
+                job_journal,
+                source_full_path,
+                destination_bucket_name,
+                destination_full_path)
+            return
+        if job_journal:
+            job_journal.record(source_full_path, journal.STATE_COPIED)
 
-        print(f'{source_full_path} successfully moved to {destination_bucket_name}/{destination_full_path}')
-    except Exception as e:
-        print(f"An error occured {e}.") 
-        print(f"The file {source_bucket_name}/{source_full_path} could not be found")
-        sys.exit(ec.EXIT_CODE_FILE_NOT_FOUND)
+    if state != journal.STATE_VERIFIED and verify_checksums:
+        try:
+            integrity.verify_copy(
+                s3_client,
+                source_bucket_name,
+                source_full_path,
+                destination_bucket_name,
+                destination_full_path,
+                destination_client=destination_client,
+                contents_verified=contents_verified)
+        except integrity.IntegrityError:
+            # Make the retry copy the file again rather than re-check the bad copy.
+            if job_journal:
+                job_journal.record(source_full_path, journal.STATE_LISTED)
+            raise
+        except botocore.exceptions.ClientError as e:
+            if not job_journal or retries.classify_error(e) != retries.ERROR_NOT_FOUND:
+                raise
+            record_already_moved(
+                destination_client,
+                job_journal,
+                source_full_path,
+                destination_bucket_name,
+                destination_full_path)
+            return
+        if job_journal:
+            job_journal.record(source_full_path, journal.STATE_VERIFIED)
+    elif state != journal.STATE_VERIFIED and job_journal:
+        destination_client.head_object(
+            Bucket=destination_bucket_name, Key=destination_full_path)
+        job_journal.record(source_full_path, journal.STATE_VERIFIED)
+
+    s3_client.delete_object(Bucket=source_bucket_name, Key=source_full_path)
+    if job_journal:
+        job_journal.record(source_full_path, journal.STATE_DELETED)
 
+    print(f'{source_full_path} successfully moved to {destination_bucket_name}/{destination_full_path}')
+
+
+@profiling.profiled
 def main():
     args = get_args()
+    if args.profile:
+        profiling.get_profiler().start(args.profile, args.profile_output)
     set_environment_variables(args)
     source_file_name = args.source_file_name
     source_folder_name = args.source_folder_name
@@ -169,51 +486,194 @@ def main():
     aws_default_region = os.environ['AWS_DEFAULT_REGION']
     source_bucket_name = args.source_bucket_name
     destination_bucket_name = args.destination_bucket_name
+    verify_checksums = args.verify_checksums == 'TRUE'
+    preserve_structure = args.preserve_structure == 'TRUE'
 
+    max_pool_connections = (
+        args.max_concurrency + integrity.PART_CONCURRENCY + args.stream_buffer_count)
     s3_connection = connect_to_s3(
         aws_access_key_id, 
         aws_secret_access_key, 
-        aws_default_region
+        aws_default_region,
+        max_pool_connections=max_pool_connections,
+        endpoint_url=args.source_endpoint_url
         )
+    controller = concurrency.AdaptiveConcurrencyController(
+        max_limit=args.max_concurrency)
+    retry_policy = retries.RetryPolicy(max_attempts=args.max_attempts)
+    controller.observe_client(s3_connection.meta.client)
+    transfer_limiter = limiter.get_limiter()
+    transfer_limiter.set_limits(
+        args.max_bytes_per_second, args.max_requests_per_second)
+    if args.limits_file:
+        transfer_limiter.watch(args.limits_file)
+    transfer_limiter.attach(s3_connection.meta.client)
 
-    if source_file_name_match_type == 'regex_match':
-        file_names = s3_list_files(
-            s3_connection, source_bucket_name, source_folder_name)
-        ## exit if there is a regex error
+    stream_mover = None
+    if (args.destination_endpoint_url or args.destination_aws_access_key_id
+            or args.destination_aws_secret_access_key
+            or args.destination_aws_default_region):
+        destination_connection = connect_to_s3(
+            args.destination_aws_access_key_id or aws_access_key_id,
+            args.destination_aws_secret_access_key or aws_secret_access_key,
+            args.destination_aws_default_region or aws_default_region,
+            max_pool_connections=max_pool_connections,
+            endpoint_url=args.destination_endpoint_url)
+        destination_client = destination_connection.meta.client
+        controller.observe_client(destination_client)
+        transfer_limiter.attach(destination_client)
+        stream_mover = streaming.StreamMover(
+            s3_connection.meta.client,
+            destination_client,
+            part_size=args.stream_part_size,
+            buffer_count=args.stream_buffer_count)
+        print('The destination uses its own connection, so files will be streamed through this process.')
+    prefix_scheduler = scheduler.PrefixScheduler(
+        write_rate=args.prefix_write_rate,
+        read_rate=args.prefix_read_rate,
+        prefix_depth=args.prefix_depth)
+
+    object_filter = None
+    if source_file_name_match_type == 'regex_match' and not args.manifest:
         try:
-            matching_file_names = shipyard.files.find_all_file_matches(
-                file_names, source_file_name)
-            num_matches = len(matching_file_names)
-        except Exception as e:
+            object_filter = catalog.ObjectFilter(
+                source_file_name,
+                min_size=args.min_size,
+                max_size=args.max_size,
+                modified_after=args.modified_after,
+                modified_before=args.modified_before)
+        except re.error:
             print(f"Error in finding regex matches. Please make sure a valid regex is entered")
             sys.exit(ec.EXIT_CODE_INVALID_REGEX)
 
+    if args.plan:
+        transfer_config = concurrency.transfer_config()
+        run_plan = planner.create_plan(
+            s3_connection.meta.client,
+            source_bucket_name,
+            source_folder_name,
+            object_filter,
+            args.plan,
+            planner.RunPlan(
+                planner.OPERATION_MOVE,
+                multipart_threshold=transfer_config.multipart_threshold,
+                multipart_chunksize=transfer_config.multipart_chunksize,
+                verify_checksums=verify_checksums,
+                journal=bool(args.journal),
+                prefix_depth=args.prefix_depth,
+                stream_part_size=args.stream_part_size if stream_mover else None))
+        run_plan.print_summary(
+            run_plan.measure_latency(s3_connection.meta.client, source_bucket_name),
+            args.max_concurrency,
+            args.prefix_write_rate,
+            args.prefix_read_rate)
+        print(f'Plan saved to {args.plan}. Pass it as --manifest to move exactly these files.')
+        return
+
+    job_journal = None
+    if args.journal:
+        job_journal = journal.JobJournal(args.journal)
+        job_journal.check_job({
+            'source_bucket_name': source_bucket_name,
+            'source_folder_name': source_folder_name,
+            'source_file_name': source_file_name,
+            'destination_bucket_name': destination_bucket_name,
+            'destination_folder_name': destination_folder_name,
+            'destination_file_name': args.destination_file_name,
+            'preserve_structure': preserve_structure,
+            'manifest': args.manifest,
+            'min_size': args.min_size,
+            'max_size': args.max_size,
+            'modified_after': args.modified_after,
+            'modified_before': args.modified_before})
+    resuming = job_journal is not None and job_journal.listing_complete
+
+    if resuming:
+        indexed_file_names = job_journal.pending()
+        num_matches = job_journal.get('num_matches')
+        window_size = args.manifest_chunk_size
+        print(f'Resuming the job recorded in {args.journal}: {job_journal.counts()}')
+
+    elif args.manifest:
+        indexed_file_names = enumerate(profiling.timed('list', manifest.read_manifest(
+            args.manifest,
+            s3_connection=s3_connection.meta.client,
+            manifest_format=args.manifest_format)), 1)
+        num_matches = None
+        window_size = args.manifest_chunk_size
+        print(f'Reading files to move from {args.manifest}...')
+
+    elif source_file_name_match_type == 'regex_match':
+        try:
+            with profiling.phase('list'):
+                object_catalog = catalog.ObjectCatalog.from_listing(
+                    s3_connection.meta.client, source_bucket_name, source_folder_name)
+        except Exception:
+            print(f"There was an error locating the files. Either the bucket does not exist or the folder does not exist. Please ensure that both are correct.")
+            sys.exit(ec.EXIT_CODE_FILE_NOT_FOUND)
+        with profiling.phase('match'):
+            matching_indexes = object_catalog.select(object_filter)
+        matching_file_names = object_catalog.keys(matching_indexes)
+        num_matches = len(matching_indexes)
+
         if num_matches == 0:
             print(f'No matches found for regex {source_file_name}')
             sys.exit(1)
         else:
             print(f'{num_matches} files found. Preparing to upload...')
+        indexed_file_names = enumerate(matching_file_names, 1)
+        window_size = args.manifest_chunk_size
 
-        try:
-            for index, key_name in enumerate(matching_file_names,1):
-                destination_full_path = shipyard.files.determine_destination_full_path(
-                    destination_folder_name = destination_folder_name,
-                    destination_file_name = args.destination_file_name,
-                    source_full_path = key_name,
-                    file_number = None if num_matches == 1 else index
-                )
-                print(f'Moving file {index} of {len(matching_file_names)}')
+    if resuming or args.manifest or source_file_name_match_type == 'regex_match':
+        if job_journal and not resuming:
+            indexed_file_names = job_journal.track(indexed_file_names, num_matches)
+
+        def move_match(indexed_key_name):
+            index, key_name = indexed_key_name
+            with profiling.phase('destination names'):
+                if preserve_structure:
+                    destination_full_path = preserved_destination_path(
+                        destination_folder_name, source_folder_name, key_name)
+                else:
+                    destination_full_path = shipyard.files.determine_destination_full_path(
+                        destination_folder_name = destination_folder_name,
+                        destination_file_name = args.destination_file_name,
+                        source_full_path = key_name,
+                        file_number = None if num_matches == 1 else index
+                    )
+            print(f'Moving file {index}{f" of {num_matches}" if num_matches else ""}')
+            # The scheduler only spaces out the source requests; the copy writes here.
+            prefix_scheduler.acquire(destination_bucket_name, destination_full_path, 'COPY')
+            with profiling.phase('transfer'):
                 move_s3_file(
                         s3_connection,
                         source_bucket_name,
                         destination_bucket_name,
                         key_name,
-                        destination_full_path
+                        destination_full_path,
+                        job_journal=job_journal,
+                        verify_checksums=verify_checksums,
+                        stream_mover=stream_mover
                 )
-        except Exception as e:
-            print("Something went wrong moving the files")
-            print(e)
-            sys.exit(1)
+
+        report = retries.OperationReport(
+            key=lambda indexed_key_name: indexed_key_name[1])
+        try:
+            concurrency.run_concurrently(
+                move_match,
+                prefix_scheduler.schedule(
+                    indexed_file_names,
+                    bucket_name=source_bucket_name,
+                    operations=('GET', 'DELETE'),
+                    key=lambda indexed_key_name: indexed_key_name[1],
+                    window_size=window_size),
+                controller=controller,
+                retry_policy=retry_policy,
+                report=report)
+        finally:
+            if job_journal:
+                print(f'Journal {args.journal}: {job_journal.counts()}')
+                job_journal.close()
 
     else:
 
@@ -225,13 +685,23 @@ def main():
             source_full_path = source_full_path
         )
 
-        move_s3_file(
-            s3_connection,
-            source_bucket_name,
-            destination_bucket_name,
-            source_full_path,
-            destination_full_path
-        )
+        report = retries.OperationReport()
+        concurrency.run_concurrently(
+            lambda key_name: move_s3_file(
+                s3_connection,
+                source_bucket_name,
+                destination_bucket_name,
+                key_name,
+                destination_full_path,
+                verify_checksums=verify_checksums,
+                stream_mover=stream_mover
+            ),
+            [source_full_path],
+            controller=controller,
+            retry_policy=retry_policy,
+            report=report)
+
+    report.finish(args.failure_manifest)
 
 
 if __name__ == '__main__':
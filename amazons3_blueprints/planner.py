@@ -0,0 +1,222 @@
+import csv
+import math
+import statistics
+import time
+from bisect import bisect_right
+from collections import Counter
+try:
+    import catalog
+    import integrity
+    import scheduler
+except BaseException:
+    from . import catalog
+    from . import integrity
+    from . import scheduler
+
+
+KILOBYTE = 1024
+MEGABYTE = 1024 * KILOBYTE
+GIGABYTE = 1024 * MEGABYTE
+
+# Upper bounds of each size histogram bucket. The last bucket holds everything larger.
+SIZE_BUCKET_BOUNDS = [
+    KILOBYTE,
+    64 * KILOBYTE,
+    MEGABYTE,
+    8 * MEGABYTE,
+    100 * MEGABYTE,
+    GIGABYTE,
+    5 * GIGABYTE]
+LATENCY_SAMPLES = 5
+
+OPERATION_MOVE = 'move'
+OPERATION_REMOVE = 'remove'
+
+
+def format_bytes(size):
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if size < 1024 or unit == 'TB':
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(math.ceil(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}h {minutes:02d}m {seconds:02d}s'
+
+
+class RunPlan:
+    """
+    What a bulk move or remove would do, accumulated one listed object at a time: how
+    many objects and bytes match, how their sizes are spread, and which S3 requests
+    the run would make for them.
+
+    Request counts follow the code paths the blueprints take, and every key is deleted
+    with its own DeleteObject call. Managed copies above multipart_threshold are split
+    into multipart_chunksize parts, as TransferConfig does. Verified copies follow the
+    source's own parts, whose count comes from its ETag, as copy_with_checksum does.
+    With a stream_part_size, objects are streamed between connections the way
+    StreamMover.copy splits them.
+    """
+
+    def __init__(
+            self,
+            operation,
+            multipart_threshold=8 * MEGABYTE,
+            multipart_chunksize=8 * MEGABYTE,
+            verify_checksums=False,
+            journal=False,
+            prefix_depth=None,
+            stream_part_size=None):
+        self.operation = operation
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+        self.verify_checksums = verify_checksums
+        self.journal = journal
+        self.prefix_depth = prefix_depth
+        self.stream_part_size = stream_part_size
+        self.count = 0
+        self.total_bytes = 0
+        self.largest = 0
+        self.size_histogram = [0] * (len(SIZE_BUCKET_BOUNDS) + 1)
+        self.requests = Counter()
+        self.prefix_counts = Counter()
+        self.sample_keys = []
+
+    def add(self, key, size, etag=None):
+        self.count += 1
+        self.total_bytes += size
+        self.largest = max(self.largest, size)
+        self.size_histogram[bisect_right(SIZE_BUCKET_BOUNDS, size - 1)] += 1
+        self.prefix_counts[scheduler.key_prefix(key, self.prefix_depth)] += 1
+        self.requests.update(self._requests_for(
+            size, integrity.etag_parts_count(etag) if etag else 1))
+        if len(self.sample_keys) < LATENCY_SAMPLES:
+            self.sample_keys.append(key)
+
+    def _requests_for(self, size, parts_count=1):
+        if self.operation == OPERATION_REMOVE:
+            return {'DeleteObject': 1}
+
+        requests = Counter({'DeleteObject': 1})
+        if self.verify_checksums:
+            # The source's checksum and parts before the copy, both objects' after it.
+            requests['GetObjectAttributes'] += 3 * math.ceil(parts_count / 1000)
+        if self.stream_part_size:
+            requests.update(self._stream_requests_for(size, parts_count))
+        elif self.verify_checksums:
+            if parts_count == 1 and size <= integrity.MAX_COPY_SIZE:
+                requests['CopyObject'] += 1
+            else:
+                requests['HeadObject'] += 1
+                requests['CreateMultipartUpload'] += 1
+                requests['UploadPartCopy'] += parts_count
+                requests['CompleteMultipartUpload'] += 1
+        else:
+            # The managed copy reads the source's size before choosing how to copy.
+            requests['HeadObject'] += 1
+            if size < self.multipart_threshold:
+                requests['CopyObject'] += 1
+            else:
+                requests['CreateMultipartUpload'] += 1
+                requests['UploadPartCopy'] += math.ceil(size / self.multipart_chunksize)
+                requests['CompleteMultipartUpload'] += 1
+        if self.journal and not self.verify_checksums:
+            # The copy is confirmed before the source is deleted.
+            requests['HeadObject'] += 1
+        return requests
+
+    def _stream_requests_for(self, size, parts_count):
+        requests = Counter({'HeadObject': 1})
+        if self.verify_checksums and parts_count > 1:
+            part_count = parts_count
+        else:
+            part_size = max(self.stream_part_size, math.ceil(size / integrity.MAX_PARTS))
+            part_count = math.ceil(size / part_size)
+        if part_count <= 1:
+            requests['GetObject'] += 1 if size else 0
+            requests['PutObject'] += 1
+        else:
+            requests['CreateMultipartUpload'] += 1
+            requests['GetObject'] += part_count
+            requests['UploadPart'] += part_count
+            requests['CompleteMultipartUpload'] += 1
+        return requests
+
+    @property
+    def total_requests(self):
+        return sum(self.requests.values())
+
+    def measure_latency(self, s3_client, bucket_name):
+        """
+        Return the median latency in seconds of a HEAD request on a few of the
+        matched keys, as a stand-in for the per-request latency of the run.
+        """
+        latencies = []
+        for key in self.sample_keys:
+            start = time.perf_counter()
+            s3_client.head_object(Bucket=bucket_name, Key=key)
+            latencies.append(time.perf_counter() - start)
+        return statistics.median(latencies) if latencies else None
+
+    def projected_seconds(self, latency, concurrency, write_rate, read_rate):
+        """
+        Return the projected wall time of the run and what limits it: either
+        requests in flight at the given latency and concurrency, or the request rate
+        of the busiest prefix.
+        """
+        request_seconds = self.total_requests * latency / concurrency
+        rates = [write_rate] if self.operation == OPERATION_REMOVE else [
+            write_rate, read_rate]
+        rate = min(rate for rate in rates if rate) if any(rates) else None
+        busiest_count = max(self.prefix_counts.values(), default=0)
+        rate_seconds = busiest_count / rate if rate else 0.0
+        if rate_seconds > request_seconds:
+            return rate_seconds, 'the per-prefix request rate'
+        return request_seconds, f'{concurrency} requests in flight'
+
+    def print_summary(self, latency, concurrency, write_rate, read_rate):
+        print(
+            f'Plan: {self.operation} {self.count} objects, '
+            f'{format_bytes(self.total_bytes)} in total across '
+            f'{len(self.prefix_counts)} prefixes. Largest object: {format_bytes(self.largest)}.')
+        print('Object sizes:')
+        lower_bounds = [0] + SIZE_BUCKET_BOUNDS
+        for index, objects in enumerate(self.size_histogram):
+            if index < len(SIZE_BUCKET_BOUNDS):
+                label = f'{format_bytes(lower_bounds[index])} - {format_bytes(SIZE_BUCKET_BOUNDS[index])}'
+            else:
+                label = f'>= {format_bytes(SIZE_BUCKET_BOUNDS[-1])}'
+            print(f'  {label:>22}: {objects}')
+        print(f'Estimated requests: {self.total_requests}')
+        for request, count in sorted(self.requests.items()):
+            print(f'  {request:>24}: {count}')
+        if latency is None:
+            print('No objects matched, so no latency was measured.')
+            return
+        seconds, limit = self.projected_seconds(
+            latency, concurrency, write_rate, read_rate)
+        print(
+            f'Measured request latency: {latency * 1000:.1f} ms. Projected wall time: '
+            f'{format_duration(seconds)}, limited by {limit}.')
+
+
+def create_plan(s3_client, bucket_name, prefix, object_filter, plan_path, run_plan):
+    """
+    Stream the listing of prefix once, adding every object that passes object_filter
+    to run_plan and writing it to plan_path as a CSV manifest of key and size. The
+    manifest can be passed back with --manifest to act on exactly those keys.
+    """
+    with open(plan_path, 'w', newline='') as plan_file:
+        writer = csv.writer(plan_file)
+        writer.writerow(['key', 'size'])
+        for contents in catalog.list_pages(s3_client, bucket_name, prefix):
+            # A catalog per page keeps memory flat while filtering like the run will.
+            page = catalog.ObjectCatalog()
+            page.add_page(contents)
+            for index in page.select(object_filter):
+                key, size = page.key(index), page.sizes[index]
+                run_plan.add(key, size, page.etag(index))
+                writer.writerow([key, size])
+    return run_plan
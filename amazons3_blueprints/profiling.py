@@ -0,0 +1,289 @@
+import cProfile
+import functools
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+PROFILE_PHASES = 'phases'
+PROFILE_CPROFILE = 'cprofile'
+PROFILE_SAMPLE = 'sample'
+PROFILE_MODES = (PROFILE_PHASES, PROFILE_CPROFILE, PROFILE_SAMPLE)
+
+DEFAULT_OUTPUT_PATHS = {
+    PROFILE_CPROFILE: 'profile.prof',
+    PROFILE_SAMPLE: 'profile.folded'}
+SAMPLE_INTERVAL = 0.005
+TOP_FUNCTIONS = 20
+
+_profiler = None
+_profiler_lock = threading.Lock()
+
+
+def _frame_name(code):
+    # Semicolons separate frames in folded stacks, so they can't appear in a name.
+    return (
+        f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+    ).replace(';', ':')
+
+
+class SamplingProfiler:
+    """
+    Records the call stack of every thread each interval seconds from a background
+    thread. Threads waiting on the network or a lock are sampled too, so the counts
+    show where wall time goes, not only CPU time.
+
+    Stacks are kept as tuples of code objects and only formatted when written, so
+    each sample costs little more than walking the frames.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                self.samples[tuple(reversed(stack))] += 1
+
+    def write_folded(self, output_path):
+        """
+        Write the samples as folded stacks, one 'outer;...;inner count' line per
+        distinct stack, which flamegraph.pl, speedscope and inferno read directly.
+        """
+        with open(output_path, 'w') as output_file:
+            for stack, count in self.samples.most_common():
+                output_file.write(
+                    f'{";".join(_frame_name(code) for code in stack)} {count}\n')
+
+    def print_top(self, top=TOP_FUNCTIONS):
+        total = sum(self.samples.values())
+        own = Counter()
+        inclusive = Counter()
+        for stack, count in self.samples.items():
+            own[stack[-1]] += count
+            for code in set(stack):
+                inclusive[code] += count
+        print(f'Top functions by samples ({total} samples every {self.interval * 1000:g} ms):')
+        print(f'  {"own %":>7} {"total %":>8}  function')
+        for code, count in own.most_common(top):
+            print(
+                f'  {100 * count / total:>6.1f}% {100 * inclusive[code] / total:>7.1f}%  '
+                f'{_frame_name(code)}')
+
+
+class ThreadedCProfile:
+    """
+    cProfile over every thread of the run. From Python 3.12 one profile sees all
+    threads. Before that, each thread started after start() gets its own profile and
+    they are merged when the run stops.
+    """
+
+    def __init__(self):
+        self._profiles = []
+        self._lock = threading.Lock()
+        self._per_thread = sys.version_info < (3, 12)
+
+    def start(self):
+        self._enable_profile()
+        if self._per_thread:
+            threading.setprofile(self._start_thread)
+
+    def _start_thread(self, frame, event, arg):
+        # Enabling the profile replaces this hook for the rest of the thread.
+        self._enable_profile()
+
+    def _enable_profile(self):
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def stop(self):
+        if self._per_thread:
+            threading.setprofile(None)
+        # The profile of the calling thread is the first one, so disable it last.
+        for profile in reversed(self._profiles):
+            profile.disable()
+
+    def stats(self):
+        with self._lock:
+            profiles = list(self._profiles)
+        return pstats.Stats(*profiles, stream=io.StringIO())
+
+    def write_stats(self, output_path):
+        """
+        Write the merged profile in pstats format, which snakeviz, flameprof and
+        gprof2dot turn into flamegraphs and call graphs.
+        """
+        self.stats().dump_stats(output_path)
+
+    def print_top(self, top=TOP_FUNCTIONS):
+        stats = self.stats()
+        stats.stream = sys.stdout
+        print('Top functions by own time:')
+        stats.sort_stats('tottime').print_stats(top)
+
+
+class RunProfiler:
+    """
+    Times the phases of a blueprint run, such as resolving credentials, connecting,
+    listing, matching, naming destinations and transferring, and optionally profiles
+    the whole run with cProfile or a sampling profiler.
+
+    Phases are timed with phase() or timed() wherever they run. Phases in worker
+    threads add up across threads, so their total can exceed the wall time.
+    Until start() is called, phases cost only a flag check.
+    """
+
+    def __init__(self):
+        self.mode = None
+        self.output_path = None
+        self.started = None
+        self.phases = {}
+        self._lock = threading.Lock()
+        self._profiler = None
+
+    @property
+    def active(self):
+        return self.mode is not None
+
+    def start(
+            self,
+            mode=PROFILE_PHASES,
+            output_path=None,
+            sample_interval=SAMPLE_INTERVAL):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f'Unknown profile mode {mode}, expected one of {PROFILE_MODES}')
+        self.mode = mode
+        self.output_path = output_path or DEFAULT_OUTPUT_PATHS.get(mode)
+        self.phases = {}
+        if mode == PROFILE_CPROFILE:
+            self._profiler = ThreadedCProfile()
+        elif mode == PROFILE_SAMPLE:
+            self._profiler = SamplingProfiler(sample_interval)
+        self.started = time.perf_counter()
+        if self._profiler:
+            self._profiler.start()
+
+    def add(self, name, seconds, calls=1):
+        with self._lock:
+            phase = self.phases.setdefault(name, [0, 0.0])
+            phase[0] += calls
+            phase[1] += seconds
+
+    @contextmanager
+    def phase(self, name):
+        if not self.active:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def timed(self, name, iterable):
+        """
+        Yield from iterable, timing each step as the named phase. Used for lazy
+        listings, whose requests happen while they're consumed.
+        """
+        if not self.active:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.perf_counter() - start, calls=0)
+                return
+            self.add(name, time.perf_counter() - start, calls=0)
+            yield item
+
+    def print_phases(self, wall_seconds):
+        print(f'Run time: {wall_seconds:.3f}s. Time by phase:')
+        print(f'  {"phase":>20} {"calls":>8} {"seconds":>10} {"% of run":>9}')
+        for name, (calls, seconds) in self.phases.items():
+            print(
+                f'  {name:>20} {calls or "":>8} {seconds:>10.3f} '
+                f'{100 * seconds / wall_seconds if wall_seconds else 0:>8.1f}%')
+
+    def finish(self):
+        """
+        Stop profiling and print the breakdown, writing the profile to output_path.
+        Does nothing if the profiler was never started.
+        """
+        if not self.active:
+            return
+        wall_seconds = time.perf_counter() - self.started
+        profiler, self._profiler = self._profiler, None
+        self.mode = None
+        if profiler:
+            profiler.stop()
+        self.print_phases(wall_seconds)
+        if isinstance(profiler, SamplingProfiler):
+            profiler.print_top()
+            profiler.write_folded(self.output_path)
+            print(f'Folded stacks for a flamegraph written to {self.output_path}')
+        elif isinstance(profiler, ThreadedCProfile):
+            profiler.print_top()
+            profiler.write_stats(self.output_path)
+            print(f'cProfile stats written to {self.output_path}')
+
+
+def get_profiler():
+    """
+    Return the profiler shared by the whole process, which starts out inactive.
+    """
+    global _profiler
+    with _profiler_lock:
+        if _profiler is None:
+            _profiler = RunProfiler()
+        return _profiler
+
+
+def phase(name):
+    return get_profiler().phase(name)
+
+
+def timed(name, iterable):
+    return get_profiler().timed(name, iterable)
+
+
+def profiled(function):
+    """
+    Finish the process-wide profiler when function returns or exits, so a blueprint's
+    main() reports its profile even when it ends with sys.exit().
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        finally:
+            get_profiler().finish()
+    return wrapper
@@ -0,0 +1,413 @@
+import argparse
+import csv
+import os
+import queue
+import sys
+import threading
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+import botocore
+from botocore.client import Config
+try:
+    import catalog
+    import exit_codes as ec
+    import integrity
+    import profiling
+    import retries
+except BaseException:
+    from . import catalog
+    from . import exit_codes as ec
+    from . import integrity
+    from . import profiling
+    from . import retries
+
+
+COMPARE_SIZE = 'size'
+COMPARE_ETAG = 'etag'
+COMPARE_CHECKSUM = 'checksum'
+COMPARE_MODES = (COMPARE_SIZE, COMPARE_ETAG, COMPARE_CHECKSUM)
+
+ONLY_IN_SOURCE = 'only_in_source'
+ONLY_IN_DESTINATION = 'only_in_destination'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+
+# Listing pages each side may hold before its lister waits for the merge to catch up.
+LISTING_QUEUE_PAGES = 4
+# Checksum lookups in flight before the merge waits for the oldest one.
+CHECKSUM_WINDOW = 1000
+
+ListedObject = namedtuple('ListedObject', ['key', 'size', 'etag'])
+Difference = namedtuple(
+    'Difference', ['status', 'relative_key', 'source', 'destination'])
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--source-bucket-name',
+        dest='source_bucket_name',
+        required=True)
+    parser.add_argument(
+        '--source-folder-name',
+        dest='source_folder_name',
+        default='',
+        required=False)
+    parser.add_argument(
+        '--destination-bucket-name',
+        dest='destination_bucket_name',
+        required=True)
+    parser.add_argument(
+        '--destination-folder-name',
+        dest='destination_folder_name',
+        default='',
+        required=False)
+    parser.add_argument(
+        '--compare',
+        dest='compare',
+        choices=COMPARE_MODES,
+        default=COMPARE_ETAG,
+        required=False)
+    parser.add_argument(
+        '--only-in-source-manifest',
+        dest='only_in_source_manifest',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--only-in-destination-manifest',
+        dest='only_in_destination_manifest',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--changed-manifest',
+        dest='changed_manifest',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--s3-config',
+        dest='s3_config',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--aws-access-key-id',
+        dest='aws_access_key_id',
+        required=False)
+    parser.add_argument(
+        '--aws-secret-access-key',
+        dest='aws_secret_access_key',
+        required=False)
+    parser.add_argument(
+        '--aws-default-region',
+        dest='aws_default_region',
+        required=False)
+    parser.add_argument(
+        '--max-concurrency',
+        dest='max_concurrency',
+        type=int,
+        default=32,
+        required=False)
+    parser.add_argument(
+        '--profile',
+        dest='profile',
+        choices=profiling.PROFILE_MODES,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--profile-output',
+        dest='profile_output',
+        default=None,
+        required=False)
+    return parser.parse_args()
+
+
+def set_environment_variables(args):
+    """
+    Set AWS credentials as environment variables if they're provided via keyword arguments
+    rather than seeded as environment variables. This will override system defaults.
+    """
+
+    if args.aws_access_key_id:
+        os.environ['AWS_ACCESS_KEY_ID'] = args.aws_access_key_id
+    if args.aws_secret_access_key:
+        os.environ['AWS_SECRET_ACCESS_KEY'] = args.aws_secret_access_key
+    if args.aws_default_region:
+        os.environ['AWS_DEFAULT_REGION'] = args.aws_default_region
+    return
+
+
+def connect_to_s3(s3_config=None, max_pool_connections=10):
+    """
+    Create a connection to the S3 service using credentials provided as environment variables.
+    """
+    with profiling.phase('credentials'):
+        session = boto3.Session()
+        session.get_credentials()
+    with profiling.phase('connect'):
+        s3_connection = session.client(
+            's3',
+            config=Config(
+                s3_config,
+                max_pool_connections=max_pool_connections,
+                # Only checksums a request asks for, such as --verify-checksums, are sent
+                # or checked; S3-compatible stores may reject the ones boto3 adds by default.
+                request_checksum_calculation='when_required',
+                response_checksum_validation='when_required')
+        )
+    return s3_connection
+
+
+def folder_prefix(folder_name):
+    """
+    Turn a folder name into a listing prefix that only matches keys inside the folder.
+    """
+    folder_name = folder_name.strip('/')
+    if folder_name != '':
+        folder_name = f'{os.path.normpath(folder_name)}/'
+    return folder_name
+
+
+def list_in_background(s3_client, bucket_name, prefix='', queue_pages=LISTING_QUEUE_PAGES):
+    """
+    Yield the objects under prefix as ListedObjects, in the lexicographic key order
+    S3 lists them in, while a background thread lists the next pages. At most queue_pages pages are held, so listing never runs far ahead of the reader.
+    """
+    pages = queue.Queue(maxsize=queue_pages)
+
+    def list_into_queue():
+        try:
+            for contents in catalog.list_pages(s3_client, bucket_name, prefix):
+                pages.put([
+                    ListedObject(
+                        s3_object['Key'], s3_object['Size'], s3_object['ETag'].strip('"'))
+                    for s3_object in contents])
+            pages.put(None)
+        except BaseException as e:
+            pages.put(e)
+
+    threading.Thread(
+        target=list_into_queue, name=f'list-{bucket_name}', daemon=True).start()
+    while True:
+        page = pages.get()
+        if page is None:
+            return
+        if isinstance(page, BaseException):
+            raise page
+        yield from page
+
+
+def _relative(objects, bucket_name, prefix):
+    previous = None
+    for listed_object in objects:
+        relative_key = listed_object.key[len(prefix):]
+        # The merge relies on sorted keys, which some S3-compatible stores don't give.
+        if previous is not None and relative_key <= previous:
+            raise ValueError(
+                f'{bucket_name} listed {listed_object.key} out of order, '
+                'so it cannot be reconciled')
+        previous = relative_key
+        yield relative_key, listed_object
+
+
+def merge_join(
+        source_objects,
+        destination_objects,
+        source_bucket_name='source',
+        source_prefix='',
+        destination_bucket_name='destination',
+        destination_prefix=''):
+    """
+    Walk two sorted listings side by side, yielding (relative_key, source,
+    destination) for every key below either prefix. The side a key is missing from
+    is None. Only the current object of each listing is held in memory.
+    """
+    sentinel = (None, None)
+    source = _relative(source_objects, source_bucket_name, source_prefix)
+    destination = _relative(
+        destination_objects, destination_bucket_name, destination_prefix)
+    source_key, source_object = next(source, sentinel)
+    destination_key, destination_object = next(destination, sentinel)
+    while source_object is not None or destination_object is not None:
+        if destination_object is None or (
+                source_object is not None and source_key < destination_key):
+            yield source_key, source_object, None
+            source_key, source_object = next(source, sentinel)
+        elif source_object is None or destination_key < source_key:
+            yield destination_key, None, destination_object
+            destination_key, destination_object = next(destination, sentinel)
+        else:
+            yield source_key, source_object, destination_object
+            source_key, source_object = next(source, sentinel)
+            destination_key, destination_object = next(destination, sentinel)
+
+
+def checksums_differ(
+        source_client,
+        source_bucket_name,
+        source_key_name,
+        destination_client,
+        destination_bucket_name,
+        destination_key_name):
+    """
+    Compare the checksums S3 stores for two objects of the same size. Objects
+    without checksums that can be compared are reported as different, so that
+    they're copied again rather than assumed equal.
+    """
+    source = integrity.get_object_checksum(
+        source_client, source_bucket_name, source_key_name)
+    destination = integrity.get_object_checksum(
+        destination_client, destination_bucket_name, destination_key_name)
+    if not source.comparable_to(destination):
+        return True
+    return source.checksum != destination.checksum
+
+
+def reconcile(
+        s3_client,
+        source_bucket_name,
+        source_prefix,
+        destination_bucket_name,
+        destination_prefix,
+        compare=COMPARE_ETAG,
+        destination_client=None,
+        max_concurrency=32):
+    """
+    Yield a Difference for every key under either prefix, in key order.
+
+    Both prefixes are listed at once and merge joined, so memory stays constant
+    however many keys there are. Keys on both sides are CHANGED if their sizes
+    differ. With COMPARE_ETAG they are also CHANGED if their ETags differ. With
+    COMPARE_CHECKSUM, keys whose ETags differ are then checked with
+    GetObjectAttributes, up to max_concurrency at a time. This matters because copies
+    made with a different part size have different ETags for the same content.
+    """
+    destination_client = destination_client or s3_client
+    pairs = merge_join(
+        list_in_background(s3_client, source_bucket_name, source_prefix),
+        list_in_background(destination_client, destination_bucket_name, destination_prefix),
+        source_bucket_name,
+        source_prefix,
+        destination_bucket_name,
+        destination_prefix)
+
+    with ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix='reconcile') as executor:
+        pending = deque()
+        for relative_key, source, destination in pairs:
+            if destination is None:
+                status = ONLY_IN_SOURCE
+            elif source is None:
+                status = ONLY_IN_DESTINATION
+            elif source.size != destination.size:
+                status = CHANGED
+            elif compare == COMPARE_SIZE or source.etag == destination.etag:
+                status = UNCHANGED
+            elif compare == COMPARE_ETAG:
+                status = CHANGED
+            else:
+                status = executor.submit(
+                    checksums_differ,
+                    s3_client,
+                    source_bucket_name,
+                    source.key,
+                    destination_client,
+                    destination_bucket_name,
+                    destination.key)
+            pending.append((status, relative_key, source, destination))
+
+            # Keep key order by only yielding once every earlier lookup is done.
+            while pending and (
+                    isinstance(pending[0][0], str) or pending[0][0].done()
+                    or len(pending) > CHECKSUM_WINDOW):
+                yield _resolve(*pending.popleft())
+        while pending:
+            yield _resolve(*pending.popleft())
+
+
+def _resolve(status, relative_key, source, destination):
+    if not isinstance(status, str):
+        status = CHANGED if status.result() else UNCHANGED
+    return Difference(status, relative_key, source, destination)
+
+
+def write_manifests(differences, manifest_paths):
+    """
+    Write the keys of each status to the CSV manifest at manifest_paths[status], with
+    key and size columns. move_file, download_file and remove_files take these as
+    --manifest. Source keys are written for changed keys. Returns the number of keys
+    found with each status.
+
+    Keys are written in full, since that is how they are read from the bucket. To move
+    them to the same relative keys in the destination, pass the reconciled source folder
+    as --source-folder-name along with --preserve-structure TRUE; otherwise move_file
+    puts every key directly in the destination folder.
+    """
+    counts = Counter()
+    manifest_files = {}
+    try:
+        writers = {}
+        for status, path in manifest_paths.items():
+            if path:
+                manifest_files[status] = open(path, 'w', newline='')
+                writers[status] = csv.writer(manifest_files[status])
+                writers[status].writerow(['key', 'size'])
+        for difference in differences:
+            counts[difference.status] += 1
+            writer = writers.get(difference.status)
+            if writer:
+                listed_object = difference.source or difference.destination
+                writer.writerow([listed_object.key, listed_object.size])
+    finally:
+        for manifest_file in manifest_files.values():
+            manifest_file.close()
+    return counts
+
+
+@profiling.profiled
+def main():
+    args = get_args()
+    if args.profile:
+        profiling.get_profiler().start(args.profile, args.profile_output)
+    set_environment_variables(args)
+    source_prefix = folder_prefix(args.source_folder_name)
+    destination_prefix = folder_prefix(args.destination_folder_name)
+    manifest_paths = {
+        ONLY_IN_SOURCE: args.only_in_source_manifest,
+        ONLY_IN_DESTINATION: args.only_in_destination_manifest,
+        CHANGED: args.changed_manifest}
+
+    s3_connection = connect_to_s3(
+        args.s3_config, max_pool_connections=args.max_concurrency + 2)
+    print(
+        f'Reconciling {args.source_bucket_name}/{source_prefix} with '
+        f'{args.destination_bucket_name}/{destination_prefix} by {args.compare}...')
+    try:
+        with profiling.phase('reconcile'):
+            counts = write_manifests(
+                reconcile(
+                    s3_connection,
+                    args.source_bucket_name,
+                    source_prefix,
+                    args.destination_bucket_name,
+                    destination_prefix,
+                    compare=args.compare,
+                    max_concurrency=args.max_concurrency),
+                manifest_paths)
+    except ValueError as e:
+        print(f'Error: {e}')
+        sys.exit(ec.EXIT_CODE_UNKNOWN_ERROR)
+    except botocore.exceptions.ClientError as e:
+        print(f'Error: The listings could not be compared. {e}')
+        sys.exit(dict(retries.EXIT_CODE_PRIORITY)[retries.classify_error(e)])
+
+    print(
+        f'{counts[ONLY_IN_SOURCE]} only in source, '
+        f'{counts[ONLY_IN_DESTINATION]} only in destination, '
+        f'{counts[CHANGED]} changed, {counts[UNCHANGED]} unchanged.')
+    for status, path in manifest_paths.items():
+        if path:
+            print(f'{status.replace("_", " ").capitalize()} keys written to {path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -7,11 +7,30 @@ import argparse
 import glob
 from ast import literal_eval
 import sys
+import functools
 import shipyard_utils as shipyard
 try:
     import exit_codes as ec
+    import catalog
+    import concurrency
+    import journal
+    import limiter
+    import manifest
+    import planner
+    import profiling
+    import retries
+    import scheduler
 except BaseException:
     from . import exit_codes as ec
+    from . import catalog
+    from . import concurrency
+    from . import journal
+    from . import limiter
+    from . import manifest
+    from . import planner
+    from . import profiling
+    from . import retries
+    from . import scheduler
 
 
 def get_args():
@@ -28,7 +47,7 @@ def get_args():
     parser.add_argument(
         '--source-file-name',
         dest='source_file_name',
-        required=True)
+        required=False)
     parser.add_argument(
         '--source-folder-name',
         dest='source_folder_name',
@@ -51,7 +70,136 @@ def get_args():
         '--aws-default-region',
         dest='aws_default_region',
         required=False)
-    return parser.parse_args()
+    parser.add_argument(
+        '--max-concurrency',
+        dest='max_concurrency',
+        type=int,
+        default=32,
+        required=False)
+    parser.add_argument(
+        '--max-attempts',
+        dest='max_attempts',
+        type=int,
+        default=5,
+        required=False)
+    parser.add_argument(
+        '--failure-manifest',
+        dest='failure_manifest',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--max-bytes-per-second',
+        dest='max_bytes_per_second',
+        type=float,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--max-requests-per-second',
+        dest='max_requests_per_second',
+        type=float,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--limits-file',
+        dest='limits_file',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--profile',
+        dest='profile',
+        choices=profiling.PROFILE_MODES,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--profile-output',
+        dest='profile_output',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--min-size',
+        dest='min_size',
+        type=int,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--max-size',
+        dest='max_size',
+        type=int,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--modified-after',
+        dest='modified_after',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--modified-before',
+        dest='modified_before',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--manifest',
+        dest='manifest',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--manifest-format',
+        dest='manifest_format',
+        choices=manifest.MANIFEST_FORMATS,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--manifest-chunk-size',
+        dest='manifest_chunk_size',
+        type=int,
+        default=10000,
+        required=False)
+    parser.add_argument(
+        '--journal',
+        dest='journal',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--plan',
+        dest='plan',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--prefix-write-rate',
+        dest='prefix_write_rate',
+        type=float,
+        default=scheduler.DEFAULT_WRITE_RATE,
+        required=False)
+    parser.add_argument(
+        '--prefix-read-rate',
+        dest='prefix_read_rate',
+        type=float,
+        default=scheduler.DEFAULT_READ_RATE,
+        required=False)
+    parser.add_argument(
+        '--prefix-depth',
+        dest='prefix_depth',
+        type=int,
+        default=None,
+        required=False)
+    args = parser.parse_args()
+    if not args.source_file_name and not args.manifest:
+        parser.error('--source-file-name is required unless --manifest is provided')
+    if args.plan and (
+            args.manifest or args.source_file_name_match_type != 'regex_match'):
+        parser.error('--plan requires --source-file-name-match-type regex_match and no --manifest')
+    if (args.min_size, args.max_size, args.modified_after, args.modified_before) != (
+            None, None, None, None) and (
+            args.manifest or args.source_file_name_match_type != 'regex_match'):
+        parser.error(
+            '--min-size, --max-size, --modified-after and --modified-before require '
+            '--source-file-name-match-type regex_match and no --manifest')
+    for modified_time in (args.modified_after, args.modified_before):
+        try:
+            catalog.parse_time(modified_time)
+        except ValueError:
+            parser.error(f'{modified_time} is not an ISO 8601 date or time')
+    return args
 
 
 def set_environment_variables(args):
@@ -69,55 +217,58 @@ def set_environment_variables(args):
     return
 
 
-def connect_to_s3(s3_config=None):
+def connect_to_s3(s3_config=None, max_pool_connections=10):
     """
     Create a connection to the S3 service using credentials provided as environment variables.
     """
-    s3_connection = boto3.client(
-        's3',
-        config=Config(s3_config)
-    )
+    with profiling.phase('credentials'):
+        session = boto3.Session()
+        session.get_credentials()
+    with profiling.phase('connect'):
+        s3_connection = session.client(
+            's3',
+            config=Config(
+                s3_config,
+                max_pool_connections=max_pool_connections,
+                # Only checksums a request asks for, such as --verify-checksums, are sent
+                # or checked; S3-compatible stores may reject the ones boto3 adds by default.
+                request_checksum_calculation='when_required',
+                response_checksum_validation='when_required')
+        )
     return s3_connection
 
 
-def s3_list_files(
-        s3_connection,
-        bucket_name,
-        source_folder,
-        ):
-    """List files in s3"""
-    s3_response = s3_connection.list_objects_v2(Bucket=bucket_name, Prefix=source_folder)
-    files_list =  [
-        _file['Key'] for _file in s3_response['Contents']
-    ]
-    return files_list
-
-
 def remove_s3_file(
         s3_connection,
         bucket_name,
         source_full_path,
+        job_journal=None,
         ):
     """
-    Uploads a single file to S3. Uses the s3.transfer method to ensure that files larger than 5GB are split up during the upload process.
+    Removes a single file from S3. Errors are raised to the caller so they can be
+    classified and retried.
 
-    Extra Args can be found at https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html#the-extraargs-parameter
-    and are commonly used for custom file encryption or permissions.
+    If a job_journal is provided, the removal is recorded in it and files a previous
+    run already removed are skipped.
     """
-    try:
-        s3_response = s3_connection.delete_object(
-            Bucket=bucket_name,
-            Key=source_full_path
-        )
+    if job_journal and job_journal.state(source_full_path) == journal.STATE_DELETED:
+        return
+
+    s3_response = s3_connection.delete_object(
+        Bucket=bucket_name,
+        Key=source_full_path
+    )
+    if job_journal:
+        job_journal.record(source_full_path, journal.STATE_DELETED)
 
-        print(f'{source_full_path} delete function successful')
-    except Exception as e:
-        print(f"Error: {source_full_path} not found in bucket {bucket_name}.")
-        sys.exit(ec.EXIT_CODE_FILE_NOT_FOUND)
+    print(f'{source_full_path} delete function successful')
 
 
+@profiling.profiled
 def main():
     args = get_args()
+    if args.profile:
+        profiling.get_profiler().start(args.profile, args.profile_output)
     set_environment_variables(args)
     bucket_name = args.bucket_name
     source_file_name = args.source_file_name
@@ -128,39 +279,145 @@ def main():
     source_file_name_match_type = args.source_file_name_match_type
     s3_config = args.s3_config
 
-    s3_connection = connect_to_s3(s3_config)
-    if source_file_name_match_type == 'regex_match':
-        file_names = s3_list_files(
-            s3_connection, bucket_name, source_folder_name)
-        ## exit if there is a regex error
+    s3_connection = connect_to_s3(
+        s3_config, max_pool_connections=args.max_concurrency)
+    controller = concurrency.AdaptiveConcurrencyController(
+        max_limit=args.max_concurrency)
+    retry_policy = retries.RetryPolicy(max_attempts=args.max_attempts)
+    controller.observe_client(s3_connection)
+    transfer_limiter = limiter.get_limiter()
+    transfer_limiter.set_limits(
+        args.max_bytes_per_second, args.max_requests_per_second)
+    if args.limits_file:
+        transfer_limiter.watch(args.limits_file)
+    transfer_limiter.attach(s3_connection)
+    prefix_scheduler = scheduler.PrefixScheduler(
+        write_rate=args.prefix_write_rate,
+        read_rate=args.prefix_read_rate,
+        prefix_depth=args.prefix_depth)
+
+    object_filter = None
+    if source_file_name_match_type == 'regex_match' and not args.manifest:
         try:
-            matching_file_names = shipyard.files.find_all_file_matches(
-                file_names, source_file_name)
-            num_matches = len(matching_file_names)
-        except Exception as e:
+            object_filter = catalog.ObjectFilter(
+                source_file_name,
+                min_size=args.min_size,
+                max_size=args.max_size,
+                modified_after=args.modified_after,
+                modified_before=args.modified_before)
+        except re.error:
             print(f"Error in finding regex matches. Please make sure a valid regex is entered")
             sys.exit(ec.EXIT_CODE_INVALID_REGEX)
 
+    if args.plan:
+        run_plan = planner.create_plan(
+            s3_connection,
+            bucket_name,
+            source_folder_name,
+            object_filter,
+            args.plan,
+            planner.RunPlan(
+                planner.OPERATION_REMOVE,
+                journal=bool(args.journal),
+                prefix_depth=args.prefix_depth))
+        run_plan.print_summary(
+            run_plan.measure_latency(s3_connection, bucket_name),
+            args.max_concurrency,
+            args.prefix_write_rate,
+            args.prefix_read_rate)
+        print(f'Plan saved to {args.plan}. Pass it as --manifest to remove exactly these files.')
+        return
+
+    job_journal = None
+    if args.journal:
+        job_journal = journal.JobJournal(args.journal)
+        job_journal.check_job({
+            'bucket_name': bucket_name,
+            'source_folder_name': source_folder_name,
+            'source_file_name': source_file_name,
+            'manifest': args.manifest,
+            'min_size': args.min_size,
+            'max_size': args.max_size,
+            'modified_after': args.modified_after,
+            'modified_before': args.modified_before})
+    resuming = job_journal is not None and job_journal.listing_complete
+
+    if resuming:
+        indexed_file_names = job_journal.pending()
+        num_matches = job_journal.get('num_matches')
+        window_size = args.manifest_chunk_size
+        print(f'Resuming the job recorded in {args.journal}: {job_journal.counts()}')
+
+    elif args.manifest:
+        indexed_file_names = enumerate(profiling.timed('list', manifest.read_manifest(
+            args.manifest,
+            s3_connection=s3_connection,
+            manifest_format=args.manifest_format)), 1)
+        num_matches = None
+        window_size = args.manifest_chunk_size
+        print(f'Reading files to remove from {args.manifest}...')
+
+    elif source_file_name_match_type == 'regex_match':
+        with profiling.phase('list'):
+            object_catalog = catalog.ObjectCatalog.from_listing(
+                s3_connection, bucket_name, source_folder_name)
+        with profiling.phase('match'):
+            matching_indexes = object_catalog.select(object_filter)
+        matching_file_names = object_catalog.keys(matching_indexes)
+        num_matches = len(matching_indexes)
+
         if num_matches == 0:
             print(f'No matches found for regex {source_file_name}')
             sys.exit(1)
         else:
             print(f'{num_matches} files found. Preparing to remove...')
+        indexed_file_names = enumerate(matching_file_names, 1)
+        window_size = args.manifest_chunk_size
+
+    if resuming or args.manifest or source_file_name_match_type == 'regex_match':
+        if job_journal and not resuming:
+            indexed_file_names = job_journal.track(indexed_file_names, num_matches)
 
-        for index, key_name in enumerate(matching_file_names,1):
-            remove_s3_file(
-                source_full_path=key_name,
-                bucket_name=bucket_name,
-                s3_connection=s3_connection
-            )
-            print(f'Removing file {index} of {len(matching_file_names)}')
+        def remove_match(indexed_key_name):
+            index, key_name = indexed_key_name
+            with profiling.phase('delete'):
+                remove_s3_file(
+                    source_full_path=key_name,
+                    bucket_name=bucket_name,
+                    s3_connection=s3_connection,
+                    job_journal=job_journal
+                )
+            print(f'Removing file {index}{f" of {num_matches}" if num_matches else ""}')
+
+        report = retries.OperationReport(
+            key=lambda indexed_key_name: indexed_key_name[1])
+        try:
+            concurrency.run_concurrently(
+                remove_match,
+                prefix_scheduler.schedule(
+                    indexed_file_names,
+                    bucket_name=bucket_name,
+                    operations=('DELETE',),
+                    key=lambda indexed_key_name: indexed_key_name[1],
+                    window_size=window_size),
+                controller=controller,
+                retry_policy=retry_policy,
+                report=report)
+        finally:
+            if job_journal:
+                print(f'Journal {args.journal}: {job_journal.counts()}')
+                job_journal.close()
 
     else:
-        remove_s3_file(
-            source_full_path=source_full_path,
-            bucket_name=bucket_name,
-            s3_connection=s3_connection
-        )
+        report = retries.OperationReport()
+        concurrency.run_concurrently(
+            functools.partial(remove_s3_file, s3_connection, bucket_name),
+            [source_full_path],
+            controller=controller,
+            retry_policy=retry_policy,
+            report=report)
+
+    report.finish(args.failure_manifest)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,224 @@
+import csv
+import heapq
+import random
+import sys
+import threading
+import time
+import botocore.exceptions
+try:
+    import exit_codes as ec
+    import integrity
+except BaseException:
+    from . import exit_codes as ec
+    from . import integrity
+
+
+ERROR_THROTTLING = 'throttling'
+ERROR_TRANSIENT = 'transient'
+ERROR_NOT_FOUND = 'not_found'
+ERROR_ACCESS_DENIED = 'access_denied'
+ERROR_UNKNOWN = 'unknown'
+
+RETRYABLE_ERRORS = {ERROR_THROTTLING, ERROR_TRANSIENT}
+
+THROTTLING_ERROR_CODES = {
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'TooManyRequestsException',
+    'ServiceUnavailable',
+    '503'}
+NOT_FOUND_ERROR_CODES = {'NoSuchKey', 'NoSuchBucket', 'NotFound', '404'}
+ACCESS_DENIED_ERROR_CODES = {
+    'AccessDenied',
+    'AllAccessDisabled',
+    'InvalidAccessKeyId',
+    'SignatureDoesNotMatch',
+    'ExpiredToken',
+    'InvalidToken',
+    '403'}
+TRANSIENT_ERROR_CODES = {
+    'InternalError',
+    'RequestTimeout',
+    'RequestTimeTooSkewed',
+    'BadGateway',
+    'GatewayTimeout',
+    'BadDigest',
+    'XAmzContentSHA256Mismatch',
+    'PreconditionFailed',
+    '412',
+    '500',
+    '502',
+    '504'}
+
+# When several kinds of failures remain, the run exits with the code of the first kind found.
+EXIT_CODE_PRIORITY = [
+    (ERROR_ACCESS_DENIED, ec.EXIT_CODE_INVALID_CREDENTIALS),
+    (ERROR_UNKNOWN, ec.EXIT_CODE_UNKNOWN_ERROR),
+    (ERROR_THROTTLING, ec.EXIT_CODE_RETRIES_EXHAUSTED),
+    (ERROR_TRANSIENT, ec.EXIT_CODE_RETRIES_EXHAUSTED),
+    (ERROR_NOT_FOUND, ec.EXIT_CODE_FILE_NOT_FOUND)]
+
+
+def classify_error(error):
+    """
+    Sort an exception raised while calling S3 into one of the error classes above.
+    """
+    if isinstance(error, (
+            botocore.exceptions.NoCredentialsError,
+            botocore.exceptions.PartialCredentialsError)):
+        return ERROR_ACCESS_DENIED
+    if isinstance(error, (
+            botocore.exceptions.ConnectionError,
+            botocore.exceptions.HTTPClientError,
+            botocore.exceptions.IncompleteReadError,
+            ConnectionError,
+            TimeoutError,
+            integrity.IntegrityError)):
+        return ERROR_TRANSIENT
+
+    response = getattr(error, 'response', None) or {}
+    error_code = str(response.get('Error', {}).get('Code', ''))
+    status_code = str(response.get(
+        'ResponseMetadata', {}).get('HTTPStatusCode', ''))
+    if error_code in THROTTLING_ERROR_CODES or status_code == '503':
+        return ERROR_THROTTLING
+    if error_code in NOT_FOUND_ERROR_CODES or status_code == '404':
+        return ERROR_NOT_FOUND
+    if error_code in ACCESS_DENIED_ERROR_CODES or status_code == '403':
+        return ERROR_ACCESS_DENIED
+    if error_code in TRANSIENT_ERROR_CODES or status_code.startswith('5'):
+        return ERROR_TRANSIENT
+    return ERROR_UNKNOWN
+
+
+class RetryPolicy:
+    """
+    Decides whether a failed item is retried and how long it waits first, using
+    exponential backoff with full jitter.
+    """
+
+    def __init__(self, max_attempts=5, base_delay=0.5, max_delay=30.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, error_class, attempt):
+        """
+        Return whether an item that failed with error_class on its attempt-th try should run again.
+        """
+        return error_class in RETRYABLE_ERRORS and attempt < self.max_attempts
+
+    def backoff_delay(self, attempt):
+        """
+        Return a random delay between 0 and base_delay * 2^attempt, capped at max_delay.
+        """
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class RetryQueue:
+    """
+    Items deferred for a later attempt, ordered by the time they become ready.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, item, attempt, delay):
+        heapq.heappush(
+            self._heap,
+            (time.monotonic() + delay, self._counter, attempt, item))
+        self._counter += 1
+
+    def seconds_until_ready(self):
+        """
+        Return how long until the next item can be retried, or None if the queue is empty.
+        """
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - time.monotonic())
+
+    def pop_ready(self):
+        """
+        Return (item, attempt) for the next item whose delay has passed, or None.
+        """
+        if self._heap and self._heap[0][0] <= time.monotonic():
+            _, _, attempt, item = heapq.heappop(self._heap)
+            return item, attempt
+        return None
+
+
+class OperationReport:
+    """
+    Tally of how every item in a bulk operation ended up, used to pick the exit code
+    and to write a manifest of failed keys for a targeted re-run.
+    """
+
+    def __init__(self, key=None):
+        self.key = key or (lambda item: item)
+        self.succeeded = 0
+        self.retried = 0
+        self.failures = []
+        self._lock = threading.Lock()
+
+    def record_success(self):
+        with self._lock:
+            self.succeeded += 1
+
+    def record_retry(self, item, error_class, error, attempt, delay):
+        with self._lock:
+            self.retried += 1
+        print(
+            f'{self.key(item)} failed with a {error_class} error on attempt {attempt}. '
+            f'Retrying after the remaining files, at least {delay:.1f}s from now.')
+
+    def record_failure(self, item, error_class, error):
+        with self._lock:
+            self.failures.append((self.key(item), error_class, str(error)))
+        print(f'Error: {self.key(item)} failed with a {error_class} error. {error}')
+
+    def exit_code(self):
+        """
+        Map the failures onto exit_codes. Returns 0 when every item succeeded.
+        """
+        failed_classes = {error_class for _, error_class, _ in self.failures}
+        for error_class, exit_code in EXIT_CODE_PRIORITY:
+            if error_class in failed_classes:
+                return exit_code
+        return 0
+
+    def print_summary(self):
+        print(
+            f'{self.succeeded} succeeded, {len(self.failures)} failed, '
+            f'{self.retried} retries attempted.')
+
+    def write_failure_manifest(self, file_path):
+        """
+        Write every failed key to a CSV file. The key is the first column, so the file
+        can be fed straight back in as the list of keys to re-run.
+        """
+        with open(file_path, 'w', newline='') as manifest:
+            writer = csv.writer(manifest)
+            writer.writerow(['key', 'error_class', 'error'])
+            writer.writerows(self.failures)
+        print(f'{len(self.failures)} failed keys written to {file_path}')
+
+    def finish(self, failure_manifest=None):
+        """
+        Print the summary and, if anything failed, write the failure manifest and exit
+        with the matching exit code.
+        """
+        self.print_summary()
+        if not self.failures:
+            return
+        if failure_manifest:
+            self.write_failure_manifest(failure_manifest)
+        sys.exit(self.exit_code())
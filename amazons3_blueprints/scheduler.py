@@ -0,0 +1,204 @@
+import time
+import threading
+from collections import OrderedDict, deque
+from itertools import islice
+
+
+# Documented S3 request rates per partitioned prefix, per second.
+DEFAULT_WRITE_RATE = 3500
+DEFAULT_READ_RATE = 5500
+
+READ_OPERATIONS = {'GET', 'HEAD'}
+WRITE_OPERATIONS = {'PUT', 'COPY', 'POST', 'DELETE'}
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `rate` tokens per second, holding at most
+    `capacity` tokens. A rate of None or 0 never limits.
+
+    acquire() reserves its tokens up front and then sleeps outside of the lock for
+    any deficit, so concurrent callers are served in the order they arrived and
+    pay for a single lock round trip.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self._lock = threading.Lock()
+        self.rate = None
+        self.set_rate(rate, capacity)
+
+    def set_rate(self, rate, capacity=None):
+        """
+        Change the refill rate and capacity. Safe to call while the bucket is in use.
+
+        Tokens left in a limited bucket, or owed by callers that overdrew it, carry over
+        to the new rate, clamped to the new capacity, so a rate change never lets a
+        fresh burst through. A bucket that wasn't limited before starts out full.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.rate is not None:
+                self._refill(now)
+            tokens = self._tokens if self.rate is not None else None
+            self.rate = rate or None
+            self.capacity = capacity or rate or None
+            if tokens is None or self.capacity is None:
+                self._tokens = self.capacity or 0
+            else:
+                self._tokens = min(tokens, self.capacity)
+            self._updated = now
+
+    def _refill(self, now):
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def time_until_available(self, amount=1):
+        """
+        Return how many seconds must pass before `amount` tokens are available.
+        """
+        if self.rate is None:
+            return 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, (min(amount, self.capacity) - self._tokens) / self.rate)
+
+    def try_acquire(self, amount=1):
+        """
+        Take `amount` tokens if they're available right now. Returns whether they were taken.
+        """
+        if self.rate is None:
+            return True
+        with self._lock:
+            self._refill(time.monotonic())
+            amount = min(amount, self.capacity)
+            if self._tokens < amount:
+                return False
+            self._tokens -= amount
+            return True
+
+    def acquire(self, amount=1):
+        """
+        Take `amount` tokens, blocking until the bucket has refilled enough to cover them.
+        """
+        if self.rate is None:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= amount
+            deficit = -self._tokens
+            rate = self.rate
+        if deficit > 0:
+            time.sleep(deficit / rate)
+
+
+def key_prefix(key, prefix_depth=None):
+    """
+    Return the prefix S3 will most likely partition a key under. By default this is
+    everything up to the final '/', otherwise only the first prefix_depth folders are kept.
+    """
+    folders = key.split('/')[:-1]
+    if prefix_depth is not None:
+        folders = folders[:prefix_depth]
+    return ''.join(f'{folder}/' for folder in folders)
+
+
+class PrefixScheduler:
+    """
+    Reorders work so that consecutive requests are spread across key prefixes rather
+    than exhausting one partition at a time, holding each prefix to its own read and
+    write request rate.
+    """
+
+    def __init__(
+            self,
+            write_rate=DEFAULT_WRITE_RATE,
+            read_rate=DEFAULT_READ_RATE,
+            prefix_depth=None):
+        self.write_rate = write_rate
+        self.read_rate = read_rate
+        self.prefix_depth = prefix_depth
+        self._buckets = {}
+
+    def _bucket(self, bucket_name, prefix, operation):
+        # S3 partitions each bucket separately, so equal prefixes in two buckets
+        # don't share a request rate.
+        rate_class = 'read' if operation in READ_OPERATIONS else 'write'
+        bucket = self._buckets.get((bucket_name, prefix, rate_class))
+        if bucket is None:
+            rate = self.read_rate if rate_class == 'read' else self.write_rate
+            # Worker threads may create the same bucket at once; only one is kept.
+            bucket = self._buckets.setdefault(
+                (bucket_name, prefix, rate_class), TokenBucket(rate))
+        return bucket
+
+    def acquire(self, bucket_name, key, operation='PUT'):
+        """
+        Take a token for one operation on the prefix of key in bucket_name, blocking
+        until one is available. Used for requests schedule() doesn't see, such as
+        writes to a destination while the source keys are being scheduled.
+        """
+        self._bucket(bucket_name, key_prefix(key, self.prefix_depth), operation).acquire()
+
+    def schedule(
+            self,
+            work_items,
+            bucket_name='',
+            operations=('PUT',),
+            key=None,
+            window_size=None):
+        """
+        Yield every item in work_items, interleaved round-robin across their key prefixes
+        in bucket_name.
+
+        Each item costs one token per entry in operations from its prefix's read or write
+        bucket. When no prefix has tokens left the generator sleeps until the first one refills.
+        key extracts the S3 key from an item and defaults to the item itself.
+
+        By default all of work_items is read before scheduling starts. With a window_size,
+        items are read and interleaved that many at a time so a streamed source is never
+        held in memory at once.
+        """
+        if key is None:
+            def key(item):
+                return item
+
+        work_items = iter(work_items)
+        while True:
+            window = list(islice(work_items, window_size))
+            if not window:
+                return
+            yield from self._interleave(window, bucket_name, operations, key)
+            if window_size is None:
+                return
+
+    def _interleave(self, work_items, bucket_name, operations, key):
+        queues = OrderedDict()
+        for item in work_items:
+            prefix = key_prefix(key(item), self.prefix_depth)
+            queues.setdefault(prefix, deque()).append(item)
+        print(f'Scheduling {len(work_items)} files across {len(queues)} prefixes')
+
+        active = deque(queues.items())
+        while active:
+            shortest_wait = None
+            for _ in range(len(active)):
+                prefix, items = active[0]
+                active.rotate(-1)
+                buckets = [self._bucket(bucket_name, prefix, operation)
+                           for operation in operations]
+                wait = max(bucket.time_until_available()
+                           for bucket in buckets)
+                if wait > 0:
+                    if shortest_wait is None or wait < shortest_wait:
+                        shortest_wait = wait
+                    continue
+
+                for bucket in buckets:
+                    bucket.try_acquire()
+                yield items.popleft()
+                if not items:
+                    active.pop()
+                break
+            else:
+                time.sleep(shortest_wait)
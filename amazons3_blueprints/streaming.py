@@ -0,0 +1,311 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import integrity
+except BaseException:
+    from . import integrity
+
+
+MEGABYTE = 1024 * 1024
+PART_SIZE = 8 * MEGABYTE
+BUFFER_COUNT = 16
+READ_SIZE = MEGABYTE
+
+
+class BufferPool:
+    """
+    A fixed number of reusable part buffers shared by every stream in the process.
+
+    Taking a buffer blocks while all of them are in use, which caps the memory held by
+    parts in flight at buffer_count * buffer_size and makes readers wait for writers.
+    A part larger than buffer_size, which a verified copy gets when it follows the
+    source's own part boundaries, is given a buffer of its own size instead. That
+    buffer is freed once the part is sent rather than kept in the pool, so only parts
+    in flight can take the memory held past buffer_count * buffer_size.
+    """
+
+    def __init__(self, buffer_count=BUFFER_COUNT, buffer_size=PART_SIZE):
+        self.buffer_count = buffer_count
+        self.buffer_size = buffer_size
+        self._available = threading.Semaphore(buffer_count)
+        self._lock = threading.Lock()
+        self._free = []
+
+    def acquire(self, size):
+        """
+        Return a buffer of at least size bytes, blocking until one is free.
+        """
+        self._available.acquire()
+        with self._lock:
+            for index, buffer in enumerate(self._free):
+                if len(buffer) >= size:
+                    return self._free.pop(index)
+        return bytearray(max(size, self.buffer_size))
+
+    def release(self, buffer):
+        with self._lock:
+            if len(self._free) < self.buffer_count and len(buffer) <= self.buffer_size:
+                self._free.append(buffer)
+        self._available.release()
+
+
+class OrderedChecksum:
+    """
+    Whole-object checksum of parts that are read concurrently. Each part waits until
+    the parts before it were added, so the bytes are hashed in object order.
+    """
+
+    def __init__(self, algorithm):
+        self.checksum = integrity.Checksum(algorithm)
+        self._next_part_number = 1
+        self._aborted = False
+        self._condition = threading.Condition()
+
+    def add(self, part_number, data):
+        with self._condition:
+            while part_number != self._next_part_number and not self._aborted:
+                self._condition.wait()
+            if self._aborted:
+                raise integrity.IntegrityError('An earlier part of the object failed')
+            self.checksum.update(data)
+            self._next_part_number += 1
+            self._condition.notify_all()
+
+    def abort(self):
+        """
+        Stop waiting for parts, because one of them failed and will never be added.
+        """
+        with self._condition:
+            self._aborted = True
+            self._condition.notify_all()
+
+
+class StreamMover:
+    """
+    Copies objects between two S3 connections that can't copy server side, such as
+    different accounts or an AWS bucket and an S3-compatible store, by streaming
+    them through this process without touching local disk.
+
+    Each part is read from the source with a ranged GET into a pooled buffer and
+    written to the destination with UploadPart from that same buffer. Parts of all
+    objects share one pool of buffer_count workers and buffers. So while one part is
+    being uploaded the next ones are already downloading, throughput approaches the
+    slower of the two links, and memory stays capped.
+    """
+
+    def __init__(
+            self,
+            source_client,
+            destination_client,
+            part_size=PART_SIZE,
+            buffer_count=BUFFER_COUNT):
+        self.source_client = source_client
+        self.destination_client = destination_client
+        self.part_size = part_size
+        self.buffers = BufferPool(buffer_count, part_size)
+        self._executor = ThreadPoolExecutor(
+            max_workers=buffer_count, thread_name_prefix='stream')
+
+    def _read_range(self, bucket_name, key_name, etag, byte_range, buffer, checksum):
+        """
+        Read a byte range of the source into buffer, returning a body for the
+        destination request that shares the buffer's memory where possible.
+        """
+        kwargs = {'Range': f'bytes={byte_range[0]}-{byte_range[1]}'} if byte_range else {}
+        body = self.source_client.get_object(
+            Bucket=bucket_name, Key=key_name, IfMatch=f'"{etag}"', **kwargs)['Body']
+        view = memoryview(buffer)
+        length = 0
+        while True:
+            chunk = body.read(READ_SIZE)
+            if not chunk:
+                break
+            view[length:length + len(chunk)] = chunk
+            length += len(chunk)
+        if byte_range and length != byte_range[1] - byte_range[0] + 1:
+            raise integrity.IntegrityError(
+                f'{bucket_name}/{key_name}: expected {byte_range[1] - byte_range[0] + 1} '
+                f'bytes from {byte_range[0]} but received {length}')
+        data = buffer if length == len(buffer) else bytes(view[:length])
+        if checksum is not None:
+            checksum.update(data)
+        return data
+
+    def _transfer_part(
+            self,
+            source_bucket_name,
+            source_key_name,
+            etag,
+            destination_bucket_name,
+            destination_key_name,
+            upload_id,
+            part_number,
+            byte_range,
+            buffer,
+            algorithm,
+            whole_object,
+            failed):
+        try:
+            checksum = integrity.Checksum(algorithm) if algorithm else None
+            data = self._read_range(
+                source_bucket_name, source_key_name, etag, byte_range, buffer, checksum)
+            if whole_object is not None:
+                whole_object.add(part_number, data)
+            checksum_args = {
+                f'Checksum{algorithm}': checksum.encoded()} if checksum else {}
+            response = self.destination_client.upload_part(
+                Bucket=destination_bucket_name,
+                Key=destination_key_name,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=data,
+                **checksum_args)
+            return dict(
+                {'ETag': response['ETag'], 'PartNumber': part_number}, **checksum_args)
+        except BaseException:
+            failed.set()
+            if whole_object is not None:
+                whole_object.abort()
+            raise
+        finally:
+            self.buffers.release(buffer)
+
+    def copy(
+            self,
+            source_bucket_name,
+            source_key_name,
+            destination_bucket_name,
+            destination_key_name,
+            verify_checksums=False):
+        """
+        Stream one object from the source to the destination.
+
+        With verify_checksums, parts follow the source's own part boundaries and each
+        is sent with a checksum in the source's algorithm, so the destination rejects
+        corrupted parts and stores a checksum that integrity.verify_copy can compare.
+
+        A single part source with a SHA checksum, or with no checksum but an ETag that
+        is the MD5 of its contents, is re-split into parts whose composite checksum
+        and ETag can't be compared to it. So the whole object is also hashed in that
+        algorithm as it streams, and the upload is aborted with IntegrityError if it
+        doesn't match. Returns whether the contents were checked this way, in which
+        case integrity.verify_copy needn't compare them again.
+        """
+        head = self.source_client.head_object(
+            Bucket=source_bucket_name, Key=source_key_name)
+        size = head['ContentLength']
+        etag = head['ETag'].strip('"')
+        properties = {
+            name: head[name] for name in integrity.COPIED_PROPERTIES if head.get(name)}
+
+        algorithm = None
+        byte_ranges = None
+        full_object_checksum = None
+        whole_object_algorithm = expected_checksum = None
+        if verify_checksums:
+            source = integrity.get_object_checksum(
+                self.source_client, source_bucket_name, source_key_name)
+            algorithm = source.algorithm or integrity.DEFAULT_CHECKSUM_ALGORITHM
+            if not integrity.algorithm_available(algorithm):
+                algorithm = integrity.DEFAULT_CHECKSUM_ALGORITHM
+            if source.parts_count > 1:
+                byte_ranges = source.byte_ranges(
+                    self.source_client, source_bucket_name, source_key_name)
+            if (source.is_full_object and source.algorithm == algorithm
+                    and algorithm in integrity.CRC_POLYNOMIALS):
+                # CRCs of re-split parts still combine into the source's full object CRC.
+                full_object_checksum = source.checksum
+            elif source.parts_count <= 1 and source.algorithm == algorithm:
+                whole_object_algorithm, expected_checksum = algorithm, source.checksum
+            elif source.parts_count <= 1 and not integrity.etag_is_encrypted(head):
+                # The ETag of an unencrypted single part object is the MD5 of its contents.
+                whole_object_algorithm, expected_checksum = 'MD5', etag
+        if byte_ranges is None:
+            part_size = max(self.part_size, -(-size // integrity.MAX_PARTS))
+            byte_ranges = [
+                (start, min(start + part_size, size) - 1)
+                for start in range(0, size, part_size)]
+
+        if len(byte_ranges) <= 1:
+            buffer = self.buffers.acquire(size)
+            try:
+                checksum = integrity.Checksum(algorithm) if algorithm else None
+                data = self._read_range(
+                    source_bucket_name,
+                    source_key_name,
+                    etag,
+                    None,
+                    buffer,
+                    checksum) if size else b''
+                checksum_args = {
+                    f'Checksum{algorithm}': checksum.encoded()} if checksum else {}
+                self.destination_client.put_object(
+                    Bucket=destination_bucket_name,
+                    Key=destination_key_name,
+                    Body=data,
+                    **checksum_args,
+                    **properties)
+            finally:
+                self.buffers.release(buffer)
+            return False
+
+        checksum_args = {'ChecksumAlgorithm': algorithm} if algorithm else {}
+        complete_args = {}
+        if full_object_checksum:
+            checksum_args['ChecksumType'] = 'FULL_OBJECT'
+            complete_args = {
+                'ChecksumType': 'FULL_OBJECT',
+                f'Checksum{algorithm}': full_object_checksum}
+        upload_id = self.destination_client.create_multipart_upload(
+            Bucket=destination_bucket_name,
+            Key=destination_key_name,
+            **checksum_args,
+            **properties)['UploadId']
+        failed = threading.Event()
+        whole_object = OrderedChecksum(
+            whole_object_algorithm) if whole_object_algorithm else None
+        submitted = []
+        try:
+            for part_number, byte_range in enumerate(byte_ranges, 1):
+                # Blocks while every buffer is in flight, so reads never run ahead of writes.
+                buffer = self.buffers.acquire(byte_range[1] - byte_range[0] + 1)
+                future = self._executor.submit(
+                    self._transfer_part,
+                    source_bucket_name,
+                    source_key_name,
+                    etag,
+                    destination_bucket_name,
+                    destination_key_name,
+                    upload_id,
+                    part_number,
+                    byte_range,
+                    buffer,
+                    algorithm,
+                    whole_object,
+                    failed)
+                submitted.append((future, buffer))
+                if failed.is_set():
+                    break
+            parts = [future.result() for future, _ in submitted]
+            if whole_object is not None and whole_object.checksum.encoded() != expected_checksum:
+                raise integrity.IntegrityError(
+                    f'{destination_bucket_name}/{destination_key_name}: '
+                    f'{whole_object_algorithm} mismatch, expected {expected_checksum} '
+                    f'but got {whole_object.checksum.encoded()}')
+            self.destination_client.complete_multipart_upload(
+                Bucket=destination_bucket_name,
+                Key=destination_key_name,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts},
+                **complete_args)
+        except BaseException:
+            for future, buffer in submitted:
+                # Parts that never started still hold their buffer.
+                if future.cancel():
+                    self.buffers.release(buffer)
+            self.destination_client.abort_multipart_upload(
+                Bucket=destination_bucket_name,
+                Key=destination_key_name,
+                UploadId=upload_id)
+            raise
+        return whole_object is not None
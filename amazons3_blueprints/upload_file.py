@@ -7,6 +7,20 @@ import argparse
 import glob
 from ast import literal_eval
 import sys
+try:
+    import concurrency
+    import dedup
+    import integrity
+    import limiter
+    import profiling
+    import retries
+except BaseException:
+    from . import concurrency
+    from . import dedup
+    from . import integrity
+    from . import limiter
+    from . import profiling
+    from . import retries
 
 
 def get_args():
@@ -56,11 +70,80 @@ def get_args():
         '--aws-default-region',
         dest='aws_default_region',
         required=False)
+    parser.add_argument(
+        '--max-concurrency',
+        dest='max_concurrency',
+        type=int,
+        default=32,
+        required=False)
+    parser.add_argument(
+        '--max-attempts',
+        dest='max_attempts',
+        type=int,
+        default=5,
+        required=False)
+    parser.add_argument(
+        '--failure-manifest',
+        dest='failure_manifest',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--max-bytes-per-second',
+        dest='max_bytes_per_second',
+        type=float,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--max-requests-per-second',
+        dest='max_requests_per_second',
+        type=float,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--limits-file',
+        dest='limits_file',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--profile',
+        dest='profile',
+        choices=profiling.PROFILE_MODES,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--profile-output',
+        dest='profile_output',
+        default=None,
+        required=False)
     parser.add_argument(
         '--extra-args',
         dest='extra_args',
         required=False)
-    return parser.parse_args()
+    parser.add_argument(
+        '--checksum-algorithm',
+        dest='checksum_algorithm',
+        choices=integrity.CHECKSUM_ALGORITHMS,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--dedup-index',
+        dest='dedup_index',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--dedup-manifest',
+        dest='dedup_manifest',
+        default=None,
+        required=False)
+    args = parser.parse_args()
+    if args.dedup_manifest and not args.dedup_index:
+        parser.error('--dedup-manifest requires --dedup-index')
+    if args.dedup_manifest and not args.dedup_manifest.startswith('s3://'):
+        parser.error('--dedup-manifest must be an s3://bucket/key url')
+    if args.checksum_algorithm and not integrity.algorithm_available(
+            args.checksum_algorithm):
+        parser.error(integrity.missing_package_message(args.checksum_algorithm))
+    return args
 
 
 def set_environment_variables(args):
@@ -78,14 +161,24 @@ def set_environment_variables(args):
     return
 
 
-def connect_to_s3(s3_config=None):
+def connect_to_s3(s3_config=None, max_pool_connections=10):
     """
     Create a connection to the S3 service using credentials provided as environment variables.
     """
-    s3_connection = boto3.client(
-        's3',
-        config=Config(s3_config)
-    )
+    with profiling.phase('credentials'):
+        session = boto3.Session()
+        session.get_credentials()
+    with profiling.phase('connect'):
+        s3_connection = session.client(
+            's3',
+            config=Config(
+                s3_config,
+                max_pool_connections=max_pool_connections,
+                # Only checksums a request asks for, such as --verify-checksums, are sent
+                # or checked; S3-compatible stores may reject the ones boto3 adds by default.
+                request_checksum_calculation='when_required',
+                response_checksum_validation='when_required')
+        )
     return s3_connection
 
 
@@ -199,26 +292,100 @@ def upload_s3_file(
         bucket_name,
         source_full_path,
         destination_full_path,
-        extra_args=None):
+        extra_args=None,
+        checksum_algorithm=None,
+        content_index=None):
     """
     Uploads a single file to S3. Uses the s3.transfer method to ensure that files larger than 5GB are split up during the upload process.
 
     Extra Args can be found at https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html#the-extraargs-parameter
     and are commonly used for custom file encryption or permissions.
-    """
-    s3_upload_config = boto3.s3.transfer.TransferConfig()
-    s3_transfer = boto3.s3.transfer.S3Transfer(
-        client=s3_connection, config=s3_upload_config)
 
-    s3_transfer.upload_file(source_full_path, bucket_name,
-                            destination_full_path, extra_args=extra_args)
+    With a checksum_algorithm, every part is sent with its checksum and the checksum S3
+    stores for the object is compared with the one computed locally.
 
-    print(f'{source_full_path} successfully uploaded to {bucket_name}/{destination_full_path}')
+    With a content_index, a file whose content is already in S3 is copied server side
+    from the existing object instead of being uploaded again.
+    """
+    def send():
+        if checksum_algorithm:
+            integrity.upload_verified(
+                s3_connection,
+                source_full_path,
+                bucket_name,
+                destination_full_path,
+                checksum_algorithm,
+                extra_args=extra_args)
+            return
+        s3_upload_config = concurrency.transfer_config()
+        s3_transfer = boto3.s3.transfer.S3Transfer(
+            client=s3_connection, config=s3_upload_config)
+        s3_transfer.upload_file(source_full_path, bucket_name,
+                                destination_full_path, extra_args=extra_args)
+
+    verified = ' and verified' if checksum_algorithm else ''
+    if content_index is None:
+        send()
+        print(f'{source_full_path} successfully uploaded to {bucket_name}/{destination_full_path}{verified}')
+        return
+
+    result = dedup.deduplicated_upload(
+        s3_connection,
+        content_index,
+        source_full_path,
+        bucket_name,
+        destination_full_path,
+        send,
+        extra_args=extra_args,
+        checksum_algorithm=checksum_algorithm)
+    if result == dedup.RESULT_COPIED:
+        print(f'{source_full_path} already in S3, copied to {bucket_name}/{destination_full_path}{verified}')
+    elif result == dedup.RESULT_UNCHANGED:
+        print(f'{source_full_path} is unchanged at {bucket_name}/{destination_full_path}')
+    else:
+        print(f'{source_full_path} successfully uploaded to {bucket_name}/{destination_full_path}{verified}')
 
 
+@profiling.profiled
 def main():
     args = get_args()
+    if args.profile:
+        profiling.get_profiler().start(args.profile, args.profile_output)
     set_environment_variables(args)
+
+    s3_connection = connect_to_s3(
+        args.s3_config,
+        max_pool_connections=args.max_concurrency + integrity.PART_CONCURRENCY)
+    controller = concurrency.AdaptiveConcurrencyController(
+        max_limit=args.max_concurrency)
+    retry_policy = retries.RetryPolicy(max_attempts=args.max_attempts)
+    controller.observe_client(s3_connection)
+    transfer_limiter = limiter.get_limiter()
+    transfer_limiter.set_limits(
+        args.max_bytes_per_second, args.max_requests_per_second)
+    if args.limits_file:
+        transfer_limiter.watch(args.limits_file)
+    transfer_limiter.attach(s3_connection)
+    content_index = None
+    if args.dedup_index:
+        content_index = dedup.ContentIndex(args.dedup_index)
+        if args.dedup_manifest:
+            content_index.load_manifest(s3_connection, args.dedup_manifest)
+
+    try:
+        upload_files(args, s3_connection, controller, retry_policy, content_index)
+    finally:
+        if content_index is not None:
+            if args.dedup_manifest:
+                content_index.save_manifest(s3_connection, args.dedup_manifest)
+            content_index.print_summary()
+            content_index.close()
+
+
+def upload_files(args, s3_connection, controller, retry_policy, content_index):
+    """
+    Upload the file, or every file matching the regex, named by the arguments.
+    """
     bucket_name = args.bucket_name
     source_file_name = args.source_file_name
     source_folder_name = args.source_folder_name
@@ -227,15 +394,14 @@ def main():
         file_name=source_file_name)
     destination_folder_name = clean_folder_name(args.destination_folder_name)
     source_file_name_match_type = args.source_file_name_match_type
-    s3_config = args.s3_config
     extra_args = literal_eval(args.extra_args if args.extra_args else '{}')
 
-    s3_connection = connect_to_s3(s3_config)
-
     if source_file_name_match_type == 'regex_match':
-        file_names = find_all_local_file_names(source_folder_name)
-        matching_file_names = find_all_file_matches(
-            file_names, re.compile(source_file_name))
+        with profiling.phase('list'):
+            file_names = find_all_local_file_names(source_folder_name)
+        with profiling.phase('match'):
+            matching_file_names = find_all_file_matches(
+                file_names, re.compile(source_file_name))
         num_matches = len(matching_file_names)
 
         if num_matches == 0:
@@ -244,31 +410,49 @@ def main():
         else:
             print(f'{num_matches} files found. Preparing to upload...')
 
-        for index, key_name in enumerate(matching_file_names):
-            destination_full_path = determine_destination_full_path(
-                destination_folder_name=destination_folder_name,
-                destination_file_name=args.destination_file_name,
-                source_full_path=key_name,
-                file_number=None if num_matches == 1 else index + 1)
-            print(f'Uploading file {index+1} of {len(matching_file_names)}')
-            upload_s3_file(
-                source_full_path=key_name,
-                destination_full_path=destination_full_path,
-                bucket_name=bucket_name,
-                extra_args=extra_args,
-                s3_connection=s3_connection)
+        def upload_match(indexed_key_name):
+            index, key_name = indexed_key_name
+            with profiling.phase('destination names'):
+                destination_full_path = determine_destination_full_path(
+                    destination_folder_name=destination_folder_name,
+                    destination_file_name=args.destination_file_name,
+                    source_full_path=key_name,
+                    file_number=None if num_matches == 1 else index)
+            print(f'Uploading file {index} of {num_matches}')
+            with profiling.phase('transfer'):
+                upload_s3_file(
+                    source_full_path=key_name,
+                    destination_full_path=destination_full_path,
+                    bucket_name=bucket_name,
+                    extra_args=extra_args,
+                    s3_connection=s3_connection,
+                    checksum_algorithm=args.checksum_algorithm,
+                    content_index=content_index)
+
+        report = retries.OperationReport(
+            key=lambda indexed_key_name: indexed_key_name[1])
+        concurrency.run_concurrently(
+            upload_match,
+            enumerate(matching_file_names, 1),
+            controller=controller,
+            retry_policy=retry_policy,
+            report=report)
+        report.finish(args.failure_manifest)
 
     else:
         destination_full_path = determine_destination_full_path(
             destination_folder_name=destination_folder_name,
             destination_file_name=args.destination_file_name,
             source_full_path=source_full_path)
-        upload_s3_file(
-            source_full_path=source_full_path,
-            destination_full_path=destination_full_path,
-            bucket_name=bucket_name,
-            extra_args=extra_args,
-            s3_connection=s3_connection)
+        with profiling.phase('transfer'):
+            upload_s3_file(
+                source_full_path=source_full_path,
+                destination_full_path=destination_full_path,
+                bucket_name=bucket_name,
+                extra_args=extra_args,
+                s3_connection=s3_connection,
+                checksum_algorithm=args.checksum_algorithm,
+                content_index=content_index)
 
 
 if __name__ == '__main__':
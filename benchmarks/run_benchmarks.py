@@ -0,0 +1,330 @@
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import boto3
+from s3_server import LocalS3Server
+
+
+BLUEPRINTS_FOLDER = os.path.join(REPO_ROOT, 'amazons3_blueprints')
+RUN_BLUEPRINT = os.path.join(os.path.dirname(__file__), 'run_blueprint.py')
+MEGABYTE = 1024 * 1024
+
+DATASETS = {
+    'tiny_objects': {'count': 2000, 'size': 1024, 'depth': 1},
+    'huge_objects': {'count': 3, 'size': 64 * MEGABYTE, 'depth': 1},
+    'deep_prefixes': {'count': 1000, 'size': 4096, 'depth': 8},
+}
+BLUEPRINTS = ['download_file', 'upload_file', 'move_file', 'remove_files']
+
+# Metrics compared against the baseline, and whether a higher value is an improvement.
+COMPARED_METRICS = {
+    'objects_per_second': True,
+    'megabytes_per_second': True,
+    'total_requests': False,
+    'peak_rss_megabytes': False,
+    'cpu_seconds': False,
+}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the blueprints against a local S3-compatible server.')
+    parser.add_argument(
+        '--blueprints',
+        dest='blueprints',
+        nargs='+',
+        choices=BLUEPRINTS,
+        default=BLUEPRINTS,
+        required=False)
+    parser.add_argument(
+        '--datasets',
+        dest='datasets',
+        nargs='+',
+        choices=sorted(DATASETS),
+        default=sorted(DATASETS),
+        required=False)
+    parser.add_argument(
+        '--scale',
+        dest='scale',
+        type=float,
+        default=1.0,
+        required=False)
+    parser.add_argument(
+        '--latency-ms',
+        dest='latency_ms',
+        type=float,
+        default=0.0,
+        required=False)
+    parser.add_argument(
+        '--bandwidth-mbps',
+        dest='bandwidth_mbps',
+        type=float,
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--blueprint-args',
+        dest='blueprint_args',
+        default='',
+        required=False)
+    parser.add_argument(
+        '--output',
+        dest='output',
+        default='bench_output.json',
+        required=False)
+    parser.add_argument(
+        '--baseline',
+        dest='baseline',
+        default=None,
+        required=False)
+    parser.add_argument(
+        '--threshold',
+        dest='threshold',
+        type=float,
+        default=0.2,
+        required=False)
+    return parser.parse_args()
+
+
+def dataset_keys(dataset, scale=1.0):
+    """
+    Return the (key, size) pairs of a synthetic dataset. Keys are spread over a tree of
+    folders `depth` levels deep with a fan out of 4 per level.
+    """
+    count = max(1, int(dataset['count'] * scale))
+    keys = []
+    for index in range(count):
+        folders = [
+            f'level{level}-{(index >> (2 * level)) % 4}'
+            for level in range(dataset['depth'])]
+        keys.append(
+            ('/'.join(['bench'] + folders + [f'object_{index}.bin']), dataset['size']))
+    return keys
+
+
+def object_body(size):
+    block = os.urandom(min(size, MEGABYTE))
+    return (block * (size // len(block) + 1))[:size]
+
+
+def seed_bucket(s3_client, bucket_name, keys):
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(
+            lambda key_size: s3_client.put_object(
+                Bucket=bucket_name, Key=key_size[0], Body=object_body(key_size[1])),
+            keys))
+
+
+def seed_folder(folder_name, keys):
+    for key, size in keys:
+        local_path = os.path.join(folder_name, key)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, 'wb') as local_file:
+            local_file.write(object_body(size))
+
+
+def empty_bucket(s3_client, bucket_name):
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name):
+        objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if objects:
+            s3_client.delete_objects(
+                Bucket=bucket_name, Delete={'Objects': objects})
+    s3_client.delete_bucket(Bucket=bucket_name)
+
+
+def blueprint_arguments(blueprint, bucket_name):
+    """
+    Arguments that make each blueprint act on every object in the dataset.
+    """
+    if blueprint == 'download_file':
+        return ['--bucket-name', bucket_name, '--source-folder-name', 'bench',
+                '--source-file-name-match-type', 'regex_match',
+                '--source-file-name', 'object_', '--destination-folder-name', 'downloads']
+    if blueprint == 'upload_file':
+        return ['--bucket-name', bucket_name, '--source-folder-name', 'bench',
+                '--source-file-name-match-type', 'regex_match',
+                '--source-file-name', 'object_', '--destination-folder-name', 'uploads']
+    if blueprint == 'move_file':
+        return ['--source-bucket-name', bucket_name,
+                '--destination-bucket-name', f'{bucket_name}-destination',
+                '--source-folder-name', 'bench',
+                '--source-file-name-match-type', 'regex_match',
+                '--source-file-name', 'object_', '--destination-folder-name', 'moved']
+    return ['--bucket-name', bucket_name, '--source-folder-name', 'bench',
+            '--source-file-name-match-type', 'regex_match', '--source-file-name', 'object_']
+
+
+def run_blueprint(server, blueprint, arguments, working_folder):
+    """
+    Run one blueprint in a child process and return its wall time and resource usage.
+    """
+    stats_path = os.path.join(working_folder, 'blueprint_stats.json')
+    environment = dict(
+        os.environ,
+        AWS_ACCESS_KEY_ID='benchmark',
+        AWS_SECRET_ACCESS_KEY='benchmark',
+        AWS_DEFAULT_REGION='us-east-1',
+        BENCHMARK_STATS_PATH=stats_path)
+    command = [
+        sys.executable, RUN_BLUEPRINT, server.endpoint_url,
+        os.path.join(BLUEPRINTS_FOLDER, f'{blueprint}.py')] + arguments
+
+    start = time.perf_counter()
+    with open(os.path.join(working_folder, 'blueprint.log'), 'wb') as log:
+        process = subprocess.Popen(
+            command, cwd=working_folder, env=environment,
+            stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+    wall_seconds = time.perf_counter() - start
+    exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+    try:
+        with open(stats_path) as stats_file:
+            peak_rss_bytes = json.load(stats_file)['peak_rss_bytes']
+    except (OSError, ValueError):
+        peak_rss_bytes = 0
+    return {
+        'exit_code': exit_code,
+        'wall_seconds': wall_seconds,
+        'cpu_seconds': usage.ru_utime + usage.ru_stime,
+        'peak_rss_megabytes': peak_rss_bytes / MEGABYTE,
+    }
+
+
+def run_scenario(server, s3_client, blueprint, dataset_name, args):
+    """
+    Seed the server or local folder with a dataset, run a blueprint over it and return
+    its throughput, request counts and resource usage.
+    """
+    keys = dataset_keys(DATASETS[dataset_name], args.scale)
+    bucket_name = f'bench-{blueprint.replace("_", "-")}-{dataset_name.replace("_", "-")}'
+    working_folder = tempfile.mkdtemp(prefix='amazons3-benchmark-')
+    buckets = [bucket_name]
+    if blueprint == 'move_file':
+        buckets.append(f'{bucket_name}-destination')
+    try:
+        for bucket in buckets:
+            s3_client.create_bucket(Bucket=bucket)
+        if blueprint == 'upload_file':
+            seed_folder(working_folder, keys)
+        else:
+            seed_bucket(s3_client, bucket_name, keys)
+
+        server.reset_counts()
+        result = run_blueprint(
+            server,
+            blueprint,
+            blueprint_arguments(blueprint, bucket_name) + shlex.split(args.blueprint_args),
+            working_folder)
+        request_counts = server.request_counts
+    finally:
+        for bucket in buckets:
+            empty_bucket(s3_client, bucket)
+        shutil.rmtree(working_folder, ignore_errors=True)
+
+    total_bytes = sum(size for _, size in keys)
+    result.update({
+        'objects': len(keys),
+        'bytes': total_bytes,
+        'objects_per_second': len(keys) / result['wall_seconds'],
+        'megabytes_per_second': total_bytes / MEGABYTE / result['wall_seconds'],
+        'request_counts': request_counts,
+        'total_requests': sum(request_counts.values()),
+    })
+    return result
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """
+    Return a description of every metric that got worse than the baseline by more
+    than the threshold, as a fraction of the baseline value.
+    """
+    regressions = []
+    for scenario, metrics in results.items():
+        baseline_metrics = baseline.get('results', {}).get(scenario)
+        if not baseline_metrics:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            before, after = baseline_metrics.get(metric), metrics.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append(
+                    f'{scenario} {metric}: {before:.2f} -> {after:.2f} ({change:+.0%})')
+    return regressions
+
+
+def main():
+    args = get_args()
+    server = LocalS3Server(
+        latency=args.latency_ms / 1000,
+        bandwidth=args.bandwidth_mbps * MEGABYTE if args.bandwidth_mbps else None).start()
+    s3_client = boto3.client(
+        's3',
+        endpoint_url=server.endpoint_url,
+        aws_access_key_id='benchmark',
+        aws_secret_access_key='benchmark',
+        region_name='us-east-1')
+
+    results = {}
+    try:
+        for dataset_name in args.datasets:
+            for blueprint in args.blueprints:
+                scenario = f'{blueprint}/{dataset_name}'
+                print(f'Running {scenario}...')
+                result = run_scenario(server, s3_client, blueprint, dataset_name, args)
+                results[scenario] = result
+                print(
+                    f'{scenario}: {result["objects_per_second"]:.1f} objects/s, '
+                    f'{result["megabytes_per_second"]:.1f} MB/s, '
+                    f'{result["total_requests"]} requests, '
+                    f'{result["peak_rss_megabytes"]:.0f} MB peak RSS, '
+                    f'{result["cpu_seconds"]:.2f}s CPU, exit code {result["exit_code"]}')
+    finally:
+        server.stop()
+
+    with open(args.output, 'w') as output:
+        json.dump({
+            'settings': {
+                'scale': args.scale,
+                'latency_ms': args.latency_ms,
+                'bandwidth_mbps': args.bandwidth_mbps,
+                'blueprint_args': args.blueprint_args,
+                'python': platform.python_version(),
+            },
+            'results': results,
+        }, output, indent=2, sort_keys=True)
+    print(f'Results written to {args.output}')
+
+    failed = [scenario for scenario, result in results.items() if result['exit_code']]
+    if failed:
+        print(f'Error: {", ".join(failed)} exited with a non-zero exit code.')
+        sys.exit(1)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_to_baseline(
+                results, json.load(baseline_file), args.threshold)
+        if regressions:
+            print(f'{len(regressions)} metrics regressed by more than {args.threshold:.0%}:')
+            for regression in regressions:
+                print(f'  {regression}')
+            sys.exit(1)
+        print(f'No metrics regressed by more than {args.threshold:.0%}.')
+
+
+if __name__ == '__main__':
+    main()
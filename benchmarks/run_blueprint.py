@@ -0,0 +1,64 @@
+import os
+import json
+import atexit
+import resource
+import platform
+import runpy
+import sys
+import botocore.session
+
+
+def point_clients_at(endpoint_url):
+    """
+    Make every S3 client created in this process default to endpoint_url.
+    """
+    create_client = botocore.session.Session.create_client
+
+    def create_client_with_endpoint(self, service_name, *args, **kwargs):
+        if service_name == 's3' and not kwargs.get('endpoint_url'):
+            kwargs['endpoint_url'] = endpoint_url
+        return create_client(self, service_name, *args, **kwargs)
+
+    botocore.session.Session.create_client = create_client_with_endpoint
+
+
+def peak_rss_bytes():
+    """
+    Return the peak resident set size of this process since it started running Python.
+    VmHWM is used where available because, unlike ru_maxrss, it isn't inherited from the
+    parent process that forked this one.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS.
+    rss_unit = 1 if platform.system() == 'Darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit
+
+
+def write_stats(stats_path):
+    with open(stats_path, 'w') as stats_file:
+        json.dump({'peak_rss_bytes': peak_rss_bytes()}, stats_file)
+
+
+def main():
+    """
+    Run a blueprint script against a different S3 endpoint, without changing the blueprint.
+
+        python benchmarks/run_blueprint.py <endpoint_url> <blueprint_path> [blueprint arguments...]
+    """
+    endpoint_url, blueprint_path = sys.argv[1], sys.argv[2]
+    point_clients_at(endpoint_url)
+    if os.environ.get('BENCHMARK_STATS_PATH'):
+        atexit.register(write_stats, os.environ['BENCHMARK_STATS_PATH'])
+    sys.argv = [blueprint_path] + sys.argv[3:]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(blueprint_path)))
+    runpy.run_path(blueprint_path, run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+from werkzeug.serving import make_server, WSGIRequestHandler
+from moto.server import DomainDispatcherApplication, create_backend_app
+from amazons3_blueprints.scheduler import TokenBucket
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def classify_request(environ):
+    """
+    Name the S3 API operation an incoming request is calling.
+    """
+    method = environ['REQUEST_METHOD']
+    query = parse_qs(environ.get('QUERY_STRING', ''), keep_blank_values=True)
+    path = environ.get('PATH_INFO', '/').strip('/')
+    is_bucket_request = '/' not in path
+
+    if method == 'GET':
+        if is_bucket_request:
+            return 'ListObjectsV2' if 'list-type' in query else 'ListObjects'
+        return 'GetObject'
+    if method == 'HEAD':
+        return 'HeadBucket' if is_bucket_request else 'HeadObject'
+    if method == 'PUT':
+        if is_bucket_request:
+            return 'CreateBucket'
+        is_copy = 'HTTP_X_AMZ_COPY_SOURCE' in environ
+        if 'partNumber' in query:
+            return 'UploadPartCopy' if is_copy else 'UploadPart'
+        return 'CopyObject' if is_copy else 'PutObject'
+    if method == 'POST':
+        if 'delete' in query:
+            return 'DeleteObjects'
+        if 'uploads' in query:
+            return 'CreateMultipartUpload'
+        if 'uploadId' in query:
+            return 'CompleteMultipartUpload'
+        return 'Post'
+    if method == 'DELETE':
+        if 'uploadId' in query:
+            return 'AbortMultipartUpload'
+        return 'DeleteBucket' if is_bucket_request else 'DeleteObject'
+    return method
+
+
+class ThrottledInput:
+    """
+    Request body stream that draws from the link's bandwidth as it is read.
+    """
+
+    def __init__(self, stream, link):
+        self._stream = stream
+        self._link = link
+
+    def read(self, *args):
+        data = self._stream.read(*args)
+        self._link.acquire(len(data))
+        return data
+
+    def readline(self, *args):
+        data = self._stream.readline(*args)
+        self._link.acquire(len(data))
+        return data
+
+    def __iter__(self):
+        for line in self._stream:
+            self._link.acquire(len(line))
+            yield line
+
+
+class LinkSimulator:
+    """
+    WSGI middleware that delays every request by a fixed latency, shares a fixed
+    bandwidth between all request and response bodies, and counts requests per
+    S3 operation.
+    """
+
+    def __init__(self, app, latency=0.0, bandwidth=None):
+        self.app = app
+        self.latency = latency
+        self.link = TokenBucket(bandwidth)
+        self.request_counts = Counter()
+        self._lock = threading.Lock()
+
+    def reset_counts(self):
+        with self._lock:
+            self.request_counts = Counter()
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            self.request_counts[classify_request(environ)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.link.rate is not None:
+            environ['wsgi.input'] = ThrottledInput(environ['wsgi.input'], self.link)
+            return self._throttled_response(self.app(environ, start_response))
+        return self.app(environ, start_response)
+
+    def _throttled_response(self, response):
+        try:
+            for chunk in response:
+                for start in range(0, len(chunk), CHUNK_SIZE):
+                    piece = chunk[start:start + CHUNK_SIZE]
+                    self.link.acquire(len(piece))
+                    yield piece
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class LocalS3Server:
+    """
+    An S3-compatible server backed by moto, running on a background thread of the
+    current process, with simulated latency in seconds and bandwidth in bytes per second.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, host='127.0.0.1'):
+        self.simulator = LinkSimulator(
+            DomainDispatcherApplication(create_backend_app),
+            latency=latency,
+            bandwidth=bandwidth)
+        self._server = make_server(
+            host, 0, self.simulator, threaded=True,
+            request_handler=QuietRequestHandler)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+
+    @property
+    def endpoint_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def request_counts(self):
+        return dict(self.simulator.request_counts)
+
+    def reset_counts(self):
+        self.simulator.reset_counts()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._thread.join()
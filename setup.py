@@ -3,13 +3,13 @@ from pkg_resources import parse_requirements
 from setuptools import find_packages, setup
 
 
-for path in Path('./').rglob('requirements.txt'):
-    with Path(path).open() as requirements_txt:
-        install_requires = [
-            str(requirement)
-            for requirement
-            in parse_requirements(requirements_txt)
-        ]
+# Only the package's own requirements; benchmarks/requirements.txt is for development.
+with Path('amazons3_blueprints/requirements.txt').open() as requirements_txt:
+    install_requires = [
+        str(requirement)
+        for requirement
+        in parse_requirements(requirements_txt)
+    ]
 
 
 config = {
@@ -29,8 +29,8 @@ config = {
         "Topic :: Scientific/Engineering",
         "Topic :: Software Development",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
     ],
-    "python_requires": ">=3.7"}
+    "python_requires": ">=3.8"}
 
 setup(**config)
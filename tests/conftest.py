@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Import amazons3_blueprints from this checkout, with or without it installed.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,36 @@
+from amazons3_blueprints import concurrency
+
+
+def make_controller():
+    return concurrency.AdaptiveConcurrencyController(
+        initial_limit=8, increase_step=0, min_window_size=4, verbose=False)
+
+
+def record_window(controller, latency, completions):
+    for _ in range(completions):
+        controller.record(latency)
+
+
+def test_requests_in_flight_at_a_cut_are_not_judged_at_the_new_limit():
+    controller = make_controller()
+    record_window(controller, 0.1, 8)
+    record_window(controller, 0.5, 8)
+    assert controller.limit == 4
+    record_window(controller, 5.0, 8)
+    assert controller.limit == 4
+
+
+def test_first_window_after_a_cut_sets_the_baseline():
+    controller = make_controller()
+    record_window(controller, 0.1, 8)
+    record_window(controller, 0.5, 8)
+    record_window(controller, 0.5, 8)
+    record_window(controller, 0.3, 4)
+    assert controller.limit == 4
+    assert controller._best_latency == 0.3
+    record_window(controller, 0.7, 4)
+    assert controller.limit == 2
+
+
+def test_managed_transfers_run_on_the_worker_thread():
+    assert not concurrency.transfer_config().use_threads
@@ -0,0 +1,77 @@
+import base64
+import os
+import zlib
+
+import pytest
+try:
+    from crc32c import crc32c
+except ImportError:
+    crc32c = None
+
+from amazons3_blueprints import integrity
+
+
+DATA = os.urandom(3 * 1024 + 7)
+PART_SIZES = [1024, 1, 2048, 0, 6]
+
+
+def split(data, part_sizes):
+    parts = []
+    start = 0
+    for part_size in part_sizes:
+        parts.append(data[start:start + part_size])
+        start += part_size
+    return parts
+
+
+def part_checksums(algorithm, parts):
+    checksums = []
+    for part in parts:
+        checksum = integrity.Checksum(algorithm)
+        checksum.update(part)
+        checksums.append(checksum)
+    return checksums
+
+
+@pytest.mark.parametrize('algorithm, crc', [
+    ('CRC32', zlib.crc32),
+    pytest.param('CRC32C', crc32c, marks=pytest.mark.skipif(
+        crc32c is None, reason='needs the crc32c package'))])
+@pytest.mark.parametrize('split_at', [0, 1, 1000, len(DATA)])
+def test_crc_combine_matches_crc_of_concatenation(algorithm, crc, split_at):
+    first, second = DATA[:split_at], DATA[split_at:]
+    combined = integrity.crc_combine(algorithm, crc(first), crc(second), len(second))
+    assert combined == crc(DATA)
+
+
+@pytest.mark.parametrize('algorithm', [
+    algorithm for algorithm in integrity.CRC_POLYNOMIALS
+    if integrity.algorithm_available(algorithm)])
+def test_full_object_checksum_matches_checksum_of_whole_object(algorithm):
+    whole = integrity.Checksum(algorithm)
+    whole.update(DATA)
+    checksums = part_checksums(algorithm, split(DATA, PART_SIZES))
+    assert integrity.full_object_checksum(checksums) == whole.encoded()
+
+
+def test_full_object_checksum_of_crc32_is_base64_of_zlib_crc32():
+    checksums = part_checksums('CRC32', split(DATA, PART_SIZES))
+    expected = base64.b64encode(zlib.crc32(DATA).to_bytes(4, 'big')).decode()
+    assert integrity.full_object_checksum(checksums) == expected
+
+
+# A three part upload and the checksums S3 reports for it, as GetObjectAttributes
+# and multipart ETags give them: the checksum of the part digests and a part count.
+COMPOSITE_PARTS = [b'The quick brown fox ', b'jumps over ', b'the lazy dog']
+COMPOSITE_CHECKSUMS = {
+    'CRC32': 'xU/lUQ==-3',
+    'SHA1': '35CNe/xk6dFHFPTTHUlYdG67E18=-3',
+    'SHA256': 'zaqbqwxblBztGfNY1qTEjrTPj3X1KS6Vofi9Umh9oHU=-3',
+    'MD5': '29c86a1fb7cd57ab41849af95d74d794-3',
+}
+
+
+@pytest.mark.parametrize('algorithm, reported', COMPOSITE_CHECKSUMS.items())
+def test_composite_checksum_matches_reported_value(algorithm, reported):
+    checksums = part_checksums(algorithm, COMPOSITE_PARTS)
+    assert integrity.composite_checksum(checksums) == integrity.strip_part_count(reported)
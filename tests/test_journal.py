@@ -0,0 +1,18 @@
+from amazons3_blueprints import journal
+
+
+def test_pending_pages_across_a_repeated_index(tmp_path):
+    job_journal = journal.JobJournal(str(tmp_path / 'job.db'))
+    # A resumed listing numbers its keys from 1 again, so indexes repeat.
+    first_listing = [(index, f'first/{index:02}') for index in range(1, 6)]
+    second_listing = [(index, f'second/{index:02}') for index in range(1, 6)]
+    list(job_journal.track(first_listing + second_listing))
+    job_journal.record('first/01', journal.STATE_DELETED)
+    job_journal.flush()
+
+    pending = list(job_journal.pending(page_size=3))
+    job_journal.close()
+
+    assert sorted(pending) == sorted(first_listing[1:] + second_listing)
+    assert len(pending) == len(set(pending))
+    assert [index for index, _ in pending] == sorted(index for index, _ in pending)
@@ -0,0 +1,23 @@
+import gzip
+import io
+
+from amazons3_blueprints import manifest
+
+
+INVENTORY_CSV = (
+    b'"my-bucket","reports/2024+summary%2Bdraft.csv","1024"\n'
+    b'"my-bucket","plain/key.csv","10"\n'
+    b'"my-bucket","caf%C3%A9/a+b+c.txt","5"\n')
+INVENTORY_KEYS = ['reports/2024 summary+draft.csv', 'plain/key.csv', 'café/a b c.txt']
+
+
+def test_inventory_csv_keys_decode_spaces_and_plus_signs():
+    keys = list(manifest.read_inventory_csv_keys(io.BytesIO(INVENTORY_CSV)))
+    assert keys == INVENTORY_KEYS
+
+
+def test_read_manifest_decodes_gzipped_inventory_csv(tmp_path):
+    inventory_path = tmp_path / 'data.csv.gz'
+    inventory_path.write_bytes(gzip.compress(INVENTORY_CSV))
+    keys = list(manifest.read_manifest(str(inventory_path), manifest_format='inventory_csv'))
+    assert keys == INVENTORY_KEYS
@@ -0,0 +1,51 @@
+from amazons3_blueprints import planner
+
+
+MEGABYTE = planner.MEGABYTE
+
+
+def requests_for(run_plan, size, etag):
+    run_plan.add('data/object', size, etag)
+    return dict(run_plan.requests)
+
+
+def test_verified_copy_of_multipart_source_follows_its_parts():
+    run_plan = planner.RunPlan(planner.OPERATION_MOVE, verify_checksums=True)
+    assert requests_for(run_plan, 100 * MEGABYTE, '"0123456789abcdef0123456789abcdef-3"') == {
+        'GetObjectAttributes': 3,
+        'HeadObject': 1,
+        'CreateMultipartUpload': 1,
+        'UploadPartCopy': 3,
+        'CompleteMultipartUpload': 1,
+        'DeleteObject': 1}
+
+
+def test_verified_copy_of_single_part_source_is_one_copy_object():
+    run_plan = planner.RunPlan(planner.OPERATION_MOVE, verify_checksums=True)
+    assert requests_for(run_plan, 100 * MEGABYTE, '"0123456789abcdef0123456789abcdef"') == {
+        'GetObjectAttributes': 3,
+        'CopyObject': 1,
+        'DeleteObject': 1}
+
+
+def test_managed_copy_splits_on_the_transfer_config():
+    run_plan = planner.RunPlan(planner.OPERATION_MOVE, journal=True)
+    assert requests_for(run_plan, 100 * MEGABYTE, '"0123456789abcdef0123456789abcdef-3"') == {
+        'HeadObject': 2,
+        'CreateMultipartUpload': 1,
+        'UploadPartCopy': 13,
+        'CompleteMultipartUpload': 1,
+        'DeleteObject': 1}
+
+
+def test_verified_stream_of_single_part_source_is_split_by_part_size():
+    run_plan = planner.RunPlan(
+        planner.OPERATION_MOVE, verify_checksums=True, stream_part_size=8 * MEGABYTE)
+    assert requests_for(run_plan, 20 * MEGABYTE, '"0123456789abcdef0123456789abcdef"') == {
+        'GetObjectAttributes': 3,
+        'HeadObject': 1,
+        'CreateMultipartUpload': 1,
+        'GetObject': 3,
+        'UploadPart': 3,
+        'CompleteMultipartUpload': 1,
+        'DeleteObject': 1}
@@ -0,0 +1,64 @@
+import pytest
+
+from amazons3_blueprints import manifest, move_file
+from amazons3_blueprints.reconcile import (
+    ONLY_IN_SOURCE, Difference, ListedObject, merge_join, write_manifests)
+
+
+def listed(*keys):
+    return [ListedObject(key, 1, 'etag') for key in keys]
+
+
+def joined(source_objects, destination_objects, **kwargs):
+    return [
+        (relative_key,
+         source.key if source else None,
+         destination.key if destination else None)
+        for relative_key, source, destination in merge_join(
+            source_objects, destination_objects, **kwargs)]
+
+
+def test_interleaved_keys_are_paired_by_relative_key():
+    assert joined(
+        listed('src/a', 'src/b', 'src/d'),
+        listed('dst/b', 'dst/c', 'dst/d', 'dst/e'),
+        source_prefix='src/',
+        destination_prefix='dst/') == [
+            ('a', 'src/a', None),
+            ('b', 'src/b', 'dst/b'),
+            ('c', None, 'dst/c'),
+            ('d', 'src/d', 'dst/d'),
+            ('e', None, 'dst/e')]
+
+
+def test_empty_source_yields_every_destination_key():
+    assert joined([], listed('a', 'b')) == [('a', None, 'a'), ('b', None, 'b')]
+
+
+def test_empty_destination_yields_every_source_key():
+    assert joined(listed('a', 'b'), []) == [('a', 'a', None), ('b', 'b', None)]
+
+
+def test_both_empty_yields_nothing():
+    assert joined([], []) == []
+
+
+@pytest.mark.parametrize('source_keys, destination_keys', [
+    (('b', 'a'), ('a', 'b')),
+    (('a', 'b'), ('b', 'a')),
+    (('a', 'a'), ('a',))])
+def test_out_of_order_listing_is_rejected(source_keys, destination_keys):
+    with pytest.raises(ValueError, match='out of order'):
+        joined(listed(*source_keys), listed(*destination_keys))
+
+
+def test_moving_a_manifest_with_preserved_structure_keeps_nested_keys_apart(tmp_path):
+    manifest_path = str(tmp_path / 'only_in_source.csv')
+    write_manifests(
+        [Difference(ONLY_IN_SOURCE, key[len('src/'):], ListedObject(key, 1, 'etag'), None)
+         for key in ('src/a/data.csv', 'src/b/data.csv', 'src/top.csv')],
+        {ONLY_IN_SOURCE: manifest_path})
+    assert [
+        move_file.preserved_destination_path('dst', 'src/', key)
+        for key in manifest.read_manifest(manifest_path)] == [
+            'dst/a/data.csv', 'dst/b/data.csv', 'dst/top.csv']
@@ -0,0 +1,28 @@
+from amazons3_blueprints import scheduler
+
+
+def test_set_rate_keeps_tokens_already_taken():
+    bucket = scheduler.TokenBucket(100)
+    assert bucket.try_acquire(100)
+    bucket.set_rate(50)
+    assert not bucket.try_acquire(25)
+
+
+def test_set_rate_clamps_tokens_to_new_capacity():
+    bucket = scheduler.TokenBucket(1000)
+    bucket.set_rate(10)
+    assert bucket.try_acquire(10)
+    assert not bucket.try_acquire()
+
+
+def test_limiting_an_unlimited_bucket_starts_full():
+    bucket = scheduler.TokenBucket(None)
+    bucket.set_rate(100)
+    assert bucket.try_acquire(100)
+
+
+def test_equal_prefixes_in_different_buckets_have_separate_rates():
+    prefix_scheduler = scheduler.PrefixScheduler(write_rate=1)
+    prefix_scheduler.acquire('source', 'data/a.csv', 'DELETE')
+    assert prefix_scheduler._bucket('destination', 'data/', 'COPY').try_acquire()
+    assert not prefix_scheduler._bucket('source', 'data/', 'DELETE').try_acquire()